@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import sys
+
+from cvangysel import argparse_utils, logging_utils, trec_utils
+
+import argparse
+import logging
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str, default='INFO')
+
+    parser.add_argument('document_paths',
+                        type=argparse_utils.existing_file_path, nargs='+')
+
+    parser.add_argument('--encoding', type=str, default='latin1')
+    parser.add_argument('--parser', type=str,
+                        choices=trec_utils.TRECTEXT_PARSERS, default='bytes')
+
+    parser.add_argument('--num_workers',
+                        type=argparse_utils.positive_int, default=8)
+
+    parser.add_argument('--batch_sizes',
+                        type=argparse_utils.positive_int, nargs='+',
+                        default=[1, 16, 128, 1024])
+
+    parser.add_argument('--tokenize', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    try:
+        logging_utils.configure_logging(args)
+    except IOError:
+        return -1
+
+    reader = trec_utils.TRECTextReader(
+        args.document_paths, args.encoding, parser=args.parser)
+
+    for batch_size in args.batch_sizes:
+        num_documents = 0
+
+        start_time = time.time()
+
+        for _ in reader.iter_document_multiprocessing(
+                num_workers=args.num_workers,
+                replace_digits=False, strip_html=False,
+                tokenize=args.tokenize,
+                batch_size=batch_size):
+            num_documents += 1
+
+        duration = time.time() - start_time
+
+        logging.info('Batch size %d: %d documents in %.2f seconds '
+                     '(%.2f documents/second).',
+                     batch_size, num_documents, duration,
+                     num_documents / max(duration, 1e-9))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import sys
+
+from cvangysel import argparse_utils, logging_utils, trec_utils
+
+import argparse
+import logging
+import time
+
+
+def benchmark(document_paths, encoding, parser):
+    num_documents = 0
+
+    start_time = time.time()
+
+    for document_path in document_paths:
+        for _ in trec_utils._iter_trectext_file(
+                document_path, encoding, parser):
+            num_documents += 1
+
+    return num_documents, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str, default='INFO')
+
+    parser.add_argument('document_paths',
+                        type=argparse_utils.existing_file_path, nargs='+')
+
+    parser.add_argument('--encoding', type=str, default='latin1')
+
+    parser.add_argument('--parsers', nargs='+',
+                        choices=trec_utils.TRECTEXT_PARSERS,
+                        default=trec_utils.TRECTEXT_PARSERS)
+
+    parser.add_argument('--verify', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    try:
+        logging_utils.configure_logging(args)
+    except IOError:
+        return -1
+
+    if args.verify:
+        logging.info('Verifying that all parsers agree.')
+
+        for document_path in args.document_paths:
+            documents = [
+                list(trec_utils._iter_trectext_file(
+                    document_path, args.encoding, parser))
+                for parser in args.parsers]
+
+            if any(other != documents[0] for other in documents[1:]):
+                logging.error('Parsers disagree on %s.', document_path)
+
+                return -1
+
+    for parser in args.parsers:
+        num_documents, duration = benchmark(
+            args.document_paths, args.encoding, parser)
+
+        logging.info('Parser %s: %d documents in %.2f seconds '
+                     '(%.2f documents/second).',
+                     parser, num_documents, duration,
+                     num_documents / max(duration, 1e-9))
+
+if __name__ == "__main__":
+    sys.exit(main())
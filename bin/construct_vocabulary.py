@@ -21,12 +21,16 @@ def main():
     parser.add_argument('--vocabulary_min_count', type=int, default=2)
     parser.add_argument('--vocabulary_min_word_size', type=int, default=2)
     parser.add_argument('--vocabulary_max_size', type=int, default=65536)
+    parser.add_argument('--vocabulary_max_candidate_words',
+                        type=argparse_utils.positive_int, default=None)
 
     parser.add_argument('--include_stopwords',
                         action='store_true', default=False)
 
     parser.add_argument('--num_workers',
                         type=argparse_utils.positive_int, default=8)
+    parser.add_argument('--chunk_size',
+                        type=argparse_utils.positive_int, default=1 << 26)
 
     parser.add_argument('--dictionary_out', required=True)
     parser.add_argument('--humanreadable_dictionary_out', default=None)
@@ -48,9 +52,11 @@ def main():
     vocabulary = io_utils.construct_vocabulary(
         args.document_paths,
         num_workers=args.num_workers,
+        chunk_size=args.chunk_size,
         min_count=args.vocabulary_min_count,
         min_word_size=args.vocabulary_min_word_size,
         max_vocab_size=args.vocabulary_max_size,
+        max_candidate_words=args.vocabulary_max_candidate_words,
         ignore_tokens=ignore_words,
         encoding=args.encoding)
 
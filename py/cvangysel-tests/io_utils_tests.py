@@ -1,3 +1,6 @@
+import os
+import tempfile
+import unicodedata
 import unittest
 
 from cvangysel import io_utils
@@ -5,6 +8,219 @@ from cvangysel import io_utils
 
 class IOUtilsTest(unittest.TestCase):
 
+    def test_open_gzip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.gz')
+
+            with io_utils.open(path, 'w', encoding='utf8') as f:
+                f.write('hello w\u00f6rld\n')
+
+            with io_utils.open(path, 'r', encoding='utf8') as f:
+                self.assertEqual(f.read(), 'hello w\u00f6rld\n')
+
+            with io_utils.open(path, 'wb', encoding=None) as f:
+                f.write(b'hello world\n')
+
+            with io_utils.open(path, 'rb', encoding=None) as f:
+                self.assertEqual(f.read(), b'hello world\n')
+
+    def test_character_stream(self):
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write('<doc>caf\u00e9\r\nau lait</doc>'.encode('utf8'))
+            f.flush()
+
+            with open(f.name, 'r', encoding='utf8') as text_f:
+                self.assertEqual(
+                    ''.join(io_utils.character_stream(text_f)),
+                    ' <doc> caf\u00e9\nau lait </doc> ')
+
+            # The limit is expressed in bytes; the character that
+            # straddles it is read in full.
+            with open(f.name, 'r', encoding='utf8') as text_f:
+                self.assertEqual(
+                    ''.join(io_utils.character_stream(text_f, limit=9)),
+                    ' <doc> caf\u00e9')
+
+            with open(f.name, 'r', encoding='utf8') as text_f:
+                text_f.seek(11)
+
+                self.assertEqual(
+                    ''.join(io_utils.character_block_stream(
+                        text_f, limit=14, block_size=1)),
+                    '\nau')
+
+            with open(f.name, 'rb') as binary_f:
+                self.assertEqual(
+                    ''.join(io_utils.character_block_stream(
+                        binary_f, encoding='utf8', block_size=2)),
+                    ' <doc> caf\u00e9\r\nau lait </doc> ')
+
+            # Text streams remain usable afterwards.
+            with open(f.name, 'r', encoding='utf8') as text_f:
+                self.assertEqual(
+                    ''.join(io_utils.character_block_stream(
+                        text_f, limit=14)),
+                    ' <doc> caf\u00e9\nau')
+
+                self.assertEqual(text_f.tell(), 14)
+                self.assertEqual(text_f.read(), ' lait</doc>')
+
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(b'ab\xffcd')
+            f.flush()
+
+            with open(f.name, 'rb') as binary_f, \
+                    self.assertLogs(level='ERROR'):
+                self.assertEqual(
+                    ''.join(io_utils.character_block_stream(
+                        binary_f, encoding='utf8')),
+                    'ab\ufffdcd')
+
+    def test_extract_vocabulary_chunks(self):
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(
+                ('Caf\u00e9 na\u00efve \u00fcber\r\n'
+                 'caf\u00e9\tfox <b>fox</b>\n'
+                 '\u4e2d\u6587 123 \ufb01ne  Zo\u00eb\n' * 20).encode(
+                    'utf8'))
+            f.flush()
+
+            for chunk_size in (1, 7, 100):
+                chunks = io_utils._chunk_file(f.name, 'utf8', chunk_size)
+
+                self.assertGreater(len(chunks), 1)
+                self.assertEqual(chunks[0][0], 0)
+                self.assertEqual(chunks[-1][1], os.path.getsize(f.name))
+
+                for (_, end), (start, _) in zip(chunks, chunks[1:]):
+                    self.assertEqual(end, start)
+
+            self.assertEqual(
+                io_utils._chunk_file(f.name, 'utf-16', 7),
+                [(0, os.path.getsize(f.name))])
+
+            def _counts(**kwargs):
+                words, _ = io_utils.extract_vocabulary(
+                    [f.name], 'utf8', **kwargs)
+
+                return {word: word_meta.count
+                        for word, word_meta in words.items()}
+
+            expected_counts = _counts()
+
+            self.assertEqual(expected_counts['caf\u00e9'], 40)
+            self.assertEqual(expected_counts['fox'], 40)
+            self.assertEqual(expected_counts['</s>'], 60)
+
+            for chunk_size in (1, 7, 100):
+                for num_workers in (1, 2):
+                    self.assertEqual(
+                        _counts(chunk_size=chunk_size,
+                                num_workers=num_workers),
+                        expected_counts)
+
+    def test_extract_vocabulary_approximate(self):
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            words = ['w{}'.format(chr(ord('a') + idx % 26) * (idx // 26 + 1))
+                     for idx in range(200)]
+
+            # Word idx occurs roughly 400 / (idx + 1) times.
+            lines = [' '.join(word
+                              for word_idx, word in enumerate(words)
+                              if line_idx % (word_idx + 1) == 0)
+                     for line_idx in range(400)]
+
+            f.write('\n'.join(lines).encode('ascii'))
+            f.flush()
+
+            exact_words, _ = io_utils.extract_vocabulary(
+                [f.name], 'ascii', ignore_tokens=['wb'])
+
+            exact_counts = {word: word_meta.count
+                            for word, word_meta in exact_words.items()}
+            num_words = sum(exact_counts.values())
+
+            self.assertNotIn('wb', exact_counts)
+
+            for max_candidate_words in (5, 20):
+                for num_workers, chunk_size in ((1, 1 << 20), (2, 512)):
+                    approximate_words, _ = io_utils.extract_vocabulary(
+                        [f.name], 'ascii', ignore_tokens=['wb'],
+                        max_candidate_words=max_candidate_words,
+                        num_workers=num_workers, chunk_size=chunk_size)
+
+                    max_error = num_words / (max_candidate_words + 1)
+
+                    for word, count in exact_counts.items():
+                        if count > max_error:
+                            self.assertIn(word, approximate_words)
+
+                        if word in approximate_words and \
+                                approximate_words[word].count:
+                            self.assertLessEqual(
+                                approximate_words[word].count, count)
+                            self.assertGreaterEqual(
+                                approximate_words[word].count,
+                                count - max_error)
+
+                    self.assertNotIn('wb', approximate_words)
+
+                    for word_meta in approximate_words.values():
+                        self.assertIs(type(word_meta.count), int)
+
+    def test_filter_streams(self):
+        characters = ''.join(
+            chr(codepoint) for codepoint in range(0x3000))
+        characters += '\uff21\u4e2d\U0001d400\U00017000\U0010ffff'
+
+        self.assertEqual(
+            ''.join(io_utils.filter_non_latin_stream(characters)),
+            ''.join(char for char in characters
+                    if char.isspace() or
+                    'LATIN' in unicodedata.name(char, '') or
+                    'SIGN' in unicodedata.name(char, '')))
+
+        self.assertEqual(
+            ''.join(io_utils.filter_non_alphanumeric_stream(characters)),
+            ''.join(char for char in characters
+                    if char.isalnum() or char.isspace() or
+                    char in '</>'))
+
+    def test_tokenizer(self):
+        text = ('The quick  Brown\tfox\r\nCaf\u00e9 cafe\u0301 \ufb01ne '
+                '\u0130stanbul\u00a0x\x0by \uff21\uff42\uff43 123 4\u00bd '
+                '\u03b1\u03b2\u03b3 \u4e2d\u6587 <b>bold</b> and/or\n'
+                '\n  the end.')
+
+        def reference(text, **kwargs):
+            return list(io_utils.token_stream(
+                io_utils.lowercased_stream(
+                    io_utils.filter_non_latin_stream(
+                        io_utils.filter_non_alphanumeric_stream(
+                            io_utils.unicode_normalize_stream(
+                                iter(text))))), **kwargs))
+
+        for kwargs in ({},
+                       {'eos_chars': []},
+                       {'ignore_words': ['the', 'and']},
+                       {'eos_chars': [], 'ignore_words': ['fox']},
+                       {'eos_token': '<eos>'}):
+            tokenizer = io_utils.Tokenizer(**kwargs)
+
+            for candidate in (text, text + 'x', '', '\n'):
+                self.assertEqual(list(tokenizer(candidate)),
+                                 reference(candidate, **kwargs))
+
+                # Tokenizing in blocks gives the same result, even when
+                # tokens straddle blocks.
+                for block_size in (1, 3, 16):
+                    self.assertEqual(
+                        list(tokenizer.iter_tokens(
+                            candidate[idx:idx + block_size]
+                            for idx in range(
+                                0, len(candidate), block_size))),
+                        reference(candidate, **kwargs))
+
     def test_windowed_translated_token_stream(self):
         words = {
             '</s>': io_utils.Word(id=0, count=1),
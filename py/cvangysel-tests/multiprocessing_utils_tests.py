@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+
+from cvangysel import multiprocessing_utils
+
+
+def _queue_worker_initializer(result_queue, stop_event):
+    _queue_worker.result_queue = result_queue
+    _queue_worker.stop_event = stop_event
+
+
+def _queue_worker(num_items):
+    if num_items == -2:
+        # Simulates a worker that is killed (e.g., by the OOM killer).
+        os.kill(os.getpid(), signal.SIGKILL)
+    elif num_items == -3:
+        # Same, but only after the consumer started iterating.
+        time.sleep(0.5)
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    try:
+        if num_items < 0:
+            raise ValueError()
+
+        for idx in range(num_items):
+            if _queue_worker.stop_event.is_set():
+                break
+
+            _queue_worker.result_queue.put((num_items, idx))
+    finally:
+        _queue_worker.result_queue.put(multiprocessing_utils.END_OF_TASK)
+
+    return num_items
+
+
+def _legacy_queue_worker(num_items):
+    for idx in range(num_items):
+        _queue_worker.result_queue.put((num_items, idx))
+
+    return num_items
+
+
+class MultiprocessingUtilsTest(unittest.TestCase):
+
+    def _queue_iterator(self, tasks):
+        result_queue = multiprocessing.Queue()
+        stop_event = multiprocessing.Event()
+
+        pool = multiprocessing.Pool(
+            2,
+            initializer=_queue_worker_initializer,
+            initargs=[result_queue, stop_event])
+
+        worker_result = pool.map_async(_queue_worker, tasks)
+        pool.close()
+
+        return multiprocessing_utils.QueueIterator(
+            pool, worker_result, result_queue,
+            num_tasks=len(tasks), stop_event=stop_event, timeout=0.1)
+
+    def test_queue_iterator(self):
+        it = self._queue_iterator([3, 0, 5, 1])
+
+        self.assertEqual(
+            sorted(it),
+            sorted((num_items, idx)
+                   for num_items in (3, 0, 5, 1)
+                   for idx in range(num_items)))
+
+        self.assertTrue(it.closed)
+        self.assertEqual(it.count, 9)
+
+    def test_queue_iterator_legacy_protocol(self):
+        result_queue = multiprocessing.Queue()
+
+        pool = multiprocessing.Pool(
+            2,
+            initializer=_queue_worker_initializer,
+            initargs=[result_queue, None])
+
+        worker_result = pool.map_async(_legacy_queue_worker, [3, 0, 5])
+        pool.close()
+
+        it = multiprocessing_utils.QueueIterator(
+            pool, worker_result, result_queue, timeout=0.1)
+
+        self.assertEqual(
+            sorted(it),
+            sorted((num_items, idx)
+                   for num_items in (3, 0, 5)
+                   for idx in range(num_items)))
+
+        self.assertTrue(it.closed)
+        self.assertEqual(it.count, 8)
+
+    def test_queue_iterator_early_close(self):
+        it = self._queue_iterator([100000, 100000, 100000])
+
+        next(it)
+        it.close()
+
+        self.assertRaises(StopIteration, next, it)
+
+    def test_queue_iterator_worker_failure(self):
+        it = self._queue_iterator([2, -1])
+
+        self.assertRaises(ValueError, list, it)
+        self.assertTrue(it.closed)
+
+    def test_queue_iterator_killed_worker(self):
+        it = self._queue_iterator([3, -2])
+
+        # The killed worker never reports back; close should not wait for
+        # it forever.
+        it.close()
+
+        self.assertTrue(it.closed)
+        self.assertRaises(StopIteration, next, it)
+
+    def test_queue_iterator_killed_worker_while_iterating(self):
+        it = self._queue_iterator([3, -3])
+
+        self.assertRaises(RuntimeError, list, it)
+        self.assertTrue(it.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
+import glob
+import io
+import os
+import tempfile
+import threading
 import unittest
 
+import numpy as np
+
 from cvangysel import trec_utils, io_utils
 
 
@@ -356,5 +363,748 @@ Dallas.
 
         self.assertEqual(doc_id, 'LA051289-0030')
 
+    DOC_HDR = """<DOC>
+<DOCNO>
+clueweb09-en0000-00-00000
+</DOCNO>
+<DOCOLDNO>old-0000</DOCOLDNO>
+<DOCHDR>
+http://example.com/
+Content-Type: text/html
+</DOCHDR>
+<html>
+  caf\u00e9 \u00a0
+\u00a0
+<DOCOLDNO>old-0001</DOCOLDNO>
+ <b>bold</b></DOC>
+<DOC>
+<DOCNO>windows-0001</DOCNO>
+first\r\nsecond\rthird
+</DOC>
+"""
+
+    def test_bytes_parser(self):
+        for text in (TRECUtilsTest.DOC,
+                     TRECUtilsTest.DOC_PJG,
+                     TRECUtilsTest.DOC_SPACES,
+                     TRECUtilsTest.DOC_HDR):
+            for encoding in ('latin1', 'utf8'):
+                expected = list(trec_utils._parse_trectext(
+                    io.StringIO(text, newline=None)))
+
+                for block_size in (64, 1 << 20):
+                    self.assertEqual(
+                        list(trec_utils._parse_trectext_bytes(
+                            io.BytesIO(text.encode(encoding)), encoding,
+                            block_size=block_size)),
+                        expected)
+
+    def test_bytes_parser_header(self):
+        (first_doc_id, first_doc_content), \
+            (second_doc_id, second_doc_content) = \
+            trec_utils._parse_trectext_bytes(
+                io.BytesIO(TRECUtilsTest.DOC_HDR.encode('utf8')), 'utf8')
+
+        self.assertEqual(first_doc_id, 'clueweb09-en0000-00-00000')
+        self.assertEqual(first_doc_content,
+                         ['<html>', 'caf', '<b>bold</b>'])
+
+        self.assertEqual(second_doc_id, 'windows-0001')
+        self.assertEqual(second_doc_content,
+                         ['first', 'second', 'third', ''])
+
+    def test_bytes_parser_unterminated_header(self):
+        text = (b'<DOC>\n<DOCNO>truncated-0000</DOCNO>\n<DOCHDR>\n'
+                b'http://example.com/\nsome text</DOC>\n'
+                b'<DOC>\n<DOCNO>next-0001</DOCNO>\ncontent\n</DOC>\n')
+
+        self.assertEqual(
+            list(trec_utils._parse_trectext_bytes(
+                io.BytesIO(text), 'ascii')),
+            [('truncated-0000',
+              ['<DOCHDR>', 'http://example.com/', 'some text']),
+             ('next-0001', ['content', ''])])
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+
+            for idx, text in enumerate((TRECUtilsTest.DOC_PJG,
+                                        TRECUtilsTest.DOC_SPACES)):
+                paths.append(os.path.join(tmp_dir, '{}.trectext'.format(idx)))
+
+                with open(paths[-1], 'w', encoding='latin1') as f:
+                    f.write(text)
+
+            reader = trec_utils.TRECTextReader(paths, 'latin1')
+
+            index = reader.build_index()
+            index.save(os.path.join(tmp_dir, 'index.npz'))
+
+            index = trec_utils.TRECTextIndex.load(
+                os.path.join(tmp_dir, 'index.npz'))
+
+            self.assertEqual(len(index), 3)
+            self.assertIn('FR941110-0-00002', index)
+            self.assertNotIn('FR941110-0-00003', index)
+
+            path, offset, length = index['LA051289-0030']
+            self.assertEqual((path, offset), (paths[1], 0))
+
+            reader = trec_utils.TRECTextReader(paths, 'latin1', index=index)
+
+            expected = dict(reader.iter_documents(strip_html=False))
+
+            self.assertEqual(
+                list(reader.get_documents(
+                    ['LA051289-0030', 'unknown', 'FR941110-0-00002'],
+                    strip_html=False)),
+                [('FR941110-0-00002', expected['FR941110-0-00002']),
+                 ('LA051289-0030', expected['LA051289-0030'])])
+
+            # Without an index, one is built by scanning the collection.
+            reader = trec_utils.TRECTextReader(paths, 'latin1')
+
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(
+                    list(reader.get_documents(['LA051289-0030'],
+                                              strip_html=False)),
+                    [('LA051289-0030', expected['LA051289-0030'])])
+
+            self.assertIsNotNone(reader.index)
+
+    def test_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'collection.trectext')
+
+            with open(path, 'w', encoding='latin1') as f:
+                f.write(TRECUtilsTest.DOC_PJG)
+                f.write('\n')
+                f.write(TRECUtilsTest.DOC_SPACES)
+                f.write('\n')
+                f.write(TRECUtilsTest.DOC_HDR)
+
+            expected = list(trec_utils._iter_trectext_file(path, 'latin1'))
+            self.assertEqual(len(expected), 5)
+
+            for chunk_size in (1, 5, 64, 1000, 4096, 1 << 20):
+                chunks = trec_utils._split_trectext_paths(
+                    [path], 'latin1', num_workers=1, chunk_size=chunk_size)
+
+                for parser in trec_utils.TRECTEXT_PARSERS:
+                    self.assertEqual(
+                        [document
+                         for _, start, end in chunks
+                         for document in trec_utils._iter_trectext_file(
+                             path, 'latin1', parser, start=start, end=end)],
+                        expected)
+
+    def test_iter_trectext_file_stop_while_skipping(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'docs.trectext')
+
+            with open(path, 'w', encoding='latin1') as f:
+                for idx in range(10):
+                    f.write('<DOC>\n<DOCNO>doc-{}</DOCNO>\ntext\n'
+                            '</DOC>\n'.format(idx))
+
+            document_filter = {'doc-9'}
+
+            for parser in trec_utils.TRECTEXT_PARSERS:
+                for start, end in ((0, None), (0, os.path.getsize(path))):
+                    documents = trec_utils._iter_trectext_file(
+                        path, 'latin1', parser, start=start, end=end,
+                        document_filter=document_filter,
+                        stop_event=threading.Event())
+
+                    self.assertEqual([doc_id for doc_id, _ in documents],
+                                     ['doc-9'])
+
+                    # The consumer never sees the skipped documents, so the
+                    # iterator itself needs to stop.
+                    stop_event = threading.Event()
+                    stop_event.set()
+
+                    self.assertEqual(
+                        list(trec_utils._iter_trectext_file(
+                            path, 'latin1', parser, start=start, end=end,
+                            document_filter=document_filter,
+                            stop_event=stop_event)),
+                        [])
+
+    def test_iter_document_multiprocessing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+
+            for idx, text in enumerate((TRECUtilsTest.DOC_PJG,
+                                        TRECUtilsTest.DOC_SPACES,
+                                        TRECUtilsTest.DOC_HDR)):
+                paths.append(os.path.join(tmp_dir, '{}.trectext'.format(idx)))
+
+                with open(paths[-1], 'w', encoding='latin1') as f:
+                    f.write(text)
+
+            reader = trec_utils.TRECTextReader(paths, 'latin1', 'bytes')
+
+            expected = sorted(reader.iter_documents(strip_html=False))
+
+            for kwargs in ({},
+                           {'chunk_size': 512},
+                           {'batch_size': 1},
+                           {'max_in_flight_documents': 1}):
+                self.assertEqual(
+                    sorted(reader.iter_document_multiprocessing(
+                        num_workers=2, strip_html=False, **kwargs)),
+                    expected)
+
+            document_ids = {'FR941110-0-00002', 'LA051289-0030',
+                            'clueweb09-en0000-00-00000', 'unknown'}
+
+            for parser in trec_utils.TRECTEXT_PARSERS:
+                reader = trec_utils.TRECTextReader(paths, 'latin1', parser)
+
+                for chunk_size in (None, 512):
+                    self.assertEqual(
+                        sorted(reader.iter_document_multiprocessing(
+                            num_workers=2, strip_html=False,
+                            document_ids=document_ids,
+                            chunk_size=chunk_size)),
+                        [document for document in expected
+                         if document[0] in document_ids])
+
+    def test_peek_document_id(self):
+        data = TRECUtilsTest.DOC_HDR.encode('latin1')
+
+        for doc_start, doc_end in trec_utils._iter_trectext_spans(data):
+            self.assertEqual(
+                trec_utils._peek_trectext_document_id(
+                    data, doc_start, doc_end, 'latin1'),
+                trec_utils._parse_trectext_document(
+                    data[doc_start:doc_end], 'latin1')[0])
+
+        # Identifiers that cannot be determined from the <DOCNO> line.
+        for doc in (b'<DOC>\n<TEXT>\n<DOCNO>a</DOCNO>\n</DOC>\n',
+                    b'<DOC>\n<DOCNO>a\n</DOC>\n',
+                    b'<DOC>\n<DOCNO>a\r</DOCNO>\n</DOC>\n'):
+            self.assertIsNone(trec_utils._peek_trectext_document_id(
+                doc, 0, len(doc), 'latin1'))
+
+    def test_sharded_trectext_writer(self):
+        documents = [('doc{}'.format(idx), 'text {}'.format(idx))
+                     for idx in range(10)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for kwargs in ({},
+                           {'encoding': None},
+                           {'compress': True, 'num_workers': 0},
+                           {'compress': True, 'num_workers': 2,
+                            'buffer_size': 16}):
+                base = os.path.join(tmp_dir, str(len(os.listdir(tmp_dir))))
+
+                writer = trec_utils.ShardedTRECTextWriter(
+                    base, shard_size=None, max_shard_bytes=110, **kwargs)
+
+                for doc_id, doc_text in documents:
+                    writer.write_document(doc_id, doc_text)
+
+                writer.close()
+
+                shard_paths = sorted(
+                    glob.glob('{}_*'.format(base)),
+                    key=lambda path: int(path.split('_')[-1].split('.')[0]))
+
+                # Every shard holds two documents (55 bytes each), and
+                # the last shard is empty.
+                self.assertEqual(len(shard_paths), 6)
+
+                shards = []
+
+                for shard_path in shard_paths:
+                    with io_utils.open(shard_path, 'rb', encoding=None) as f:
+                        shards.append(f.read())
+
+                self.assertEqual(
+                    b''.join(shards),
+                    ''.join('<DOC>\n<DOCNO>{}</DOCNO>\n<TEXT>\n{}\n'
+                            '</TEXT>\n</DOC>\n'.format(doc_id, doc_text)
+                            for doc_id, doc_text in documents).encode(
+                                'ascii'))
+                self.assertEqual(shards[-1], b'')
+
+    def test_evaluate_run(self):
+        run = {
+            'q1': {'a': 3.0, 'b': 2.0, 'c': 1.0, 'e': 0.5},
+            'q2': {'x': 1.0, 'y': 1.0},
+            'q3': {'z': 1.0},
+        }
+
+        qrel = {
+            'q1': {'a': 1, 'b': 0, 'c': 2, 'd': 1, 'f': -1},
+            'q2': {'x': 1},
+        }
+
+        trec_eval = trec_utils.evaluate_run(
+            run, qrel,
+            measures=['P_5', 'map', 'recip_rank', 'Rprec', 'bpref', 'ndcg',
+                      'num_rel_ret'])
+
+        self.assertEqual(sorted(trec_eval), ['all', 'q1', 'q2'])
+
+        self.assertAlmostEqual(trec_eval['q1']['P_5'], 2.0 / 5.0)
+        self.assertAlmostEqual(trec_eval['q1']['map'], (1.0 + 2.0 / 3.0) / 3.0)
+        self.assertAlmostEqual(trec_eval['q1']['recip_rank'], 1.0)
+        self.assertAlmostEqual(trec_eval['q1']['Rprec'], 2.0 / 3.0)
+        self.assertAlmostEqual(trec_eval['q1']['bpref'], 1.0 / 3.0)
+        self.assertAlmostEqual(trec_eval['q1']['ndcg'],
+                               2.0 / (2.0 + 1.0 / np.log2(3.0) + 0.5))
+        self.assertEqual(trec_eval['q1']['num_rel_ret'], 2.0)
+
+        # Ties are broken by decreasing document identifier.
+        self.assertAlmostEqual(trec_eval['q2']['recip_rank'], 0.5)
+
+        self.assertEqual(trec_eval['all']['num_q'], 2.0)
+        self.assertEqual(trec_eval['all']['num_rel_ret'], 3.0)
+        self.assertAlmostEqual(trec_eval['all']['recip_rank'], 0.75)
+
+    def test_evaluate_runs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            qrel_path = os.path.join(tmp_dir, 'qrel')
+            run_path = os.path.join(tmp_dir, 'run')
+
+            with open(qrel_path, 'w') as f_qrel:
+                f_qrel.write('q1 0 a 1\nq1 0 c 2\nq2 0 x 1\n')
+
+            with open(run_path, 'w') as f_run:
+                f_run.write('q1 Q0 c 1 2.0 r\nq1 Q0 a 2 1.0 r\n'
+                            'q2 Q0 y 1 1.0 r\n')
+
+            online_run = trec_utils.OnlineTRECRun('online')
+            online_run.add_ranking('q1', [(1.0, 'a'), (0.5, 'b')])
+
+            runs = [
+                run_path,
+                online_run,
+                {'q2': {'x': 1.0}},
+                trec_utils.ColumnarTRECRun.from_dict(
+                    {'q1': {'b': 1.0, 'c': 0.5}}),
+            ]
+
+            with open(qrel_path, 'r') as f_qrel:
+                qrel = trec_utils.parse_qrel(f_qrel)
+
+            with open(run_path, 'r') as f_run:
+                run = trec_utils.parse_trec_run(f_run, return_score=True)
+
+            expected = [
+                trec_utils.evaluate_run(run, qrel)
+                for run in (run,
+                            {'q1': {'a': 1.0, 'b': 0.5}},
+                            {'q2': {'x': 1.0}},
+                            {'q1': {'b': 1.0, 'c': 0.5}})]
+
+            for num_workers in (1, 2):
+                trec_evals = dict(trec_utils.evaluate_runs(
+                    runs, qrel_path, num_workers=num_workers))
+
+                self.assertEqual(sorted(trec_evals), list(range(len(runs))))
+
+                for idx, trec_eval in trec_evals.items():
+                    self.assertEqual(trec_eval, expected[idx])
+
+            online_run.close_and_write(os.path.join(tmp_dir, 'online'))
+
+    def test_online_trec_run_evaluation(self):
+        qrel = {
+            'q1': {'a': 1, 'b': 0, 'c': 2},
+            'q2': {'x': 1},
+        }
+
+        run = trec_utils.OnlineTRECRun(
+            'model', rank_cutoff=2, qrel=qrel,
+            measures=['P_5', 'map', 'num_rel_ret'])
+
+        run.add_ranking('q1', [(3.0, 'b'), (1.0, 'c'), (1.0, 'a')])
+
+        self.assertAlmostEqual(run.evaluation()['q1']['map'], 1.0 / 4.0)
+        self.assertEqual(run.evaluation()['all']['num_q'], 1.0)
+
+        # Topics without relevance judgments are not evaluated.
+        run.add_ranking('q3', [(1.0, 'a')])
+        run.add_ranking('q2', (np.array([1.0, 2.0]), np.array(['x', 'y'])))
+
+        trec_eval = run.evaluation()
+
+        self.assertEqual(sorted(trec_eval), ['all', 'q1', 'q2'])
+        self.assertAlmostEqual(trec_eval['all']['map'],
+                               (1.0 / 4.0 + 1.0 / 2.0) / 2.0)
+        self.assertAlmostEqual(trec_eval['all']['P_5'], 2.0 / 10.0)
+        self.assertEqual(trec_eval['all']['num_rel_ret'], 2.0)
+
+        self.assertEqual(run.close_and_evaluate(), trec_eval)
+
+    def test_sparse_entity_document_associations(self):
+        associations_data = ('e2 d1 1.0\n'
+                             'e1 d1 1.0\n'
+                             'e3 d2 1.0\n'
+                             'e1 d3 1.0\n'
+                             'e1 d1 1.0\n'
+                             'e4 d3 1.0\n')
+
+        for kwargs in ({},
+                       {'max_unique_entities': 2},
+                       {'document_ids': {'d1', 'd2'}},
+                       {'document_ids': {'d3'}, 'max_unique_entities': 1}):
+            expected = trec_utils.EntityDocumentAssociations(
+                io.StringIO(associations_data), **kwargs)
+
+            for chunk_size in (1, 16, 1 << 20):
+                associations = \
+                    trec_utils.SparseEntityDocumentAssociations.parse(
+                        io.BytesIO(associations_data.encode('utf8')),
+                        chunk_size=chunk_size, **kwargs)
+
+                self.assertEqual(set(associations.entities),
+                                 expected.entities)
+                self.assertEqual(dict(associations.entities_per_document),
+                                 dict(expected.entities_per_document))
+                self.assertEqual(dict(associations.documents_per_entity),
+                                 dict(expected.documents_per_entity))
+
+                self.assertEqual(associations.max_entities_per_document,
+                                 expected.max_entities_per_document)
+                self.assertEqual(associations.num_associations,
+                                 expected.num_associations)
+
+        self.assertIn('e1', associations.entities)
+        self.assertNotIn('e2', associations.entities)
+
+        self.assertEqual(associations.documents_per_entity['e1'], {'d3'})
+        self.assertEqual(associations.documents_per_entity['e2'], set())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            associations.save(os.path.join(tmp_dir, 'associations'))
+
+            loaded = trec_utils.SparseEntityDocumentAssociations.load(
+                os.path.join(tmp_dir, 'associations'))
+
+            self.assertEqual(dict(loaded.entities_per_document),
+                             dict(associations.entities_per_document))
+            self.assertEqual(loaded.num_associations,
+                             associations.num_associations)
+
+    def test_identity_document_associations(self):
+        associations = trec_utils.IdentityDocumentAssociations(['d1', 'd2'])
+
+        self.assertEqual(associations.entities, {'d1', 'd2'})
+        self.assertEqual(dict(associations.entities_per_document),
+                         {'d1': {'d1'}, 'd2': {'d2'}})
+        self.assertEqual(associations.documents_per_entity['d2'], {'d2'})
+
+        self.assertNotIn('d3', associations.documents_per_entity)
+        self.assertRaises(KeyError,
+                          lambda: associations.entities_per_document['d3'])
+
+        self.assertEqual(associations.max_entities_per_document, 1)
+        self.assertEqual(associations.num_associations, 2)
+
+    def test_columnar_trec_run(self):
+        run_data = ('q1 Q0 d1 1 3.5 r\n'
+                    '\n'
+                    'q2 Q0 d2 1 2.0 r 1\n'
+                    'q1 Q0 d3 2 1.5 r\n'
+                    'q2 Q0 d1 2 1.0 r\n'
+                    'q1 Q0 d4 3 0.5 r')
+
+        for chunk_size in (1, 16, 1 << 20):
+            run = trec_utils.ColumnarTRECRun.parse(
+                io.BytesIO(run_data.encode('utf8')), chunk_size=chunk_size)
+
+            self.assertEqual(list(run), ['q1', 'q2'])
+
+            object_ids, scores = run['q1']
+            self.assertEqual(object_ids.tolist(), [b'd1', b'd3', b'd4'])
+            self.assertEqual(scores.tolist(), [3.5, 1.5, 0.5])
+
+            for return_score in (False, True):
+                self.assertEqual(
+                    run.to_dict(return_score=return_score),
+                    trec_utils.parse_trec_run(io.StringIO(run_data),
+                                              return_score=return_score))
+
+        self.assertEqual(
+            trec_utils.ColumnarTRECRun.from_dict(
+                run.to_dict(return_score=True)).to_dict(return_score=True),
+            run.to_dict(return_score=True))
+
+        self.assertRaises(AssertionError,
+                          trec_utils.ColumnarTRECRun.parse,
+                          io.BytesIO(b'q1 Q0 d1 1 1.0 r\nq1 Q0 d1 2 0.5 r\n'))
+
+    def test_write_run(self):
+        data = {
+            'q1': [(0.5, 'd1'), (2.0, 'd2'), (0.5, 'd3'), (1.0, 'd4')],
+            'q2': [(1.0, 'd5')],
+        }
+
+        expected = (
+            'q1 Q0 d2 1 2.0000000000000000000000000000000000000000 m\n'
+            'q1 Q0 d4 2 1.0000000000000000000000000000000000000000 m\n'
+            'q1 Q0 d3 3 0.5000000000000000000000000000000000000000 m\n'
+            'q2 Q0 d5 1 1.0000000000000000000000000000000000000000 m\n')
+
+        array_data = {
+            subject_id: (np.array([relevance for relevance, _ in ranking]),
+                         np.array([object_id for _, object_id in ranking],
+                                  dtype=np.bytes_))
+            for subject_id, ranking in data.items()}
+
+        for run_data in (data, array_data):
+            out_f = io.StringIO()
+            trec_utils.write_run('m', run_data, out_f,
+                                 max_objects_per_query=3)
+
+            self.assertEqual(out_f.getvalue(), expected)
+
+        out_f = io.StringIO()
+        trec_utils.write_qrel(None, array_data, out_f)
+
+        self.assertEqual(out_f.getvalue(),
+                         'q1 0 d2 2.0\nq1 0 d4 1.0\nq1 0 d3 0.5\n'
+                         'q1 0 d1 0.5\nq2 0 d5 1.0\n')
+
+    def test_fuse_runs(self):
+        runs = [{'q1': {'d1': 3.0, 'd2': 1.0}, 'q2': {'d1': 1.0}},
+                {'q1': {'d2': 4.0, 'd3': 2.0}}]
+
+        def _fuse(**kwargs):
+            return trec_utils.fuse_runs(runs, **kwargs).to_dict(
+                return_score=True)
+
+        fused_run = _fuse(method='combsum', normalization='minmax')
+
+        self.assertEqual(list(fused_run), ['q1', 'q2'])
+        self.assertEqual(list(fused_run['q1'].items()),
+                         [('d2', 1.0), ('d1', 1.0), ('d3', 0.0)])
+        self.assertEqual(list(fused_run['q2'].items()), [('d1', 1.0)])
+
+        fused_run = _fuse(method='combmnz', normalization='minmax')
+
+        self.assertEqual(list(fused_run['q1'].items()),
+                         [('d2', 2.0), ('d1', 1.0), ('d3', 0.0)])
+
+        fused_run = _fuse(method='combsum', normalization='rank')
+
+        self.assertEqual(list(fused_run['q1'].items()),
+                         [('d2', 1.5), ('d1', 1.0), ('d3', 0.5)])
+
+        fused_run = _fuse(method='rrf', rrf_k=60)
+
+        self.assertEqual(list(fused_run['q1']), ['d2', 'd1', 'd3'])
+        self.assertAlmostEqual(fused_run['q1']['d2'], 1.0 / 61 + 1.0 / 62)
+
+        fused_run = _fuse(method='combsum', normalization='zscore')
+
+        self.assertAlmostEqual(fused_run['q1']['d2'], 0.0)
+        self.assertAlmostEqual(fused_run['q1']['d3'], -1.0)
+
+    def test_compute_significance_matrix(self):
+        rng = np.random.RandomState(0)
+
+        trec_evals = []
+
+        for _ in range(4):
+            trec_evals.append({
+                'q{}'.format(topic_idx): {
+                    'map': rng.rand(),
+                    'P_10': rng.rand(),
+                }
+                for topic_idx in range(20)})
+
+            trec_evals[-1]['all'] = {'map': 0.0, 'P_10': 0.0}
+
+        p_values = trec_utils.compute_significance_matrix(
+            trec_evals, ['map', 'P_10'])
+
+        for first_idx in range(4):
+            self.assertTrue(np.isnan(p_values['map'][first_idx, first_idx]))
+
+            for second_idx in range(first_idx + 1, 4):
+                expected = trec_utils.compute_significance(
+                    trec_evals[first_idx], trec_evals[second_idx],
+                    ['map', 'P_10'])
+
+                for measure in ('map', 'P_10'):
+                    self.assertAlmostEqual(
+                        p_values[measure][first_idx, second_idx],
+                        expected[measure])
+                    self.assertEqual(
+                        p_values[measure][first_idx, second_idx],
+                        p_values[measure][second_idx, first_idx])
+
+        corrected_p_values = trec_utils.compute_significance_matrix(
+            trec_evals, ['map'], correction='bonferroni')
+
+        np.testing.assert_allclose(
+            corrected_p_values['map'],
+            np.minimum(p_values['map'] * 6, 1.0))
+
+        p_values = np.array([0.01, 0.04, 0.03, 0.005])
+
+        np.testing.assert_allclose(
+            trec_utils._correct_p_values(p_values, 'holm'),
+            [0.03, 0.06, 0.06, 0.02])
+
+    def test_compute_significance_resampling(self):
+        rng = np.random.RandomState(0)
+
+        trec_evals = [
+            {'q{}'.format(topic_idx): {'map': rng.rand() + shift}
+             for topic_idx in range(20)}
+            for shift in (0.0, 0.0, 1.0)]
+
+        trec_evals.append(trec_evals[0])
+
+        for test in ('randomization', 'bootstrap'):
+            p_values = trec_utils.compute_significance_matrix(
+                trec_evals, ['map'], test=test,
+                num_samples=2000, block_size=300, seed=42)['map']
+
+            # Identical systems.
+            self.assertEqual(p_values[0, 3], 1.0)
+
+            # Clearly different systems.
+            self.assertEqual(p_values[0, 2], 1.0 / 2001)
+
+            self.assertGreater(p_values[0, 1], 0.05)
+
+            np.testing.assert_array_equal(
+                trec_utils.compute_significance_matrix(
+                    trec_evals, ['map'], test=test,
+                    num_samples=2000, block_size=300, seed=42,
+                    num_workers=2)['map'],
+                p_values)
+
+            self.assertEqual(
+                trec_utils.compute_significance(
+                    trec_evals[0], trec_evals[1], ['map'], test=test,
+                    num_samples=2000, block_size=300, seed=42)['map'],
+                p_values[0, 1])
+
+    def test_columnar_trec_qrel(self):
+        qrel_data = ('2 0 D3 1\n'
+                     '1 0 D1 0\n'
+                     '2 0 D1 2\n'
+                     '1 0 D2 1\n'
+                     '1 0 D1 1\n')
+
+        expected = [('1', [('D1', 0.0), ('D2', 1.0), ('D1', 1.0)]),
+                    ('2', [('D3', 1.0), ('D1', 2.0)])]
+
+        self.assertEqual(trec_utils.parse_qrel(io.StringIO(qrel_data)),
+                         expected)
+
+        for chunk_size in (1, 10, 1 << 20):
+            qrel = trec_utils.ColumnarTRECQrel.parse(
+                io.BytesIO(qrel_data.encode('utf8')), chunk_size=chunk_size)
+
+            self.assertEqual(qrel.to_list(), expected)
+            self.assertEqual(qrel.relevances.dtype, np.int8)
+
+        self.assertEqual(qrel.to_dict(),
+                         {'1': {'D1': 1.0, 'D2': 1.0},
+                          '2': {'D3': 1.0, 'D1': 2.0}})
+
+        self.assertEqual(qrel.get('1', 'D1'), 1.0)
+        self.assertEqual(qrel.get('2', 'D1'), 2.0)
+        self.assertIsNone(qrel.get('2', 'D2'))
+        self.assertIsNone(qrel.get('3', 'D1'))
+
+        np.testing.assert_array_equal(
+            qrel.get_relevances('1', ['D2', 'D4', 'D1', 'D3']),
+            [1.0, np.nan, 1.0, np.nan])
+
+        self.assertEqual(
+            trec_utils.parse_qrel(io.StringIO(qrel_data),
+                                  lowercase_items=True)[0],
+            ('1', [('d1', 0.0), ('d2', 1.0), ('d1', 1.0)]))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+
+            run_path = os.path.join(tmp_dir, 'run')
+            qrel_path = os.path.join(tmp_dir, 'qrel')
+            trec_eval_path = os.path.join(tmp_dir, 'trec_eval')
+
+            with open(run_path, 'w') as f_run:
+                f_run.write('q1 Q0 d1 1 2.0 r\nq1 Q0 d2 2 1.0 r\n')
+
+            with open(qrel_path, 'w') as f_qrel:
+                f_qrel.write('q1 0 d2 1\nq1 0 d3 0\n')
+
+            with open(trec_eval_path, 'w') as f_trec_eval:
+                f_trec_eval.write('map\tq1\t0.5000\nmap\tall\t0.5000\n'
+                                  'num_q\tall\t1\n')
+
+            for _ in range(2):
+                self.assertEqual(
+                    trec_utils.load_cached_run(
+                        run_path, cache_dir=cache_dir).to_dict(),
+                    {'q1': {'d1': 1.0, 'd2': 2.0}})
+
+                self.assertEqual(
+                    trec_utils.load_cached_qrel(
+                        qrel_path, cache_dir=cache_dir).to_list(),
+                    [('q1', [('d2', 1.0), ('d3', 0.0)])])
+
+                self.assertEqual(
+                    trec_utils.load_cached_trec_eval(
+                        trec_eval_path, cache_dir=cache_dir),
+                    {'q1': {'map': 0.5}, 'all': {'map': 0.5, 'num_q': 1.0}})
+
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+            # Modifying the file invalidates its cache entry.
+            with open(run_path, 'a') as f_run:
+                f_run.write('q2 Q0 d1 1 1.0 r\n')
+
+            self.assertEqual(
+                list(trec_utils.load_cached_run(run_path,
+                                                cache_dir=cache_dir)),
+                ['q1', 'q2'])
+
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_cache_rebuild_while_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            run_path = os.path.join(tmp_dir, 'run')
+
+            with open(run_path, 'w') as f_run:
+                f_run.write('q1 Q0 d1 1 2.0 r\nq1 Q0 d2 2 1.0 r\n')
+
+            mapped_run = trec_utils.load_cached_run(
+                run_path, cache_dir=cache_dir, mmap=True)
+            expected = mapped_run.to_dict()
+
+            # Rebuilding the entry must not invalidate the memory-mapped
+            # arrays of the previous entry.
+            with open(run_path, 'a') as f_run:
+                f_run.write('q2 Q0 d3 1 3.0 r\n')
+
+            rebuilt_run = trec_utils.load_cached_run(
+                run_path, cache_dir=cache_dir, mmap=True)
+
+            self.assertEqual(mapped_run.to_dict(), expected)
+            self.assertEqual(list(rebuilt_run), ['q1', 'q2'])
+
+            # Only the rebuilt entry remains.
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            self.assertEqual(
+                trec_utils.load_cached_run(
+                    run_path, cache_dir=cache_dir).to_dict(),
+                rebuilt_run.to_dict())
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,8 +2,8 @@ import bs4
 import codecs
 import collections
 import gzip
-import itertools
 import io
+import locale
 import logging
 import multiprocessing
 import numpy as np
@@ -29,12 +29,18 @@ def open(filename, mode, encoding='ascii'):
         assert encoding is None
 
     if filename.endswith('.gz'):
-        assert 'w' not in mode
+        if 't' in mode:
+            mode = mode.replace('t', '')
+
+        zf = gzip.open(filename, mode if 'b' in mode else mode + 'b')
 
-        zf = gzip.open(filename, mode)
-        reader = codecs.getreader(encoding)
+        if 'b' in mode:
+            return zf
 
-        return reader(zf)
+        if 'r' in mode:
+            return codecs.getreader(encoding)(zf)
+        else:
+            return codecs.getwriter(encoding)(zf)
     elif filename.endswith('.z'):
         assert 'w' not in mode
 
@@ -138,73 +144,193 @@ class Vocabulary(object):
 def tokenize_text(text, ignore_words=set()):
     assert(isinstance(text, str) or isinstance(text, bytes))
 
-    return tuple(
-        token_stream(
-            lowercased_stream(
-                filter_non_latin_stream(
-                    filter_non_alphanumeric_stream(
-                        unicode_normalize_stream(
-                            iter(text))))),
-            eos_chars=[], ignore_words=ignore_words))
+    return Tokenizer(eos_chars=[], ignore_words=ignore_words)(text)
 
 
 def filter_non_ascii(data):
     return str(''.join(char for char in data if ord(char) < 128))
 
 
-def character_stream(file_stream, limit=None, encoding='latin1'):
+_CHARACTER_BLOCK_SIZE = 1 << 20
+
+
+def _log_and_replace_decoding_error(error):
+    logging.error('Encountered UnicodeDecodeError for parsing characters '
+                  '%r.', error.object[error.start:error.end])
+
+    return '\ufffd', error.end
+
+codecs.register_error(
+    'cvangysel.log_and_replace', _log_and_replace_decoding_error)
+
+
+def character_block_stream(file_stream, limit=None, encoding='latin1',
+                           block_size=_CHARACTER_BLOCK_SIZE):
+    """
+    Block-wise equivalent of character_stream; yields strings rather than
+    single characters.
+
+    The file is read in blocks of block_size bytes from its current
+    position onwards, until the byte offset limit (or the end of the file)
+    is reached. A multi-byte character that straddles limit is read in
+    full.
+
+    Text streams are decoded using their own encoding (with universal
+    newlines) by reading from their underlying buffer; their tell() must
+    therefore be a byte offset, which only holds for stateless codecs
+    (e.g., ASCII, Latin-1 or UTF-8). Once the generator is exhausted or
+    closed, text streams are positioned where reading stopped. Binary
+    streams are decoded using encoding; undecodable bytes are logged and
+    replaced by U+FFFD.
+    """
+    assert block_size > 0
+
     file_size = os.fstat(file_stream.fileno()).st_size
 
     if limit is not None:
-        file_size = min(file_size, limit)
+        end_position = min(file_size, limit)
+    else:
+        end_position = file_size
 
-    while file_stream.tell() < file_size:
-        try:
-            char = file_stream.read(1)
-        except UnicodeDecodeError as e:
-            logging.warning(e)
+    position = file_stream.tell()
 
-        if not char:
-            logging.error('Encountered exhausted file stream before EOF.')
+    is_text_stream = isinstance(file_stream, io.TextIOBase)
 
-            break
+    if is_text_stream:
+        byte_stream = file_stream.buffer
+        byte_stream.seek(position)
 
-        if isinstance(char, bytes):
-            try:
-                char = char.decode(encoding)
-            except UnicodeDecodeError:
-                logging.error('Encountered UnicodeDecodeError for '
-                              'parsing character "%d".', ord(char))
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(file_stream.encoding)(
+                file_stream.errors),
+            translate=True)
+    else:
+        byte_stream = file_stream
+
+        decoder = codecs.getincrementaldecoder(encoding)(
+            'cvangysel.log_and_replace')
 
-        # Introduce white space before certain characters, such that
+    def _pad(text):
+        # Introduce white space around certain characters, such that
         # tokenisation is done properly later down the line.
-        if char in ('<',):
-            yield ' '
+        return text.replace('<', ' <').replace('>', '> ')
 
-        yield char
+    try:
+        while position < end_position:
+            data = byte_stream.read(min(block_size, end_position - position))
 
-        # Introduce white space after certain characters; see above.
-        if char in ('>',):
-            yield ' '
+            if not data:
+                logging.error('Encountered exhausted file stream before EOF.')
 
+                break
 
-def filter_non_latin_stream(character_stream):
-    latin_letters_cache = {}
+            position += len(data)
+
+            text = decoder.decode(data)
+
+            if text:
+                yield _pad(text)
+
+        # Finish the character that straddles the limit, if any.
+        while decoder.getstate()[0] and position < file_size:
+            data = byte_stream.read(1)
+
+            if not data:
+                break
+
+            position += len(data)
+
+            text = decoder.decode(data)
+
+            if text:
+                yield _pad(text)
+
+        text = decoder.decode(b'', final=True)
+
+        if text:
+            yield _pad(text)
+    finally:
+        # Reading from the underlying buffer bypasses the read-ahead and
+        # decoder state of the text stream; seeking resets both.
+        if is_text_stream and not file_stream.closed:
+            file_stream.seek(position)
+
+
+def character_stream(file_stream, limit=None, encoding='latin1'):
+    for text in character_block_stream(
+            file_stream, limit=limit, encoding=encoding):
+        yield from text
+
+
+# Classification of every code point as used by filter_non_latin_stream and
+# filter_non_alphanumeric_stream. The table is filled lazily, one block of
+# code points at a time, and shared by all callers within a process (and
+# processes forked from it).
+_LATIN_CHARACTER = 1
+_ALPHANUMERIC_CHARACTER = 2
+
+_CHARACTER_BLOCK_BITS = 8
+
+_character_classes = bytearray(sys.maxunicode + 1)
+_classified_character_blocks = bytearray(
+    (sys.maxunicode >> _CHARACTER_BLOCK_BITS) + 1)
+
+
+def _classify_character_block(block):
+    start = block << _CHARACTER_BLOCK_BITS
+    end = min(start + (1 << _CHARACTER_BLOCK_BITS), sys.maxunicode + 1)
+
+    for codepoint in range(start, end):
+        character = chr(codepoint)
 
-    def _filter_non_latin(character):
         if character.isspace():
-            return True
+            _character_classes[codepoint] = \
+                _LATIN_CHARACTER | _ALPHANUMERIC_CHARACTER
+
+            continue
+
+        character_class = 0
+
+        # Code points without a name (e.g., control characters or
+        # unassigned code points) are not Latin.
+        character_name = unicodedata.name(character, '')
+
+        if 'LATIN' in character_name or 'SIGN' in character_name:
+            character_class |= _LATIN_CHARACTER
+
+        if character.isalnum() or character in ('<', '/', '>'):
+            character_class |= _ALPHANUMERIC_CHARACTER
+
+        _character_classes[codepoint] = character_class
 
-        if character not in latin_letters_cache:
-            character_name = unicodedata.name(character)
+    _classified_character_blocks[block] = 1
 
-            latin_letters_cache[character] = \
-                'LATIN' in character_name or \
-                'SIGN' in character_name
 
-        return latin_letters_cache[character]
+def _character_class(character):
+    codepoint = ord(character)
+    block = codepoint >> _CHARACTER_BLOCK_BITS
 
-    return filter(_filter_non_latin, character_stream)
+    if not _classified_character_blocks[block]:
+        _classify_character_block(block)
+
+    return _character_classes[codepoint]
+
+
+def _filter_character_class(character_stream, character_class):
+    # Inlined version of _character_class, as this is called for every
+    # character; a code point of an unclassified block has class zero.
+    for character in character_stream:
+        codepoint = ord(character)
+
+        if _character_classes[codepoint] & character_class or (
+                not _classified_character_blocks[
+                    codepoint >> _CHARACTER_BLOCK_BITS] and
+                _character_class(character) & character_class):
+            yield character
+
+
+def filter_non_latin_stream(character_stream):
+    return _filter_character_class(character_stream, _LATIN_CHARACTER)
 
 
 def unicode_normalize_stream(character_stream):
@@ -215,12 +341,8 @@ def unicode_normalize_stream(character_stream):
 
 
 def filter_non_alphanumeric_stream(character_stream):
-    allowed_chars = set(['<', '/', '>'])
-
-    return filter(
-        lambda char: (
-            char.isalnum() or char.isspace() or char in allowed_chars),
-        character_stream)
+    return _filter_character_class(
+        character_stream, _ALPHANUMERIC_CHARACTER)
 
 
 def token_stream(unicode_stream, delimiters=(' ', '\t', '\n', '\r'),
@@ -267,6 +389,127 @@ def lowercased_stream(iterable):
     return (s.lower() for s in iterable)
 
 
+# Maps code points to the characters they become after
+# unicode_normalize_stream, filter_non_alphanumeric_stream,
+# filter_non_latin_stream and lowercased_stream (None if they are removed);
+# filled lazily by _update_token_translation_table.
+_token_translation_table = {}
+
+
+def _update_token_translation_table(text):
+    for character in set(text):
+        if ord(character) in _token_translation_table:
+            continue
+
+        translated = ''.join(
+            normalized_character.lower()
+            for normalized_character in unicodedata.normalize(
+                'NFKC', character)
+            if _character_class(normalized_character) ==
+            _LATIN_CHARACTER | _ALPHANUMERIC_CHARACTER)
+
+        _token_translation_table[ord(character)] = translated or None
+
+
+class Tokenizer(object):
+
+    """
+    Fast equivalent of
+
+        token_stream(
+            lowercased_stream(
+                filter_non_latin_stream(
+                    filter_non_alphanumeric_stream(
+                        unicode_normalize_stream(iter(text))))),
+            delimiters, eos_chars, eos_token, ignore_words)
+
+    that returns a tuple of tokens.
+
+    As all of the character-level steps operate on single characters, they
+    are applied at once using str.translate with a table that is extended
+    with every character not seen before. Tokens are then extracted using a
+    single regular expression.
+    """
+
+    def __init__(self, delimiters=(' ', '\t', '\n', '\r'),
+                 eos_chars=['\n', '\r'], eos_token='</s>',
+                 ignore_words=[]):
+        self.delimiters = set(delimiters)
+        self.eos_chars = set(eos_chars)
+        self.eos_token = eos_token
+
+        self.ignore_words = set(ignore_words)
+
+        separators = ''.join(sorted(self.delimiters | self.eos_chars))
+
+        if self.eos_chars:
+            self.token_re = re.compile('[{}]|[^{}]+'.format(
+                re.escape(''.join(sorted(self.eos_chars))),
+                re.escape(separators)))
+        else:
+            self.token_re = re.compile('[^{}]+'.format(
+                re.escape(separators)))
+
+    def _tokens(self, text):
+        tokens = self.token_re.findall(text)
+
+        if self.ignore_words:
+            tokens = [token for token in tokens
+                      if token not in self.ignore_words or
+                      token in self.eos_chars]
+
+        if self.eos_chars:
+            # Every end-of-sentence character becomes an end-of-sentence
+            # token.
+            tokens = [
+                self.eos_token if token in self.eos_chars else token
+                for token in tokens]
+
+        return tokens
+
+    def iter_tokens(self, text_stream):
+        """
+        Tokenizes the concatenation of the strings in text_stream, without
+        keeping more than one string (and a partial token) in memory.
+        """
+        separators = self.delimiters | self.eos_chars
+
+        remainder = ''
+        last_character = None
+
+        for text in text_stream:
+            if not text:
+                continue
+
+            _update_token_translation_table(text)
+
+            text = remainder + text.translate(_token_translation_table)
+
+            if not text:
+                continue
+
+            last_character = text[-1]
+
+            # The trailing token may continue in the next string.
+            end = max((text.rfind(separator) for separator in separators),
+                      default=-1) + 1
+
+            yield from self._tokens(text[:end])
+
+            remainder = text[end:]
+
+        yield from self._tokens(remainder)
+
+        # The end of text becomes an end-of-sentence token if it ends
+        # within a token.
+        if self.eos_chars and last_character is not None and \
+                last_character not in separators:
+            yield self.eos_token
+
+    def __call__(self, text):
+        return tuple(self.iter_tokens((text,)))
+
+
 def translated_token_stream(iterable, words):
     for word in iterable:
         if word in words:
@@ -410,15 +653,111 @@ def downsample_tokens_stream(iterable,
         callback(num_tokens, num_discarded_tokens)
 
 
+_VOCABULARY_CHUNK_SIZE = 1 << 26
+
+_CHUNK_BOUNDARY_CHARACTERS = ' \t\n'
+_CHUNK_BOUNDARY_RE = re.compile(b'[ \t\n]')
+
+
+def _find_chunk_boundary(f, position, file_size, block_size=1 << 16):
+    """
+    Returns the byte offset just after the first space, tab or newline
+    at or after position, or file_size if there is none.
+    """
+    f.seek(position)
+
+    while position < file_size:
+        data = f.read(block_size)
+
+        if not data:
+            break
+
+        match = _CHUNK_BOUNDARY_RE.search(data)
+
+        if match:
+            return position + match.end()
+
+        position += len(data)
+
+    return file_size
+
+
+def _chunk_file(filename, encoding, chunk_size):
+    """
+    Splits filename in byte ranges of roughly chunk_size bytes.
+
+    Ranges end just after a space, tab or newline, such that no token (or
+    multi-byte character) is split. This is only safe for encodings that
+    encode these characters as their single ASCII byte (and never use
+    those bytes otherwise, e.g., ASCII, Latin-1 and UTF-8); files in other
+    encodings are not split.
+    """
+    assert chunk_size > 0
+
+    file_size = os.path.getsize(filename)
+
+    if file_size <= chunk_size:
+        return [(0, file_size)]
+
+    if encoding is None:
+        # Mirrors the default of open in text mode.
+        encoding = locale.getpreferredencoding(False)
+
+    if _CHUNK_BOUNDARY_CHARACTERS.encode(encoding) != \
+            _CHUNK_BOUNDARY_CHARACTERS.encode('ascii'):
+        logging.warning('Unable to split %s in chunks as encoding %s '
+                        'is not ASCII-compatible.', filename, encoding)
+
+        return [(0, file_size)]
+
+    chunks = []
+
+    with __python_open(filename, 'rb') as f:
+        start_position = 0
+
+        while start_position < file_size:
+            end_position = _find_chunk_boundary(
+                f, start_position + chunk_size, file_size)
+
+            chunks.append((start_position, end_position))
+
+            start_position = end_position
+
+    return chunks
+
+
+def _prune_word_counts(word_counts, max_words):
+    """
+    Misra-Gries reduction: subtracts the (max_words + 1)-th largest count
+    from all counts and drops the words whose count is no longer positive,
+    such that at most max_words words remain.
+    """
+    assert max_words > 0
+
+    if len(word_counts) <= max_words:
+        return word_counts
+
+    counts = np.fromiter(word_counts.values(),
+                         dtype=np.int64, count=len(word_counts))
+
+    # Converted to int, such that counts do not become NumPy scalars.
+    threshold = int(np.partition(
+        counts, len(counts) - max_words - 1)[len(counts) - max_words - 1])
+
+    pruned_word_counts = collections.defaultdict(int)
+
+    for word, count in word_counts.items():
+        if count > threshold:
+            pruned_word_counts[word] = count - threshold
+
+    return pruned_word_counts
+
+
 class VocabularyExtractFn(object, metaclass=multiprocessing_utils.WorkerMetaclass):
 
     @staticmethod
     def worker(payload):
-        filename, idx, num_chunks, params = payload
-
-        if params['encoding'] != 'ascii' and num_chunks != 1:
-            raise NotImplementedError('We do not yet support chunking files '
-                                      'if multi-byte encoding are used.')
+        filename, start_position, end_position, params = payload
 
         numerical_placeholder_token = (
             params['numerical_placeholder_token']
@@ -427,38 +766,22 @@ class VocabularyExtractFn(object, metaclass=multiprocessing_utils.WorkerMetaclas
         min_word_size = (
             params['min_word_size'] if 'min_word_size' in params else 0)
 
-        logging.debug('I am worker with id %d (total=%d) reading %s.',
-                      idx, num_chunks, filename)
-
-        # idx should be zero-indexed.
-        assert idx < num_chunks
-
-        f = open(filename, 'r', encoding=params.get('encoding', None))
-        file_size = os.fstat(f.fileno()).st_size
-
-        chunk_size = file_size // num_chunks
+        ignore_tokens = params.get('ignore_tokens', ())
+        max_candidate_words = params.get('max_candidate_words', None)
 
-        start_position = idx * chunk_size
+        assert start_position <= end_position
 
-        if idx == (num_chunks - 1):
-            end_position = file_size
-        else:
-            end_position = (idx + 1) * chunk_size
+        logging.debug('[%s] Reading from %d to %d.',
+                      filename, start_position, end_position)
 
-        logging.debug('[%s:%d] Reading from %d to %d (file size=%d).',
-                      filename, idx, start_position, end_position, file_size)
+        f = open(filename, 'r', encoding=params.get('encoding', None))
 
         # Set file marker.
         f.seek(start_position)
 
-        # Read current batch of characters.
-        char_stream = character_stream(f, limit=end_position)
-
-        word_stream = token_stream(lowercased_stream(
-            filter_non_latin_stream(
-                filter_non_alphanumeric_stream(
-                    unicode_normalize_stream(
-                        itertools.chain(*char_stream))))))
+        # Tokenize the current batch of characters block by block.
+        word_stream = Tokenizer().iter_tokens(
+            character_block_stream(f, limit=end_position))
 
         # Count words.
         word_counts = collections.defaultdict(int)
@@ -471,12 +794,27 @@ class VocabularyExtractFn(object, metaclass=multiprocessing_utils.WorkerMetaclas
             if numerical_placeholder_token and word.isdigit():
                 word = numerical_placeholder_token
 
+            if word in ignore_tokens:
+                continue
+
             word_counts[word] += 1
             num_words += 1
 
+            # Pruning only once the number of counters doubled keeps its
+            # amortized cost constant.
+            if max_candidate_words and \
+                    len(word_counts) > 2 * max_candidate_words:
+                word_counts = _prune_word_counts(
+                    word_counts, max_candidate_words)
+
         f.close()
 
-        logging.debug('[%s:%d] Done.', filename, idx)
+        if max_candidate_words:
+            word_counts = _prune_word_counts(
+                word_counts, max_candidate_words)
+
+        logging.debug('[%s] Done reading from %d to %d.',
+                      filename, start_position, end_position)
 
         return num_words, word_counts
 
@@ -485,29 +823,44 @@ def extract_vocabulary(filenames, encoding,
                        min_count=-1, max_vocab_size=-1, min_word_size=1,
                        eos_token='</s>', numerical_placeholder_token='<num>',
                        ignore_tokens=(),
-                       num_workers=1):
+                       num_workers=1, chunk_size=_VOCABULARY_CHUNK_SIZE,
+                       max_candidate_words=None):
+    """
+    Files are processed in chunks of roughly chunk_size bytes (see
+    _chunk_file), such that large files are spread over all workers.
+
+    If max_candidate_words is set, words are counted approximately using
+    Misra-Gries summaries of at most 2 * max_candidate_words counters (per
+    worker and in the aggregation), rather than keeping exact counts of all
+    words. For a corpus of N words, every count is then underestimated by
+    at most N / (max_candidate_words + 1), and every word that occurs more
+    often than that is retained.
+    """
+    assert max_candidate_words is None or max_candidate_words > 0
+
     ignore_tokens = set(ignore_tokens)
 
     logging.info('Extracting vocabulary from %d corpora using %d worker(s).',
                  len(filenames), num_workers)
 
-    # Quick-fix to avoid problems down the line.
-    num_workers = min(num_workers, len(filenames))
-
-    num_chunks = max(num_workers // len(filenames), 1)
-
     params = {
         'numerical_placeholder_token': numerical_placeholder_token,
         'min_word_size': min_word_size,
         'encoding': encoding,
+        'ignore_tokens': ignore_tokens,
+        'max_candidate_words': max_candidate_words,
     }
 
-    payloads = [(filename, idx, num_chunks, params)
+    payloads = [(filename, start_position, end_position, params)
                 for filename in filenames
-                for idx in range(num_chunks)]
+                for start_position, end_position in _chunk_file(
+                    filename, encoding, chunk_size)]
 
     logging.debug('Multiprocessing payloads: %s.', payloads)
 
+    # Quick-fix to avoid problems down the line.
+    num_workers = max(min(num_workers, len(payloads)), 1)
+
     def _aggregate_results(results):
         # Aggregate words.
         word_counts = collections.defaultdict(int)
@@ -528,7 +881,17 @@ def extract_vocabulary(filenames, encoding,
                     continue
 
                 word_counts[word] += count
-                num_words += count
+
+            num_words += chunk_num_words
+
+            if max_candidate_words and \
+                    len(word_counts) > 2 * max_candidate_words:
+                word_counts = _prune_word_counts(
+                    word_counts, max_candidate_words)
+
+        if max_candidate_words:
+            word_counts = _prune_word_counts(
+                word_counts, max_candidate_words)
 
         return num_words, word_counts
 
@@ -536,10 +899,13 @@ def extract_vocabulary(filenames, encoding,
     num_words, word_counts = _aggregate_results(
         vocabulary_extract_fn(payloads))
 
+    if vocabulary_extract_fn.pool is not None:
+        vocabulary_extract_fn.pool.close()
+        vocabulary_extract_fn.pool.join()
+
     del vocabulary_extract_fn
 
-    word_counts = [(word, count) for word, count in word_counts.items()
-                   if word not in ignore_tokens]
+    word_counts = list(word_counts.items())
 
     num_unique_words = len(word_counts)
 
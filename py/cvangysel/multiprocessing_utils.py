@@ -104,70 +104,248 @@ class WorkerMetaclass(type):
         return clazz
 
 
+class EndOfTask(object):
+
+    """
+        Sentinel that workers put on a result queue once they have finished
+        a task; see QueueIterator.
+    """
+
+    def __repr__(self):
+        return '<EndOfTask>'
+
+END_OF_TASK = EndOfTask()
+
+
 class QueueIterator(object):
 
-    def __init__(self, pool, result_object, queue):
+    """
+        Iterator over the results that pool workers put on a queue.
+
+        Every task is expected to put END_OF_TASK on the queue when it
+        finishes (also when it fails), such that the iterator knows when all
+        results have been consumed. The iterator blocks on the queue while
+        waiting and periodically checks whether any of the workers failed.
+
+        If num_tasks is None, the original protocol is used instead: tasks
+        do not put END_OF_TASK on the queue, but return the number of results
+        they put on it, and iteration ends once all tasks returned and all of
+        their results were consumed.
+
+        Workers should regularly check stop_event and return early once it is
+        set. This allows the iterator to shut down the pool gracefully when
+        the consumer stops early; otherwise the pool is terminated. The pool
+        is terminated as well if workers do not report back within
+        max_close_polls polls of timeout seconds after stop_event was set
+        (e.g., because a worker process was killed).
+
+        Iteration raises a RuntimeError when a worker process of the pool
+        dies while its task is running, as its task never finishes.
+
+        Usage:
+            stop_event = multiprocessing.Event()
+
+            worker_result = pool.map_async(worker_fn, tasks)
+            pool.close()
+
+            it = multiprocessing_utils.QueueIterator(
+                pool, worker_result, result_queue, num_tasks=len(tasks),
+                stop_event=stop_event)
+
+            try:
+                for result in it:
+                    ...
+            finally:
+                it.close()
+    """
+
+    def __init__(self, pool, result_object, queue, num_tasks=None,
+                 stop_event=None, timeout=1.0, max_close_polls=10):
+        assert num_tasks is None or num_tasks >= 0
+        assert timeout > 0.0
+        assert max_close_polls > 0
+
         self.pool = pool
         self.result_object = result_object
         self.queue = queue
 
-        self.finished = False
+        self.num_tasks = num_tasks
+        self.stop_event = stop_event
+        self.timeout = timeout
+        self.max_close_polls = max_close_polls
 
+        self.num_finished_tasks = 0
         self.count = 0
 
-    def __next__(self):
+        # The pool replaces workers that exit; hence, keep track of all
+        # worker processes seen so far.
+        self.workers = set()
+        self._update_workers()
+
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def _all_tasks_finished(self):
+        if self.num_tasks is None:
+            return self.result_object.ready()
+
+        return self.num_finished_tasks >= self.num_tasks
+
+    def _all_results_received(self):
+        # Only used for the original protocol (i.e., num_tasks is None), where
+        # tasks return the number of results they put on the queue.
+        worker_results = self.result_object.get()
+
+        if not all(isinstance(result, int) for result in worker_results):
+            return True
+
+        expected_number_items = sum(worker_results)
+
+        if self.count > expected_number_items:
+            logging.error('Received more objects than expected.')
+
+            raise RuntimeError()
+
+        return self.count == expected_number_items
+
+    def _update_workers(self):
+        self.workers.update(getattr(self.pool, '_pool', ()))
+
+    def _dead_workers(self):
+        return [worker for worker in self.workers
+                if worker.exitcode not in (None, 0)]
+
+    def _get(self):
         while True:
-            if self.result_object.ready() and not self.finished:
-                logging.debug('All workers finished.')
+            self._update_workers()
+
+            try:
+                result = self.queue.get(block=True, timeout=self.timeout)
+            except queue.Empty:
+                if self.result_object.ready() and \
+                        not self.result_object.successful():
+                    logging.error('Worker failed; shutting down pool.')
 
-                assert self.result_object.successful()
+                    self.close()
 
-                worker_results = self.result_object.get()
-                logging.debug('Retrieved results from workers: %s',
-                              worker_results)
+                    # Re-raises the exception that occurred in the worker.
+                    self.result_object.get()
 
-                if all(isinstance(result, int) for result in worker_results):
-                    self.expected_number_items = sum(worker_results)
+                if not self.result_object.ready() and self._dead_workers():
+                    logging.error('Worker died (exit codes %s); '
+                                  'shutting down pool.',
+                                  [worker.exitcode
+                                   for worker in self._dead_workers()])
 
-                self.finished = True
+                    self.close()
 
-            queue_finished = self.queue.empty()
+                    raise RuntimeError('Worker process died.')
 
-            # Safe-guarding code.
-            if queue_finished and hasattr(self, 'expected_number_items'):
-                logging.debug('Expected %d items; encountered %d.',
-                              self.expected_number_items, self.count)
+                if self.num_tasks is None and \
+                        self.result_object.ready() and \
+                        self._all_results_received():
+                    return END_OF_TASK
 
-                if self.count > self.expected_number_items:
-                    logging.error('Received more objects than expected.')
+                continue
 
-                    raise RuntimeError()
+            if isinstance(result, EndOfTask):
+                self.num_finished_tasks += 1
 
-                queue_finished = (
-                    queue_finished and
-                    self.expected_number_items == self.count)
+            return result
 
-            if self.finished and queue_finished:
-                logging.debug('Queue is empty.')
+    def __next__(self):
+        while not self.closed and (
+                self.num_tasks is None or
+                self.num_finished_tasks < self.num_tasks):
+            result = self._get()
 
-                self.pool.terminate()
-                logging.debug('Pool terminated.')
+            if isinstance(result, EndOfTask):
+                if self.num_tasks is None:
+                    break
 
-                self.pool.join()
-                logging.debug('Joined process pool thread.')
+                continue
 
-                self.queue.close()
-                logging.debug('Result queue closed.')
+            self.count += 1
 
-                self.queue.join_thread()
-                logging.debug('Joined result queue thread.')
+            return result
 
-                raise StopIteration()
+        if not self.closed:
+            logging.debug('All tasks finished (%d results).', self.count)
 
+            # Wait for the pool to report back, such that exceptions raised
+            # after the sentinel was sent are propagated.
             try:
-                result = self.queue.get(block=False)
-                self.count += 1
+                worker_results = self.result_object.get()
+            finally:
+                self.close()
 
-                return result
-            except queue.Empty:
-                continue
+            logging.debug('Retrieved results from workers: %s',
+                          worker_results)
+
+        raise StopIteration()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        # Terminating workers that are still busy may leave the pool in an
+        # inconsistent state; only do so if we cannot ask them to stop.
+        terminate = not self._all_tasks_finished() and (
+            self.stop_event is None or bool(self._dead_workers()))
+
+        if not terminate:
+            if self.stop_event is not None:
+                self.stop_event.set()
+
+            num_empty_polls = 0
+
+            # Keep draining the queue, such that workers blocked on a full
+            # queue are able to finish their task.
+            while not self._all_tasks_finished():
+                try:
+                    result = self.queue.get(block=True, timeout=self.timeout)
+                except queue.Empty:
+                    num_empty_polls += 1
+
+                    if self._all_tasks_finished():
+                        break
+
+                    # Workers that died (or finished without reporting back)
+                    # never send their sentinel.
+                    if self.result_object.ready() or \
+                            num_empty_polls >= self.max_close_polls:
+                        logging.warning(
+                            'Not all tasks reported back (%d finished).',
+                            self.num_finished_tasks)
+
+                        terminate = True
+
+                        break
+
+                    continue
+
+                num_empty_polls = 0
+
+                if isinstance(result, EndOfTask):
+                    self.num_finished_tasks += 1
+
+        if terminate:
+            self.pool.terminate()
+            logging.debug('Pool terminated.')
+        else:
+            logging.debug('All workers stopped.')
+
+            self.pool.close()
+
+        self.pool.join()
+        logging.debug('Joined process pool thread.')
+
+        self.queue.close()
+        logging.debug('Result queue closed.')
+
+        self.queue.join_thread()
+        logging.debug('Joined result queue thread.')
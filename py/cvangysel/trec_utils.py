@@ -1,14 +1,21 @@
 from cvangysel import io_utils, multiprocessing_utils
 
+import codecs
 import collections
+import collections.abc
+import gzip
+import hashlib
+import heapq
 import io
 import itertools
 import logging
 import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import os
 import tempfile
 import re
+import scipy.sparse
 import scipy.stats
 import shutil
 import subprocess
@@ -128,55 +135,621 @@ def _parse_trectext(iter, ignore_content=False):
             process_content(line)
 
 
-def _iter_trectext_document_ids_worker(data):
+# Characters for which str.isspace() holds within the ASCII range; used to
+# mimic str.strip() on raw bytes.
+_TRECTEXT_WHITESPACE = bytes(
+    char for char in range(128) if chr(char).isspace())
+
+_TRECTEXT_NEWLINES = (b'\n', b'\r')
+
+_TRECTEXT_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def _is_ascii_compatible_encoding(encoding):
+    """
+    Returns True if every byte below 0x80 decodes to the same ASCII character
+    and no byte above it ever contributes to an ASCII character.
+    """
+    name = codecs.lookup(encoding).name
+
+    return name in ('ascii', 'utf-8') or name.startswith(
+        ('iso8859-', 'cp125', 'koi8-', 'mac-'))
+
+
+def _check_byte_level_encoding(encoding):
+    if not _is_ascii_compatible_encoding(encoding):
+        raise NotImplementedError(
+            'Byte-level parsing is only supported for '
+            'ASCII-compatible encodings.')
+
+
+def _find_trectext_line(data, marker, start=0, end=None):
+    """
+    Returns the offset of the first line in data[start:end] that consists of
+    marker only, or -1 if there is no such line.
+    """
+    if end is None:
+        end = len(data)
+
+    pos = data.find(marker, start, end)
+
+    while pos >= 0:
+        after = pos + len(marker)
+
+        if (pos == 0 or data[pos - 1:pos] in _TRECTEXT_NEWLINES) and \
+                (after == len(data) or
+                 data[after:after + 1] in _TRECTEXT_NEWLINES):
+            return pos
+
+        pos = data.find(marker, pos + 1, end)
+
+    return -1
+
+
+def _find_trectext_end(data, start=0, end=None):
+    """
+    Returns the offset directly after the first </DOC> in data[start:end]
+    that terminates a line, or -1 if there is none.
+    """
+    if end is None:
+        end = len(data)
+
+    pos = data.find(b'</DOC>', start, end)
+
+    while pos >= 0:
+        after = pos + 6
+
+        if after == len(data) or data[after:after + 1] in _TRECTEXT_NEWLINES:
+            return after
+
+        pos = data.find(b'</DOC>', pos + 1, end)
+
+    return -1
+
+
+def _iter_trectext_spans(data, start=0, end=None):
+    """
+    Yields (begin, end) byte offsets of every <DOC>...</DOC> block that
+    starts within data[start:end].
+    """
+    if end is None:
+        end = len(data)
+
+    pos = start
+
+    while True:
+        doc_start = _find_trectext_line(data, b'<DOC>', pos, end)
+
+        if doc_start < 0:
+            break
+
+        doc_end = _find_trectext_end(data, doc_start + 5)
+
+        if doc_end < 0:
+            logging.error('Encountered unterminated document at offset %d.',
+                          doc_start)
+
+            break
+
+        yield doc_start, doc_end
+
+        pos = doc_end
+
+
+def _decode_trectext_line(line, encoding):
+    """
+    Equivalent of io_utils.filter_non_ascii(line.decode(encoding).strip()).
+    """
+    if line.isascii():
+        return line.strip(_TRECTEXT_WHITESPACE).decode('ascii')
+    else:
+        return io_utils.filter_non_ascii(line.decode(encoding).strip())
+
+
+def _is_trectext_blank_line(line, encoding):
+    if line.isascii():
+        return not line.strip(_TRECTEXT_WHITESPACE)
+    else:
+        return line.decode(encoding).isspace()
+
+
+def _is_trectext_old_id_line(line):
+    return len(line) >= 21 and \
+        line.startswith(b'<DOCOLDNO>') and line.endswith(b'</DOCOLDNO>')
+
+
+def _parse_trectext_document(doc, encoding, ignore_content=False):
+    """
+    Parses a single <DOC>...</DOC> block given as bytes.
+
+    Returns a (doc_id, content) pair identical to what _parse_trectext yields
+    for the same block when read from a text-mode file.
+    """
+    if b'\r' in doc:
+        # Mimic universal newline handling of text-mode files.
+        doc = doc.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    # The first line is the remainder of the <DOC> line (empty) and the last
+    # line is whatever precedes </DOC> on the final line.
+    lines = doc[5:-6].split(b'\n')
+    num_lines = len(lines) - 1
+
+    doc_id = None
+    idx = 1
+
+    while idx < num_lines:
+        line = lines[idx]
+        idx += 1
+
+        if line.startswith(b'<DOCNO>'):
+            if line == b'<DOCNO>':
+                doc_id = lines[idx]
+                assert lines[idx + 1].strip() == b'</DOCNO>'
+
+                idx += 2
+            elif line.endswith(b'</DOCNO>'):
+                doc_id = line[7:-8]
+            else:
+                logging.error(
+                    'Encountered input before document identifier: %s',
+                    line.decode(encoding))
+
+                continue
+
+            doc_id = doc_id.decode(encoding).strip()
+
+            break
+        elif _is_trectext_blank_line(line, encoding) or \
+                _is_trectext_old_id_line(line):
+            continue
+        else:
+            logging.error(
+                'Encountered input before document identifier: %s',
+                line.decode(encoding))
+
+    if doc_id is None:
+        logging.error('Encountered document without identifier.')
+
+        return None, []
+
+    if ignore_content:
+        return doc_id, []
+
+    # Skip the document header, if present.
+    if b'<DOCHDR>' in doc:
+        hdr_idx = idx
+
+        while hdr_idx < num_lines and (
+                _is_trectext_blank_line(lines[hdr_idx], encoding) or
+                _is_trectext_old_id_line(lines[hdr_idx])):
+            hdr_idx += 1
+
+        if hdr_idx < num_lines and lines[hdr_idx] == b'<DOCHDR>':
+            end_hdr_idx = hdr_idx + 1
+
+            while end_hdr_idx < num_lines and \
+                    lines[end_hdr_idx] != b'</DOCHDR>':
+                end_hdr_idx += 1
+
+            if end_hdr_idx < num_lines:
+                idx = end_hdr_idx + 1
+            else:
+                logging.warning(
+                    'Encountered unterminated document header in %s; '
+                    'keeping header as content.', doc_id)
+
+    body = lines[idx:num_lines]
+
+    if b'<DOCOLDNO>' in doc:
+        body = [line for line in body if not _is_trectext_old_id_line(line)]
+
+    content = []
+
+    for line in body:
+        if line.isascii():
+            line = line.strip(_TRECTEXT_WHITESPACE)
+
+            if line:
+                content.append(line.decode('ascii'))
+        else:
+            line = line.decode(encoding)
+
+            if not line.isspace():
+                content.append(io_utils.filter_non_ascii(line.strip()))
+
+    content.append(_decode_trectext_line(lines[num_lines], encoding))
+
+    return doc_id, content
+
+
+def _peek_trectext_document_id(data, start, end, encoding):
+    """
+    Returns the identifier of the <DOC>...</DOC> block data[start:end], as
+    _parse_trectext_document would, by only inspecting its <DOCNO> line(s).
+
+    Returns None if the identifier cannot be determined this way (i.e., the
+    <DOCNO> line is preceded by lines other than blank or <DOCOLDNO> lines,
+    or the document uses carriage returns within these lines).
+    """
+    pos = data.find(b'<DOCNO>', start + 5, end)
+
+    if pos < 0 or data[pos - 1:pos] != b'\n':
+        return None
+
+    preamble = data[start + 5:pos]
+
+    if preamble.strip(_TRECTEXT_WHITESPACE) and not all(
+            not line.strip(_TRECTEXT_WHITESPACE) or
+            _is_trectext_old_id_line(line.rstrip(b'\r'))
+            for line in preamble.split(b'\n')):
+        return None
+
+    lines = []
+    line_start = pos
+
+    # The <DOCNO> line, followed by the identifier and </DOCNO> lines if
+    # the <DOCNO> line holds only the tag.
+    while len(lines) < 3:
+        line_end = data.find(b'\n', line_start, end)
+
+        if line_end < 0:
+            return None
+
+        line = data[line_start:line_end]
+
+        if line.endswith(b'\r'):
+            line = line[:-1]
+
+        if b'\r' in line:
+            return None
+
+        lines.append(line)
+        line_start = line_end + 1
+
+        if lines[0] != b'<DOCNO>':
+            break
+
+    if lines[0] == b'<DOCNO>':
+        if lines[2].strip() != b'</DOCNO>':
+            return None
+
+        doc_id = lines[1]
+    elif lines[0].endswith(b'</DOCNO>'):
+        doc_id = lines[0][7:-8]
+    else:
+        return None
+
+    return doc_id.decode(encoding).strip()
+
+
+def _skip_trectext_document(data, start, end, encoding, document_filter):
+    """
+    Returns True if the document in data[start:end] is known not to be in
+    document_filter, without parsing it.
+    """
+    doc_id = _peek_trectext_document_id(data, start, end, encoding)
+
+    return doc_id is not None and doc_id not in document_filter
+
+
+def _iter_trectext_blocks(f, block_size=_TRECTEXT_BLOCK_SIZE):
+    """
+    Reads a binary stream in large blocks and yields (offset, data, end)
+    triples such that data[:end] only contains complete documents and data
+    starts at position offset within the stream.
+    """
+    offset = f.tell()
+    remainder = b''
+
+    while True:
+        block = f.read(block_size)
+
+        if not block:
+            if remainder:
+                yield offset, remainder, len(remainder)
+
+            break
+
+        data = remainder + block if remainder else block
+
+        end = max(data.rfind(b'</DOC>\n'), data.rfind(b'</DOC>\r'))
+
+        if end < 0:
+            remainder = data
+
+            continue
+
+        end += 6
+
+        yield offset, data, end
+
+        offset += end
+        remainder = data[end:]
+
+
+def _parse_trectext_bytes(f, encoding, ignore_content=False,
+                          block_size=_TRECTEXT_BLOCK_SIZE,
+                          document_filter=None, stop_event=None):
+    """
+    Regex-free alternative to _parse_trectext that operates on a binary
+    stream. Document boundaries are located using bytes.find and only the
+    identifier and content spans are decoded.
+
+    If document_filter is given, documents whose <DOCNO> line shows that
+    they are not in document_filter are skipped without being parsed. As
+    the consumer does not see skipped documents, iteration stops once
+    stop_event (if given) is set while skipping.
+    """
+    _check_byte_level_encoding(encoding)
+
+    for _, data, end in _iter_trectext_blocks(f, block_size):
+        for doc_start, doc_end in _iter_trectext_spans(data, 0, end):
+            if document_filter is not None and _skip_trectext_document(
+                    data, doc_start, doc_end, encoding, document_filter):
+                if stop_event is not None and stop_event.is_set():
+                    return
+
+                continue
+
+            yield _parse_trectext_document(
+                data[doc_start:doc_end], encoding, ignore_content)
+
+
+TRECTEXT_PARSERS = ('regex', 'bytes')
+
+
+def _iter_trectext_range(f, encoding, start, end=None,
+                         block_size=_TRECTEXT_BLOCK_SIZE,
+                         document_filter=None, stop_event=None):
+    """
+    Yields the raw bytes of every document whose <DOC> line starts within
+    the byte range [start, end) of a binary stream.
+
+    Documents are skipped as in _parse_trectext_bytes if document_filter is
+    given (and stop_event is handled likewise).
+    """
+    # Include the preceding byte, such that we can verify whether a <DOC>
+    # marker at the start of the range starts a line.
+    seek_position = max(start - 1, 0)
+    skip = start - seek_position
+
+    f.seek(seek_position)
+
+    for offset, data, data_end in _iter_trectext_blocks(f, block_size):
+        for doc_start, doc_end in _iter_trectext_spans(data, skip, data_end):
+            if end is not None and offset + doc_start >= end:
+                return
+
+            if document_filter is not None and _skip_trectext_document(
+                    data, doc_start, doc_end, encoding, document_filter):
+                if stop_event is not None and stop_event.is_set():
+                    return
+
+                continue
+
+            yield data[doc_start:doc_end]
+
+        skip = 0
+
+
+def _iter_trectext_file(document_path, encoding, parser='regex',
+                        ignore_content=False, start=0, end=None,
+                        document_filter=None, stop_event=None):
+    """
+    Yields (doc_id, content) pairs for the documents in a TREC text file
+    (or in the byte range [start, end) of it, see _iter_trectext_range).
+
+    If document_filter (a container of identifiers) is given, only the
+    documents in it are yielded. Where possible, other documents are
+    skipped at the byte level as soon as their <DOCNO> line is seen.
+
+    If stop_event is given, iteration stops once it is set while documents
+    are being skipped (the consumer is expected to check it otherwise).
+    """
+    if document_filter is None:
+        yield from _iter_trectext_file_(
+            document_path, encoding, parser, ignore_content, start, end)
+    else:
+        for doc_id, content in _iter_trectext_file_(
+                document_path, encoding, parser, ignore_content, start, end,
+                document_filter, stop_event):
+            if doc_id in document_filter:
+                yield doc_id, content
+            elif stop_event is not None and stop_event.is_set():
+                return
+
+
+def _iter_trectext_file_(document_path, encoding, parser,
+                         ignore_content, start, end, document_filter=None,
+                         stop_event=None):
+    assert parser in TRECTEXT_PARSERS
+
+    # Filtered documents are skipped while scanning the raw bytes, which
+    # requires the byte-level code path.
+    skip_filtered = document_filter is not None and \
+        not document_path.endswith('.z') and \
+        _is_ascii_compatible_encoding(encoding)
+
+    if start == 0 and end is None and not skip_filtered:
+        if parser == 'regex':
+            with io_utils.open(document_path, 'r', encoding=encoding) as f:
+                yield from _parse_trectext(f, ignore_content=ignore_content)
+        elif parser == 'bytes':
+            if document_path.endswith('.z'):
+                raise NotImplementedError(
+                    'Byte-level parsing of packed files is not supported.')
+
+            with io_utils.open(document_path, 'rb', encoding=None) as f:
+                yield from _parse_trectext_bytes(
+                    f, encoding, ignore_content=ignore_content)
+    else:
+        _check_byte_level_encoding(encoding)
+
+        block_size = _TRECTEXT_BLOCK_SIZE
+
+        if end is not None:
+            block_size = min(block_size, max(end - start, 1 << 20))
+
+        with io_utils.open(document_path, 'rb', encoding=None) as f:
+            for doc in _iter_trectext_range(
+                    f, encoding, start, end, block_size=block_size,
+                    document_filter=(
+                        document_filter if skip_filtered else None),
+                    stop_event=stop_event):
+                if parser == 'regex':
+                    yield from _parse_trectext(
+                        io.StringIO(doc.decode(encoding), newline=None),
+                        ignore_content=ignore_content)
+                elif parser == 'bytes':
+                    yield _parse_trectext_document(
+                        doc, encoding, ignore_content)
+
+
+_TRECTEXT_MIN_CHUNK_SIZE = 1 << 20
+_TRECTEXT_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _split_trectext_paths(document_paths, encoding, num_workers,
+                          chunk_size=None):
+    """
+    Splits a collection of TREC text files into (path, start, end) byte
+    ranges. Every document belongs to the range in which its <DOC> line
+    starts, hence ranges need not be aligned to document boundaries.
+
+    Compressed files and files in encodings that do not allow byte-level
+    parsing are not split. If chunk_size is not given, it is chosen such
+    that every worker receives multiple chunks.
+    """
+    file_sizes = [
+        os.path.getsize(path)
+        if not path.endswith(('.gz', '.z')) and
+        _is_ascii_compatible_encoding(encoding) else None
+        for path in document_paths]
+
+    if chunk_size is None:
+        total_size = sum(size for size in file_sizes if size is not None)
+
+        chunk_size = min(max(total_size // (4 * num_workers),
+                             _TRECTEXT_MIN_CHUNK_SIZE),
+                         _TRECTEXT_MAX_CHUNK_SIZE)
+
+    assert chunk_size > 0
+
+    chunks = []
+
+    for path, file_size in zip(document_paths, file_sizes):
+        if file_size is None or file_size <= chunk_size:
+            chunks.append((path, 0, None))
+
+            continue
+
+        num_chunks = (file_size + chunk_size - 1) // chunk_size
+
+        for chunk_idx in range(num_chunks):
+            chunks.append((
+                path,
+                chunk_idx * chunk_size,
+                (chunk_idx + 1) * chunk_size
+                if chunk_idx < num_chunks - 1 else None))
+
+    return chunks
+
+
+def _index_trectext_worker(data):
     document_path, encoding = data
 
-    logging.debug('Iterating over %s.', document_path)
+    logging.debug('Indexing %s.', document_path)
+
+    doc_ids, offsets, lengths = [], [], []
+
+    with io_utils.open(document_path, 'rb', encoding=None) as f:
+        for offset, data, end in _iter_trectext_blocks(f):
+            for doc_start, doc_end in _iter_trectext_spans(data, 0, end):
+                doc_id, _ = _parse_trectext_document(
+                    data[doc_start:doc_end], encoding, ignore_content=True)
+
+                if doc_id is None:
+                    continue
+
+                doc_ids.append(doc_id.encode('utf8'))
+                offsets.append(offset + doc_start)
+                lengths.append(doc_end - doc_start)
+
+    return doc_ids, offsets, lengths
+
+
+def _iter_trectext_document_ids_worker(data):
+    (document_path, start, end), encoding, parser = data
+
+    logging.debug('Iterating over %s (from %d to %s).',
+                  document_path, start, end)
+
+    return [doc_id for doc_id, _ in _iter_trectext_file(
+        document_path, encoding, parser, ignore_content=True,
+        start=start, end=end)]
 
-    with io_utils.open(document_path, 'r', encoding=encoding) as f:
-        return [doc_id for doc_id, _ in _parse_trectext(f)]
+
+# Upper bound on the number of characters (or tokens) within a batch of
+# documents sent by a worker.
+_TRECTEXT_MAX_BATCH_LENGTH = 1 << 20
 
 
 def _iter_trectext_documents_multiprocessing_worker_initializer(
-        result_queue,
+        result_queue, stop_event,
         replace_digits, strip_html, tokenize,
         ignore_words,
         document_ids,
-        encoding):
+        encoding, parser,
+        batch_size):
     _iter_trectext_documents_multiprocessing_worker_.result_queue = \
         result_queue
+    _iter_trectext_documents_multiprocessing_worker_.stop_event = stop_event
 
     _iter_trectext_documents_multiprocessing_worker_.strip_html = strip_html
     _iter_trectext_documents_multiprocessing_worker_.replace_digits = \
         replace_digits
     _iter_trectext_documents_multiprocessing_worker_.tokenize = tokenize
-    _iter_trectext_documents_multiprocessing_worker_.ignore_words = \
-        ignore_words
-    _iter_trectext_documents_multiprocessing_worker_.document_ids = \
-        set(document_ids)
+    _iter_trectext_documents_multiprocessing_worker_.tokenizer = \
+        io_utils.Tokenizer(eos_chars=[], ignore_words=ignore_words)
+    _iter_trectext_documents_multiprocessing_worker_.document_ids = (
+        _IdentifierSet(document_ids) if document_ids is not None else None)
 
     _iter_trectext_documents_multiprocessing_worker_.encoding = encoding
+    _iter_trectext_documents_multiprocessing_worker_.parser = parser
+    _iter_trectext_documents_multiprocessing_worker_.batch_size = batch_size
 
     _iter_trectext_documents_multiprocessing_worker_.digit_regex = \
         re.compile('\d+')
 
 
-def _iter_trectext_documents_multiprocessing_worker_(document_path):
-    logging.debug('Iterating over %s.', document_path)
+def _iter_trectext_documents_multiprocessing_worker_(chunk):
+    document_path, start, end = chunk
+
+    logging.debug('Iterating over %s (from %d to %s).',
+                  document_path, start, end)
 
     num_documents = 0
 
-    with io_utils.open(
-            document_path, 'r',
-            encoding=_iter_trectext_documents_multiprocessing_worker_.
-            encoding) as f:
-        for doc_id, text in _parse_trectext(f):
-            if (_iter_trectext_documents_multiprocessing_worker_.
-                document_ids and
-                    doc_id not in
+    batch = []
+    batch_length = 0
+
+    try:
+        for doc_id, text in _iter_trectext_file(
+                document_path,
+                _iter_trectext_documents_multiprocessing_worker_.encoding,
+                _iter_trectext_documents_multiprocessing_worker_.parser,
+                start=start, end=end,
+                document_filter=(
                     _iter_trectext_documents_multiprocessing_worker_.
-                    document_ids):
-                continue
+                    document_ids),
+                stop_event=(
+                    _iter_trectext_documents_multiprocessing_worker_.
+                    stop_event)):
+            if _iter_trectext_documents_multiprocessing_worker_.\
+                    stop_event.is_set():
+                logging.debug('Stopping early.')
+
+                break
 
             # Concatenate document lines.
             text = ' '.join(text)
@@ -191,19 +764,32 @@ def _iter_trectext_documents_multiprocessing_worker_(document_path):
                     sub('<num>', text))
 
             if _iter_trectext_documents_multiprocessing_worker_.tokenize:
-                tokens = io_utils.tokenize_text(
-                    text,
-                    ignore_words=(
-                        _iter_trectext_documents_multiprocessing_worker_.
-                        ignore_words))
-
-                _iter_trectext_documents_multiprocessing_worker_.\
-                    result_queue.put((doc_id, tokens))
-            else:
+                text = _iter_trectext_documents_multiprocessing_worker_.\
+                    tokenizer(text)
+
+            # Documents are sent in batches, as the per-item overhead of
+            # the queue dominates for short documents.
+            batch.append((doc_id, text))
+            batch_length += len(text)
+
+            if len(batch) >= \
+                    _iter_trectext_documents_multiprocessing_worker_.\
+                    batch_size or \
+                    batch_length >= _TRECTEXT_MAX_BATCH_LENGTH:
                 _iter_trectext_documents_multiprocessing_worker_.\
-                    result_queue.put((doc_id, text))
+                    result_queue.put(batch)
+
+                batch = []
+                batch_length = 0
 
             num_documents += 1
+    finally:
+        if batch:
+            _iter_trectext_documents_multiprocessing_worker_.\
+                result_queue.put(batch)
+
+        _iter_trectext_documents_multiprocessing_worker_.result_queue.put(
+            multiprocessing_utils.END_OF_TASK)
 
     return num_documents
 
@@ -223,37 +809,24 @@ def parse_query(unsplitted_terms):
     unsplitted_terms = unsplitted_terms.replace('/', ' ')
     unsplitted_terms = unsplitted_terms.replace('-', ' ')
 
-    return list(io_utils.token_stream(
-        io_utils.lowercased_stream(
-            io_utils.filter_non_latin_stream(
-                io_utils.filter_non_alphanumeric_stream(
-                    io_utils.unicode_normalize_stream(
-                        iter(unsplitted_terms))))), eos_chars=[]))
+    return list(io_utils.Tokenizer(eos_chars=[])(unsplitted_terms))
 
 
 def parse_qrel(f_qrel, lowercase_items=False):
-    qrel = []
-
-    def key_fn(line):
-        return line.split()[0]
-
-    for topic_id, group in itertools.groupby(
-            sorted(f_qrel, key=key_fn),
-            key=key_fn):
-        relevant_items = []
-
-        for line in group:
-            _, _, item, relevance = line.strip().split()
-            relevance = float(relevance)
-
-            if lowercase_items:
-                item = item.lower()
-
-            relevant_items.append((item, relevance))
+    """
+    Parses TREC relevance judgments into a list of
+    (topic_id, [(item, relevance), ...]) pairs, sorted by topic.
 
-        qrel.append((topic_id, relevant_items))
+    The judgments are parsed in a streaming fashion using ColumnarTRECQrel;
+    use ColumnarTRECQrel.parse directly to keep them in array form.
+    """
+    if not hasattr(f_qrel, 'read'):
+        f_qrel = io.StringIO(''.join(
+            line if line.endswith('\n') else line + '\n'
+            for line in f_qrel))
 
-    return qrel
+    return ColumnarTRECQrel.parse(
+        f_qrel, lowercase_items=lowercase_items).to_list()
 
 
 def parse_trec_topics(f_trec_topics):
@@ -322,25 +895,205 @@ def parse_trec_topics(f_trec_topics):
     return topics
 
 
+class TRECTextIndex(object):
+
+    """
+        Sidecar index that maps document identifiers to their location
+        (path, byte offset, length) within a collection of TREC text files.
+
+        Identifiers are kept in a sorted array, such that lookups are
+        binary searches. Offsets refer to the uncompressed stream; seeking
+        within gzipped files is supported but slow.
+
+        Usage example:
+            index = trec_utils.TRECTextIndex.build(document_paths, 'latin1')
+            index.save('collection_index.npz')
+
+            reader = trec_utils.TRECTextReader(
+                document_paths, 'latin1',
+                index=trec_utils.TRECTextIndex.load('collection_index.npz'))
+
+            for doc_id, text in reader.get_documents(doc_ids):
+                ...
+    """
+
+    def __init__(self, paths, doc_ids, path_indices, offsets, lengths):
+        assert len(doc_ids) == len(path_indices) == \
+            len(offsets) == len(lengths)
+
+        order = np.argsort(doc_ids, kind='stable')
+
+        self.paths = list(paths)
+
+        self.doc_ids = np.asarray(doc_ids)[order]
+        self.path_indices = np.asarray(path_indices, dtype=np.int32)[order]
+        self.offsets = np.asarray(offsets, dtype=np.int64)[order]
+        self.lengths = np.asarray(lengths, dtype=np.int64)[order]
+
+        if len(self.doc_ids) > 1:
+            num_duplicates = np.count_nonzero(
+                self.doc_ids[1:] == self.doc_ids[:-1])
+
+            if num_duplicates:
+                logging.warning('Index contains %d duplicate identifiers; '
+                                'only the first occurrence is retrievable.',
+                                num_duplicates)
+
+    @classmethod
+    def build(cls, document_paths, encoding, num_workers=1):
+        _check_byte_level_encoding(encoding)
+
+        doc_ids, path_indices, offsets, lengths = [], [], [], []
+
+        pool = multiprocessing.Pool(num_workers)
+
+        for path_idx, (path_doc_ids, path_offsets, path_lengths) in \
+                enumerate(pool.imap(
+                    _index_trectext_worker,
+                    [(path, encoding) for path in document_paths])):
+            if (path_idx + 1) % 5 == 0:
+                logging.info('Indexed %d out of %d paths (%.4f%%).',
+                             path_idx + 1, len(document_paths),
+                             100.0 * (path_idx + 1) / len(document_paths))
+
+            doc_ids.extend(path_doc_ids)
+            path_indices.extend([path_idx] * len(path_doc_ids))
+            offsets.extend(path_offsets)
+            lengths.extend(path_lengths)
+
+        pool.close()
+        pool.join()
+
+        return cls(document_paths,
+                   np.array(doc_ids, dtype=np.bytes_),
+                   path_indices, offsets, lengths)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['paths'].tolist(),
+                       data['doc_ids'],
+                       data['path_indices'],
+                       data['offsets'],
+                       data['lengths'])
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     paths=np.array(self.paths, dtype=np.str_),
+                     doc_ids=self.doc_ids,
+                     path_indices=self.path_indices,
+                     offsets=self.offsets,
+                     lengths=self.lengths)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) is not None
+
+    def __getitem__(self, doc_id):
+        idx = self._find(doc_id)
+
+        if idx is None:
+            raise KeyError(doc_id)
+
+        return (self.paths[self.path_indices[idx]],
+                int(self.offsets[idx]),
+                int(self.lengths[idx]))
+
+    def _find(self, doc_id):
+        if isinstance(doc_id, str):
+            doc_id = doc_id.encode('utf8')
+
+        idx = np.searchsorted(self.doc_ids, doc_id)
+
+        if idx < len(self.doc_ids) and self.doc_ids[idx] == doc_id:
+            return idx
+        else:
+            return None
+
+    def locate(self, doc_ids):
+        """
+        Returns (doc_id, path_idx, offset, length) tuples for all given
+        identifiers that occur in the index, ordered by location.
+        """
+        doc_ids = list(doc_ids)
+
+        if not doc_ids or not len(self.doc_ids):
+            return []
+
+        query = np.array([doc_id.encode('utf8') for doc_id in doc_ids],
+                         dtype=np.bytes_)
+
+        indices = np.searchsorted(self.doc_ids, query)
+        indices[indices >= len(self.doc_ids)] = 0
+
+        found = self.doc_ids[indices] == query
+
+        if not np.all(found):
+            logging.warning('%d out of %d documents not found in index.',
+                            np.count_nonzero(~found), len(doc_ids))
+
+        indices = indices[found]
+        doc_ids = [doc_id for doc_id, is_found in zip(doc_ids, found)
+                   if is_found]
+
+        order = np.lexsort((self.offsets[indices],
+                            self.path_indices[indices]))
+
+        return [(doc_ids[i],
+                 int(self.path_indices[indices[i]]),
+                 int(self.offsets[indices[i]]),
+                 int(self.lengths[indices[i]]))
+                for i in order]
+
+
 class TRECTextReader(object):
 
-    def __init__(self, document_paths, encoding):
+    """
+        Reader for collections of TREC text files.
+
+        The parser argument selects the parsing backend: 'regex' (default)
+        parses line-by-line using regular expressions, whereas 'bytes' scans
+        large binary buffers for document boundaries and only decodes the
+        spans it needs. Both backends yield identical documents.
+
+        If a TRECTextIndex is passed (or built using build_index),
+        get_documents fetches individual documents without scanning the
+        collection.
+    """
+
+    def __init__(self, document_paths, encoding, parser='regex', index=None):
+        assert parser in TRECTEXT_PARSERS
+
         self.document_paths = document_paths
         self.encoding = encoding
+        self.parser = parser
+
+        self.index = index
 
-    def iter_document_ids(self, num_workers=1):
+    def build_index(self, num_workers=1):
+        self.index = TRECTextIndex.build(
+            self.document_paths, self.encoding, num_workers=num_workers)
+
+        return self.index
+
+    def iter_document_ids(self, num_workers=1, chunk_size=None):
         document_ids = set()
 
+        chunks = _split_trectext_paths(
+            self.document_paths, self.encoding, num_workers, chunk_size)
+
         pool = multiprocessing.Pool(num_workers)
 
-        for chunk_idx, chunk_document_ids in enumerate(pool.map(
+        for chunk_idx, chunk_document_ids in enumerate(pool.imap_unordered(
                 _iter_trectext_document_ids_worker,
-                [(path, self.encoding) for path in self.document_paths])):
+                [(chunk, self.encoding, self.parser) for chunk in chunks])):
             if (chunk_idx + 1) % 5 == 0:
-                logging.info('Processed %d out of %d paths (%.4f%%).',
-                             chunk_idx + 1, len(self.document_paths),
-                             100.0 * (chunk_idx + 1) / len(
-                                 self.document_paths))
+                logging.info('Processed %d out of %d chunks (%.4f%%).',
+                             chunk_idx + 1, len(chunks),
+                             100.0 * (chunk_idx + 1) / len(chunks))
 
             document_ids.update(set(chunk_document_ids))
 
@@ -352,8 +1105,53 @@ class TRECTextReader(object):
         for document_path in self.document_paths:
             logging.debug('Iterating over %s.', document_path)
 
-            with io_utils.open(document_path, 'r', encoding=self.encoding) as f:
-                for doc_id, text in _parse_trectext(f):
+            for doc_id, text in _iter_trectext_file(
+                    document_path, self.encoding, self.parser):
+                text = ' '.join(text)
+
+                if strip_html:
+                    text = io_utils.strip_html(text)
+
+                if replace_digits:
+                    text = digit_regex.sub('<num>', text)
+
+                yield doc_id, text
+
+    def get_documents(self, doc_ids, replace_digits=True, strip_html=True):
+        """
+        Yields (doc_id, text) pairs for the requested documents by seeking
+        directly to their location. Documents are returned in the order in
+        which they occur in the collection; unknown identifiers are skipped.
+
+        If the reader has no index, one is first built using build_index,
+        which scans the whole collection.
+        """
+        if self.index is None:
+            logging.warning('No index available; scanning %d files to build '
+                            'one. Pass an index to avoid this.',
+                            len(self.document_paths))
+
+            self.build_index()
+
+        _check_byte_level_encoding(self.encoding)
+
+        digit_regex = re.compile('\d+')
+
+        for path_idx, locations in itertools.groupby(
+                self.index.locate(doc_ids), key=lambda location: location[1]):
+            document_path = self.index.paths[path_idx]
+
+            logging.debug('Fetching documents from %s.', document_path)
+
+            with io_utils.open(document_path, 'rb', encoding=None) as f:
+                for doc_id, _, offset, length in locations:
+                    f.seek(offset)
+
+                    parsed_doc_id, text = _parse_trectext_document(
+                        f.read(length), self.encoding)
+
+                    assert parsed_doc_id == doc_id, (parsed_doc_id, doc_id)
+
                     text = ' '.join(text)
 
                     if strip_html:
@@ -370,58 +1168,158 @@ class TRECTextReader(object):
     def iter_document_multiprocessing(self, num_workers=1,
                                       replace_digits=True, strip_html=True,
                                       tokenize=False, ignore_words=set(),
-                                      document_ids=set()):
+                                      document_ids=set(),
+                                      chunk_size=None,
+                                      batch_size=128,
+                                      max_in_flight_documents=None):
+        """
+        Iterates over the documents using num_workers processes.
+
+        Large uncompressed files are split into byte ranges of chunk_size
+        bytes, such that work is distributed evenly over the workers
+        regardless of the file sizes; see _split_trectext_paths.
+
+        Workers send documents in batches of at most batch_size documents.
+
+        If document_ids is non-empty, only those documents are returned;
+        workers skip other documents as soon as their <DOCNO> line is seen
+        (see _iter_trectext_file).
+
+        If max_in_flight_documents is set, workers block once that many
+        documents are waiting to be consumed. Including the batches that
+        workers are filling, at most max_in_flight_documents +
+        num_workers * batch_size parsed documents are held in memory.
+        """
         assert num_workers >= 1
+        assert batch_size >= 1
+        assert max_in_flight_documents is None or \
+            max_in_flight_documents >= 1
 
-        document_ids = set(document_ids) if document_ids else set()
+        if max_in_flight_documents is not None:
+            batch_size = min(batch_size, max_in_flight_documents)
+
+            # The queue holds batches rather than documents.
+            max_queue_size = max_in_flight_documents // batch_size
+        else:
+            max_queue_size = 0  # Unbounded.
+
+        # Identifiers are sent to the workers as a single sorted array,
+        # rather than as a pickled set.
+        if document_ids:
+            document_ids = np.unique(np.array(
+                [doc_id.encode('utf8') for doc_id in document_ids],
+                dtype=np.bytes_))
+        else:
+            document_ids = None
 
         if not tokenize:
             assert not ignore_words, \
                 'ignore_words should only be set if ' \
                 'tokeniziation is requested.'
 
-        result_q = multiprocessing.Queue()
+        result_q = multiprocessing.Queue(maxsize=max_queue_size)
+        stop_event = multiprocessing.Event()
 
         pool = multiprocessing.Pool(
             num_workers,
             initializer=(
                 _iter_trectext_documents_multiprocessing_worker_initializer),
-            initargs=[result_q,
+            initargs=[result_q, stop_event,
                       replace_digits, strip_html,
                       tokenize, ignore_words,
                       document_ids,
-                      self.encoding])
+                      self.encoding, self.parser,
+                      batch_size])
+
+        chunks = _split_trectext_paths(
+            self.document_paths, self.encoding, num_workers, chunk_size)
+
+        logging.debug('Split %d paths into %d chunks.',
+                      len(self.document_paths), len(chunks))
 
         worker_result = pool.map_async(
             _iter_trectext_documents_multiprocessing_worker,
-            self.document_paths)
+            chunks, chunksize=1)
 
         # We will not submit any more tasks to the pool.
         pool.close()
 
         it = multiprocessing_utils.QueueIterator(
-            pool, worker_result, result_q)
+            pool, worker_result, result_q, num_tasks=len(chunks),
+            stop_event=stop_event)
 
-        result_idx = 0
+        try:
+            for batch in it:
+                yield from batch
+        finally:
+            # Shut down the workers if the consumer stopped early.
+            it.close()
 
-        while True:
-            try:
-                result = next(it)
-
-                result_idx += 1
-            except StopIteration:
-                break
 
-            yield result
+_SHARD_BUFFER_SIZE = 1 << 22
 
 
 class ShardedTRECTextWriter(object):
 
-    def __init__(self, base, shard_size, encoding='ascii'):
+    """
+        Writes documents in TREC text format to shards base_1.trectext,
+        base_2.trectext, ...
+
+        A new shard is started once the current one holds shard_size
+        documents or, if max_shard_bytes is given, once it holds at least
+        max_shard_bytes (uncompressed) bytes. If encoding is None, shards
+        are written in binary mode and str data is encoded as UTF-8.
+
+        Documents are serialized into a buffer of buffer_size bytes that is
+        written at once. If compress is set, shards are gzip files
+        (base_1.trectext.gz, ...) and every buffer is compressed as a
+        separate gzip member by a pool of num_workers background threads
+        (zlib releases the GIL), such that compression runs in parallel to
+        serialization; with num_workers=0, buffers are compressed in the
+        calling thread.
+
+        Usage example:
+            writer = trec_utils.ShardedTRECTextWriter(
+                'corpus', shard_size=None, max_shard_bytes=1 << 30,
+                compress=True, num_workers=4)
+
+            for doc_id, doc_text in documents:
+                writer.write_document(doc_id, doc_text)
+
+            writer.close()
+    """
+
+    def __init__(self, base, shard_size, encoding='ascii',
+                 max_shard_bytes=None, compress=False, compresslevel=6,
+                 buffer_size=_SHARD_BUFFER_SIZE, num_workers=1):
+        assert shard_size is not None or max_shard_bytes is not None
+        assert shard_size is None or shard_size > 0
+        assert max_shard_bytes is None or max_shard_bytes > 0
+        assert buffer_size > 0
+        assert num_workers >= 0
+
         self.base = base
         self.shard_size = shard_size
+        self.max_shard_bytes = max_shard_bytes
         self.encoding = encoding
 
+        self.compress = compress
+        self.compresslevel = compresslevel
+
+        self.buffer_size = buffer_size
+
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        if compress and num_workers > 0:
+            self.pool = multiprocessing.pool.ThreadPool(num_workers)
+            self.max_pending = 2 * num_workers
+        else:
+            self.pool = None
+
+        # Compressed buffers that still need to be written, in order.
+        self.pending = collections.deque()
+
         self.current = None
 
         self.flush()
@@ -430,6 +1328,9 @@ class ShardedTRECTextWriter(object):
         if self.current is not None:
             (id, f) = self.current
 
+            self._flush_buffer()
+            self._write_pending(0)
+
             f.close()
         else:
             id = 0
@@ -437,44 +1338,86 @@ class ShardedTRECTextWriter(object):
         id += 1
 
         path = '{0}_{1}.trectext'.format(self.base, id)
+
+        if self.compress:
+            path += '.gz'
+
         if os.path.exists(path):
             raise RuntimeError('Output shard already exists.')
 
         logging.info('Writing shard %s', path)
 
-        if self.encoding is not None:
-            f = io_utils.open(path, 'w', encoding=self.encoding)
-        else:
-            f = io_utils.open(path, 'wb')
+        # Buffers are compressed by the writer (if at all), hence the shard
+        # is opened as a regular binary file.
+        f = open(path, 'wb')
 
         self.current = (id, f)
         self.current_count = 0
+        self.current_bytes = 0
 
     def close(self):
         assert self.current is not None
 
+        self._flush_buffer()
+        self._write_pending(0)
+
         self.current[1].close()
 
-    def _write(self, data):
-        if self.encoding is None and isinstance(data, str):
-            self.current[1].write(data.encode(self.encoding))
-        elif self.encoding is not None and isinstance(data, bytes):
-            self.current[1].write(data.decode(self.encoding))
-        else:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def _encode(self, data):
+        if isinstance(data, bytes):
+            return data
+        elif not isinstance(data, str):
+            data = '{0}'.format(data)
+
+        return data.encode(
+            self.encoding if self.encoding is not None else 'utf8')
+
+    def _flush_buffer(self):
+        if not self.buffer:
+            return
+
+        data = b''.join(self.buffer)
+
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        if not self.compress:
             self.current[1].write(data)
+        elif self.pool is None:
+            self.current[1].write(
+                gzip.compress(data, self.compresslevel, mtime=0))
+        else:
+            self.pending.append(self.pool.apply_async(
+                gzip.compress, (data, self.compresslevel), {'mtime': 0}))
+
+            self._write_pending(self.max_pending)
+
+    def _write_pending(self, max_pending):
+        while len(self.pending) > max_pending:
+            self.current[1].write(self.pending.popleft().get())
 
     def write_document(self, doc_id, doc_text):
-        self._write('<DOC>\n')
-        self._write('<DOCNO>{0}</DOCNO>\n'.format(doc_id))
-        self._write('<TEXT>\n')
-        self._write(doc_text)
-        self._write('\n')
-        self._write('</TEXT>\n')
-        self._write('</DOC>\n')
+        document = b''.join((
+            b'<DOC>\n<DOCNO>', self._encode(doc_id), b'</DOCNO>\n<TEXT>\n',
+            self._encode(doc_text), b'\n</TEXT>\n</DOC>\n'))
+
+        self.buffer.append(document)
+        self.buffer_bytes += len(document)
+
+        if self.buffer_bytes >= self.buffer_size:
+            self._flush_buffer()
 
         self.current_count += 1
+        self.current_bytes += len(document)
 
-        if self.current_count % self.shard_size == 0:
+        if (self.shard_size is not None and
+                self.current_count % self.shard_size == 0) or \
+                (self.max_shard_bytes is not None and
+                 self.current_bytes >= self.max_shard_bytes):
             self.flush()
 
 
@@ -516,20 +1459,50 @@ class EntityDocumentAssociations(object):
             self.num_associations += 1
 
 
+class _IdentityAssociationView(collections.abc.Mapping):
+
+    """
+        Read-only mapping from every identifier in a set to a singleton set
+        of itself, computed on access.
+    """
+
+    def __init__(self, identifiers):
+        self.identifiers = identifiers
+
+    def __getitem__(self, identifier):
+        if identifier not in self.identifiers:
+            raise KeyError(identifier)
+
+        return set([identifier])
+
+    def __contains__(self, identifier):
+        return identifier in self.identifiers
+
+    def __iter__(self):
+        return iter(self.identifiers)
+
+    def __len__(self):
+        return len(self.identifiers)
+
+
 class IdentityDocumentAssociations(object):
 
+    """
+        Associates every document with itself as an entity.
+
+        entities_per_document and documents_per_entity are views on the
+        set of document identifiers (which is not copied if document_ids is
+        a set already), rather than dictionaries of singleton sets.
+    """
+
     def __init__(self, document_ids):
-        self.entities = set(document_ids)
+        if not isinstance(document_ids, (set, frozenset)):
+            document_ids = set(document_ids)
 
-        self.entities_per_document = {
-            document_id: set([document_id])
-            for document_id in self.entities
-        }
+        self.entities = document_ids
 
-        self.documents_per_entity = {
-            document_id: set([document_id])
-            for document_id in self.entities
-        }
+        self.entities_per_document = _IdentityAssociationView(self.entities)
+        self.documents_per_entity = _IdentityAssociationView(self.entities)
 
         self.max_entities_per_document = 1
         self.num_associations = len(self.entities)
@@ -601,7 +1574,22 @@ def parse_trec_eval(f):
     return trec_eval
 
 
-def compute_significance(first_trec_eval, second_trec_eval, measures):
+def compute_significance(first_trec_eval, second_trec_eval, measures,
+                         test='ttest', **kwargs):
+    """
+    Computes the p-values between two systems for every measure, using a
+    paired t-test, or a randomization or bootstrap test (in which case
+    kwargs are passed to compute_significance_matrix).
+    """
+    assert test in SIGNIFICANCE_TESTS
+
+    if test != 'ttest':
+        p_values = compute_significance_matrix(
+            [first_trec_eval, second_trec_eval], measures,
+            test=test, **kwargs)
+
+        return {measure: p_values[measure][0, 1] for measure in p_values}
+
     topics = set(first_trec_eval.keys())
     topics = topics.intersection(set(second_trec_eval))
 
@@ -628,6 +1616,268 @@ def compute_significance(first_trec_eval, second_trec_eval, measures):
     return significance_results
 
 
+SIGNIFICANCE_TESTS = ('ttest', 'randomization', 'bootstrap')
+SIGNIFICANCE_CORRECTIONS = (None, 'bonferroni', 'holm')
+
+# Maximum number of elements of the intermediate matrices of resampling
+# tests.
+_RESAMPLING_MAX_BLOCK_ELEMENTS = 1 << 22
+
+# Tolerance when comparing resampled statistics with the observed one.
+_RESAMPLING_TOLERANCE = 1e-12
+
+
+def _stack_trec_evals(trec_evals, measures):
+    """
+    Stacks the per-topic values of the given measures into a
+    (systems x topics x measures) array; only topics that occur in every
+    trec_eval dictionary are kept.
+    """
+    topics = set.intersection(
+        *[set(trec_eval) for trec_eval in trec_evals])
+    topics.discard('all')
+
+    topics = sorted(topics)
+
+    values = np.array(
+        [[[trec_eval[topic][measure] for measure in measures]
+          for topic in topics]
+         for trec_eval in trec_evals],
+        dtype=np.float64).reshape(len(trec_evals), len(topics), len(measures))
+
+    return values, topics
+
+
+def _correct_p_values(p_values, correction):
+    """
+    Corrects a vector of p-values for multiple comparisons.
+    """
+    assert correction in SIGNIFICANCE_CORRECTIONS
+
+    num_tests = len(p_values)
+
+    if correction is None or not num_tests:
+        return p_values
+    elif correction == 'bonferroni':
+        return np.minimum(p_values * num_tests, 1.0)
+    elif correction == 'holm':
+        order = np.argsort(p_values, kind='stable')
+
+        corrected = np.empty(num_tests)
+        corrected[order] = np.minimum(np.maximum.accumulate(
+            p_values[order] * np.arange(num_tests, 0, -1)), 1.0)
+
+        return corrected
+
+
+def _pairwise_ttest(values):
+    """
+    Computes paired t-tests between all systems of a
+    (systems x topics x measures) array; returns a
+    (systems x systems x measures) array of two-sided p-values.
+    """
+    num_systems, num_topics, num_measures = values.shape
+
+    p_values = np.full((num_systems, num_systems, num_measures), np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for idx in range(num_systems - 1):
+            differences = values[idx] - values[idx + 1:]
+
+            statistics = differences.mean(axis=1) / (
+                differences.std(axis=1, ddof=1) / np.sqrt(num_topics))
+
+            p_values[idx, idx + 1:] = 2.0 * scipy.stats.t.sf(
+                np.abs(statistics), num_topics - 1)
+            p_values[idx + 1:, idx] = p_values[idx, idx + 1:]
+
+    return p_values
+
+
+def _resampling_test_worker(payload):
+    """
+    Computes randomization (sign-flip) or bootstrap p-values for every
+    column of a (topics x tests) matrix of paired differences.
+
+    Resampled topic weights are generated in blocks of block_size samples;
+    as every call uses the same seed, every column is tested using the same
+    samples, regardless of how columns are distributed over workers.
+    """
+    differences, test, num_samples, block_size, seed = payload
+
+    num_topics, num_columns = differences.shape
+
+    rng = np.random.default_rng(seed)
+
+    observed = np.abs(differences.mean(axis=0)) - _RESAMPLING_TOLERANCE
+
+    if test == 'bootstrap':
+        # Shift the differences such that the null hypothesis holds.
+        differences = differences - differences.mean(axis=0)
+
+    columns_per_chunk = max(
+        1, _RESAMPLING_MAX_BLOCK_ELEMENTS // block_size)
+
+    num_extreme = np.zeros(num_columns, dtype=np.int64)
+
+    for block_start in range(0, num_samples, block_size):
+        num_block_samples = min(block_size, num_samples - block_start)
+
+        if test == 'randomization':
+            weights = 2.0 * rng.integers(
+                0, 2, size=(num_block_samples, num_topics),
+                dtype=np.int8) - 1.0
+        elif test == 'bootstrap':
+            weights = rng.multinomial(
+                num_topics, np.full(num_topics, 1.0 / num_topics),
+                size=num_block_samples).astype(np.float64)
+
+        for column_start in range(0, num_columns, columns_per_chunk):
+            columns = slice(column_start, column_start + columns_per_chunk)
+
+            statistics = np.abs(
+                np.dot(weights, differences[:, columns]) / num_topics)
+
+            num_extreme[columns] += np.count_nonzero(
+                statistics >= observed[columns], axis=0)
+
+    return (num_extreme + 1.0) / (num_samples + 1.0)
+
+
+def _pairwise_resampling_test(values, test, num_samples, block_size, seed,
+                              num_workers=1):
+    """
+    Computes randomization or bootstrap tests between all systems of a
+    (systems x topics x measures) array; returns a
+    (systems x systems x measures) array of two-sided p-values.
+    """
+    num_systems, num_topics, num_measures = values.shape
+
+    first_indices, second_indices = np.triu_indices(num_systems, k=1)
+
+    p_values = np.full((num_systems, num_systems, num_measures), np.nan)
+
+    if not len(first_indices):
+        return p_values
+
+    # (topics x (pairs * measures)) matrix of paired differences.
+    differences = (values[first_indices] - values[second_indices]).transpose(
+        1, 0, 2).reshape(num_topics, -1)
+
+    payloads = [
+        (differences[:, columns], test, num_samples, block_size, seed)
+        for columns in np.array_split(
+            np.arange(differences.shape[1]),
+            min(num_workers, len(first_indices)))]
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+
+        pair_p_values = pool.map(_resampling_test_worker, payloads)
+
+        pool.close()
+        pool.join()
+    else:
+        pair_p_values = [_resampling_test_worker(payload)
+                         for payload in payloads]
+
+    pair_p_values = np.concatenate(pair_p_values).reshape(
+        len(first_indices), num_measures)
+
+    p_values[first_indices, second_indices] = pair_p_values
+    p_values[second_indices, first_indices] = pair_p_values
+
+    return p_values
+
+
+def _p_value_matrices(p_values, measures, correction):
+    """
+    Splits a (systems x systems x measures) array of p-values into
+    per-measure matrices, correcting for the number of system pairs.
+    """
+    num_systems = p_values.shape[0]
+
+    upper_indices = np.triu_indices(num_systems, k=1)
+
+    significance_results = {}
+
+    for measure_idx, measure in enumerate(measures):
+        matrix = p_values[:, :, measure_idx].copy()
+
+        matrix[upper_indices] = _correct_p_values(
+            matrix[upper_indices], correction)
+        matrix.T[upper_indices] = matrix[upper_indices]
+
+        significance_results[measure] = matrix
+
+    return significance_results
+
+
+def compute_significance_matrix(trec_evals, measures, correction=None,
+                                test='ttest', num_samples=100000,
+                                block_size=1000, seed=None, num_workers=1):
+    """
+    Computes paired two-sided significance tests between all pairs of
+    systems, given as a list of dictionaries in the format of
+    parse_trec_eval, for every measure at once.
+
+    Supported tests are:
+        - ttest: paired t-test.
+        - randomization: Fisher's randomization test, using num_samples
+            random sign flips of the per-topic differences.
+        - bootstrap: bootstrap test, using num_samples resamples (with
+            replacement) of the topics after shifting the per-topic
+            differences to zero mean.
+
+    For the randomization and bootstrap tests, the p-value is the fraction
+    of samples (counting the observed one) for which the absolute mean
+    difference is at least as large as observed. Samples are generated in
+    blocks of block_size samples; for a given seed, num_samples and
+    block_size, results are reproducible (also when num_workers > 1, in
+    which case system pairs are spread over a process pool).
+
+    Returns a dictionary that maps every measure to a
+    (systems x systems) matrix of p-values (with NaN on the diagonal).
+    Optionally, p-values are corrected for the number of system pairs
+    using the 'bonferroni' or 'holm' methods.
+
+    Usage example:
+        trec_evals = [trec_utils.evaluate(run_path, qrel_path)
+                      for run_path in run_paths]
+
+        p_values = trec_utils.compute_significance_matrix(
+            trec_evals, ['map', 'ndcg_cut_10'], correction='holm')
+
+        p_values['map'][0, 1]  # P-value between the first two systems.
+    """
+    assert test in SIGNIFICANCE_TESTS
+    assert correction in SIGNIFICANCE_CORRECTIONS
+
+    assert num_samples > 0
+    assert block_size > 0
+    assert num_workers > 0
+
+    measures = list(measures)
+
+    values, topics = _stack_trec_evals(trec_evals, measures)
+
+    logging.debug('Comparing %d systems over %d topics and %d measures.',
+                  *values.shape)
+
+    if test == 'ttest':
+        p_values = _pairwise_ttest(values)
+    else:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+
+            logging.info('Using seed %d for %s test.', seed, test)
+
+        p_values = _pairwise_resampling_test(
+            values, test, num_samples, block_size, seed, num_workers)
+
+    return _p_value_matrices(p_values, measures, correction)
+
+
 def parse_run(f_run, max_depth=None):
     run = {}
 
@@ -723,139 +1973,2099 @@ class TRECRun(object):
         write_run(model_name, data, out_f, max_objects_per_query)
 
 
-def write_run(model_name, data, out_f,
-              max_objects_per_query=sys.maxsize,
-              skip_sorting=False):
-    return write_ranking(
-        model_name, data, out_f, max_objects_per_query, skip_sorting,
-        '{subject} Q0 {object} {rank} {relevance:.40f} {model_name}\n')
+_TREC_CHUNK_SIZE = 1 << 24
 
+# Replaces line endings when splitting runs and qrels, such that lines can
+# be told apart after splitting on whitespace.
+_TREC_LINE_MARKER = b'\x00'
 
-def write_qrel(model_name, data, out_f,
-               max_objects_per_query=sys.maxsize,
-               skip_sorting=False):
-    return write_ranking(
-        None, data, out_f, max_objects_per_query, skip_sorting,
-        '{subject} 0 {object} {relevance}\n')
 
+def _iter_line_chunks(f, chunk_size=_TREC_CHUNK_SIZE):
+    """
+    Reads f in chunks that end at a line boundary; yields
+    (line number of first line, chunk) pairs.
+    """
+    line_idx = 0
+    remainder = b''
 
-class OnlineTRECRun(object):
+    while True:
+        data = f.read(chunk_size)
 
-    def __init__(self, name, rank_cutoff=sys.maxsize, write_fn=write_run):
-        self.name = name
-        self.rank_cutoff = rank_cutoff
+        if isinstance(data, str):
+            data = data.encode('utf8')
 
-        self.write_fn = write_fn
+        if not data:
+            break
 
-        self.tmp_file = tempfile.NamedTemporaryFile(
-            mode='w', delete=False)
+        data = remainder + data
+        boundary = data.rfind(b'\n') + 1
 
-        logging.info('Writing temporary run to %s.',
-                     self.tmp_file.name)
+        remainder = data[boundary:]
 
-    def add_ranking(self, subject_id, object_assesments):
-        assert self.tmp_file
+        if boundary:
+            yield line_idx, data[:boundary]
 
-        self.write_fn(self.name,
-                      data={subject_id: object_assesments},
-                      out_f=self.tmp_file,
-                      max_objects_per_query=self.rank_cutoff)
+            line_idx += data.count(b'\n', 0, boundary)
 
-    def close_and_return_temporary_path(self):
-        assert self.tmp_file
+    if remainder:
+        yield line_idx, remainder
 
-        tmp_file_path = self.tmp_file.name
 
-        self.tmp_file.close()
+def _split_chunk_fields(line_idx, data, num_fields, num_optional_fields=0,
+                        ignore_parse_errors=False):
+    """
+    Splits a chunk of lines that consist of num_fields whitespace-separated
+    fields (optionally followed by up to num_optional_fields fields that are
+    dropped); returns a flat list of fields and the number of fields per
+    line in that list.
+    """
+    if not data.endswith(b'\n'):
+        data += b'\n'
 
-        return tmp_file_path
+    fields = data.replace(
+        b'\n', b' ' + _TREC_LINE_MARKER + b' ').split()
 
-    def close_and_write(self, out_path, overwrite=True):
-        if not overwrite:
-            assert not os.path.exists(out_path)
-        elif os.path.exists(out_path):
-            logging.warning('Overwriting run %s.', out_path)
+    stride = num_fields + 1
+    num_lines = len(fields) // stride
 
-        tmp_file_path = self.close_and_return_temporary_path()
-        shutil.copy(tmp_file_path, out_path)
+    # Every line consists of exactly num_fields fields if and only if every
+    # (num_fields + 1)-th field, and no other, is a line marker.
+    if len(fields) % stride == 0 and \
+            fields.count(_TREC_LINE_MARKER) == num_lines and \
+            fields[num_fields::stride].count(_TREC_LINE_MARKER) == num_lines:
+        return fields, stride
 
-        os.remove(tmp_file_path)
+    # Slow path for optional fields and malformed lines.
+    fields = []
 
-    def close_and_evaluate(self, qrel):
-        assert self.tmp_file
+    for line_offset, line in enumerate(data.split(b'\n')):
+        line_fields = line.split()
 
-        assert isinstance(qrel, OnlineTRECRun) and qrel.write_fn == write_qrel
-        assert qrel.tmp_file
+        if not line_fields:  # Skip empty lines.
+            continue
+        elif num_fields <= len(line_fields) <= \
+                num_fields + num_optional_fields:
+            fields.extend(line_fields[:num_fields])
+        else:
+            logging.error('Encountered parsing error at line %d (%s).',
+                          line_idx + line_offset + 1,
+                          line.strip().decode('utf8', 'replace'))
 
-        qrel_tmp_file_path = qrel.tmp_file.name
-        run_tmp_file_path = self.tmp_file.name
+            if not ignore_parse_errors:
+                raise ValueError()
 
-        qrel.tmp_file.close()
-        self.tmp_file.close()
+    return fields, num_fields
 
-        trec_eval = evaluate(run_tmp_file_path, qrel_tmp_file_path)
 
-        os.remove(qrel_tmp_file_path)
-        os.remove(run_tmp_file_path)
+def _intern_chunk_ids(ids):
+    """
+    Interns the identifiers of a chunk; returns the sorted unique
+    identifiers and the index of every identifier.
+    """
+    unique_ids, indices = np.unique(
+        np.array(ids, dtype=np.bytes_), return_inverse=True)
 
-        return trec_eval
+    return unique_ids, indices.reshape(-1).astype(np.int32)
 
 
-def evaluate(run_path, qrel_path):
-    assert os.path.exists(run_path)
-    assert os.path.exists(qrel_path)
+def _merge_chunk_ids(chunk_ids):
+    """
+    Merges the output of _intern_chunk_ids over chunks; returns the sorted
+    unique identifiers and the index of every identifier.
+    """
+    unique_ids, remaps = _merge_sorted_ids(
+        [unique_ids for unique_ids, _ in chunk_ids])
 
-    command = ['trec_eval -q -m all_trec {} {}'.format(qrel_path, run_path)]
-    out = subprocess.check_output(command, shell=True)
-    return parse_trec_eval(out.decode('ascii').split('\n'))
+    return unique_ids, np.concatenate(
+        [remap[indices] for remap, (_, indices) in zip(remaps, chunk_ids)] +
+        [np.zeros(0, dtype=np.int32)])
 
 
-def write_ranking(model_name, data, out_f,
-                  max_objects_per_query,
-                  skip_sorting,
-                  format):
+def _parse_trec_run_chunk(line_idx, data, ignore_parse_errors=False):
     """
-    Write a run to an output file.
+    Parses a chunk of a TREC run; returns (topic_id, number of entries)
+    pairs for consecutive entries of the same topic, the interned object
+    identifiers (see _intern_chunk_ids), and arrays of ranks and scores.
+    """
+    # In some old runs, the 7th field contained relevance feedback labels.
+    fields, stride = _split_chunk_fields(
+        line_idx, data, 6, num_optional_fields=1,
+        ignore_parse_errors=ignore_parse_errors)
 
-    Parameters:
-        - model_name: identifier of run.
-        - data: dictionary mapping topic_id to object_assesments;
-            object_assesments is an iterable (list or tuple) of
-            (relevance, object_id) pairs.
+    num_entries = len(fields) // stride
 
-            The object_assesments iterable is sorted by decreasing order.
-        - out_f: output file stream.
-        - max_objects_per_query: cut-off for number of objects per query.
+    topic_runs = [(topic_id, len(list(group)))
+                  for topic_id, group in itertools.groupby(fields[0::stride])]
+
+    return (topic_runs,
+            _intern_chunk_ids(fields[2::stride]),
+            np.fromiter(map(float, fields[3::stride]),
+                        dtype=np.float64, count=num_entries),
+            np.fromiter(map(float, fields[4::stride]),
+                        dtype=np.float64, count=num_entries))
+
+
+def _merge_sorted_ids(sorted_ids):
     """
-    for subject_id, object_assesments in data.items():
-        if not object_assesments:
-            logging.warning('Received empty ranking for %s; ignoring.',
-                            subject_id)
+    Merges arrays of sorted, unique identifiers; returns the sorted union
+    and, for every array, the indices of its identifiers in the union.
+    """
+    ids = np.concatenate(list(sorted_ids) + [np.zeros(0, dtype=np.bytes_)])
+
+    # A stable sort benefits from the runs of sorted identifiers.
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+
+    is_first = np.ones(len(ids), dtype=bool)
+    is_first[1:] = ids[1:] != ids[:-1]
+
+    indices = np.empty(len(ids), dtype=np.int32)
+    indices[order] = np.cumsum(is_first) - 1
+
+    return ids[is_first], np.split(
+        indices, np.cumsum([len(array) for array in sorted_ids])[:-1])
+
 
+def _save_arrays(path, **arrays):
+    """
+    Writes arrays to directory path, as one .npy file per array, such that
+    they can be memory-mapped individually.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(path, '{}.npy'.format(name)), array,
+                allow_pickle=False)
+
+
+def _load_arrays(path, mmap=True):
+    """
+    Loads the arrays written by _save_arrays.
+    """
+    arrays = {}
+
+    for filename in os.listdir(path):
+        name, extension = os.path.splitext(filename)
+
+        if extension != '.npy':
             continue
 
-        # Probe types, to make sure everything goes alright.
-        # assert isinstance(object_assesments[0][0], float) or \
-        #     isinstance(object_assesments[0][0], np.float32)
-        assert isinstance(object_assesments[0][1], str) or \
-            isinstance(object_assesments[0][1], bytes)
+        arrays[name] = np.load(os.path.join(path, filename),
+                               mmap_mode='r' if mmap else None,
+                               allow_pickle=False)
 
-        if not skip_sorting:
-            object_assesments = sorted(object_assesments, reverse=True)
+    return arrays
 
-        if max_objects_per_query < sys.maxsize:
-            object_assesments = object_assesments[:max_objects_per_query]
 
-        if isinstance(subject_id, bytes):
-            subject_id = subject_id.decode('utf8')
+class ColumnarTRECRun(object):
+
+    """
+        Array-backed TREC run.
 
-        for rank, (relevance, object_id) in enumerate(object_assesments):
-            if isinstance(object_id, bytes):
-                object_id = object_id.decode('utf8')
+        Topic and object identifiers are interned; object identifiers are
+        kept in sorted order as a NumPy bytes array. The entries of topic
+        topic_ids[i] are stored contiguously in the slice
+        topic_offsets[i]:topic_offsets[i + 1] of object_indices (indices into
+        object_ids), scores and ranks, in the order in which they were added.
+        This takes several times less memory than the dictionaries returned
+        by parse_trec_run.
 
-            out_f.write(format.format(
-                subject=subject_id,
-                object=object_id,
-                rank=rank + 1,
-                relevance=relevance,
-                model_name=model_name))
+        Usage example:
+            with open('run.txt', 'rb') as f_run:
+                run = trec_utils.ColumnarTRECRun.parse(f_run)
+
+            for topic_id in run:
+                object_ids, scores = run[topic_id]
+
+            # For code that expects the output of parse_trec_run.
+            run_dict = run.to_dict(return_score=True)
+    """
+
+    def __init__(self, topic_ids, object_ids, topic_offsets,
+                 object_indices, scores, ranks=None):
+        assert len(topic_offsets) == len(topic_ids) + 1
+        assert len(object_indices) == len(scores) == topic_offsets[-1]
+
+        self.topic_ids = list(topic_ids)
+        self.object_ids = np.asarray(object_ids, dtype=np.bytes_)
+
+        self.topic_offsets = np.asarray(topic_offsets, dtype=np.int64)
+
+        self.object_indices = np.asarray(object_indices, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float64)
+
+        if np.any(self.object_ids[1:] <= self.object_ids[:-1]):
+            self.object_ids, remap = np.unique(
+                self.object_ids, return_inverse=True)
+            self.object_indices = remap.reshape(-1).astype(
+                np.int32)[self.object_indices]
+
+        if ranks is None:
+            # Entries are ranked in the order in which they are stored.
+            ranks = np.arange(1, len(self.scores) + 1) - np.repeat(
+                self.topic_offsets[:-1], np.diff(self.topic_offsets))
+
+        self.ranks = np.asarray(ranks, dtype=np.int32)
+
+        assert len(self.ranks) == len(self.scores)
+
+        self.topic_indices = {
+            topic_id: idx for idx, topic_id in enumerate(self.topic_ids)}
+
+        assert len(self.topic_indices) == len(self.topic_ids)
+
+    @classmethod
+    def parse(cls, f, ignore_duplicates=False, ignore_parse_errors=False,
+              chunk_size=_TREC_CHUNK_SIZE):
+        """
+        Parses a TREC run from f (preferably opened in binary mode), reading
+        it in chunks that are split and converted in bulk.
+
+        Entries are grouped by topic in order of first occurrence. As in
+        parse_trec_run, duplicate objects within a topic raise an
+        AssertionError unless ignore_duplicates is set, in which case the
+        last rank and score are kept.
+        """
+        topic_index = {}
+
+        topic_indices, object_ids, ranks, scores = [], [], [], []
+
+        for line_idx, data in _iter_line_chunks(f, chunk_size):
+            topic_runs, chunk_object_ids, chunk_ranks, chunk_scores = \
+                _parse_trec_run_chunk(line_idx, data, ignore_parse_errors)
+
+            topic_indices.append(np.repeat(
+                [topic_index.setdefault(topic_id, len(topic_index))
+                 for topic_id, _ in topic_runs],
+                [num_entries for _, num_entries in topic_runs]))
+
+            object_ids.append(chunk_object_ids)
+            ranks.append(chunk_ranks)
+            scores.append(chunk_scores)
+
+        topic_ids = [topic_id.decode('utf8') for topic_id in topic_index]
+
+        if not topic_ids:
+            return cls([], [], [0], [], [], [])
+
+        topic_indices = np.concatenate(topic_indices).astype(np.int32)
+
+        object_ids, object_indices = _merge_chunk_ids(object_ids)
+
+        ranks = np.concatenate(ranks)
+        scores = np.concatenate(scores)
+
+        keys = topic_indices.astype(np.int64) * len(object_ids) + \
+            object_indices
+
+        _, first_indices = np.unique(keys, return_index=True)
+
+        if len(first_indices) < len(keys):
+            is_duplicate = np.ones(len(keys), dtype=bool)
+            is_duplicate[first_indices] = False
+
+            duplicate_idx = np.flatnonzero(is_duplicate)[0]
+
+            assert ignore_duplicates, (
+                topic_ids[topic_indices[duplicate_idx]],
+                object_ids[object_indices[duplicate_idx]].decode('utf8'))
+
+            logging.warning('Run contains %d duplicate entries.',
+                            len(keys) - len(first_indices))
+
+            # Keep the position of the first occurrence, but the values of
+            # the last occurrence (as parse_trec_run does).
+            _, last_indices = np.unique(keys[::-1], return_index=True)
+            last_indices = len(keys) - 1 - last_indices
+
+            ranks[first_indices] = ranks[last_indices]
+            scores[first_indices] = scores[last_indices]
+
+            first_indices.sort()
+
+            topic_indices = topic_indices[first_indices]
+            object_indices = object_indices[first_indices]
+            ranks = ranks[first_indices]
+            scores = scores[first_indices]
+
+        if np.all(topic_indices[1:] >= topic_indices[:-1]):
+            order = slice(None)  # Entries are already grouped by topic.
+        else:
+            order = np.argsort(topic_indices, kind='stable')
+
+        topic_offsets = np.zeros(len(topic_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(topic_indices, minlength=len(topic_ids)),
+                  out=topic_offsets[1:])
+
+        return cls(topic_ids, object_ids, topic_offsets,
+                   object_indices[order], scores[order], ranks[order])
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a run written by save; arrays are memory-mapped if mmap is set.
+        """
+        arrays = _load_arrays(path, mmap)
+
+        return cls(arrays['topic_ids'].tolist(),
+                   arrays['object_ids'],
+                   arrays['topic_offsets'],
+                   arrays['object_indices'],
+                   arrays['scores'],
+                   arrays['ranks'])
+
+    def save(self, path):
+        """
+        Writes the run to directory path, as one .npy file per array.
+        """
+        _save_arrays(path,
+                     topic_ids=np.array(self.topic_ids, dtype=np.str_),
+                     object_ids=self.object_ids,
+                     topic_offsets=self.topic_offsets,
+                     object_indices=self.object_indices,
+                     scores=self.scores,
+                     ranks=self.ranks)
+
+    @classmethod
+    def from_dict(cls, run):
+        """
+        Converts a dictionary mapping topic identifiers to dictionaries of
+        object scores (e.g., the output of parse_trec_run or TRECRun) into a
+        columnar run. Ranks follow the order of the dictionaries.
+        """
+        if isinstance(run, TRECRun):
+            run = run.data
+
+        topic_ids = [topic_id for topic_id in run if run[topic_id]]
+
+        topic_offsets = np.zeros(len(topic_ids) + 1, dtype=np.int64)
+        np.cumsum([len(run[topic_id]) for topic_id in topic_ids],
+                  out=topic_offsets[1:])
+
+        object_index = {}
+
+        object_indices = np.fromiter(
+            (object_index.setdefault(object_id, len(object_index))
+             for topic_id in topic_ids for object_id in run[topic_id]),
+            dtype=np.int32, count=topic_offsets[-1])
+
+        scores = np.fromiter(
+            (score for topic_id in topic_ids
+             for score in run[topic_id].values()),
+            dtype=np.float64, count=topic_offsets[-1])
+
+        object_ids = np.array(
+            [object_id.encode('utf8') for object_id in object_index],
+            dtype=np.bytes_)
+
+        return cls(topic_ids, object_ids, topic_offsets,
+                   object_indices, scores)
+
+    def to_dict(self, return_score=False):
+        """
+        Converts the run into the format of parse_trec_run.
+        """
+        run = collections.defaultdict(collections.OrderedDict)
+
+        values = self.scores if return_score else \
+            self.ranks.astype(np.float64)
+
+        for topic_id in self.topic_ids:
+            object_ids, start, end = self._get(topic_id)
+
+            run[topic_id] = collections.OrderedDict(zip(
+                (object_id.decode('utf8') for object_id in object_ids),
+                values[start:end].tolist()))
+
+        return run
+
+    def topic_segments(self):
+        """
+        Returns the topic index of every entry.
+        """
+        return np.repeat(np.arange(len(self.topic_ids), dtype=np.int32),
+                         np.diff(self.topic_offsets))
+
+    def rank_entries(self):
+        """
+        Returns the rank (starting from 1) of every entry within its topic,
+        when ordered by decreasing score and decreasing object identifier
+        (as trec_eval does).
+        """
+        segments = self.topic_segments()
+
+        # As object identifiers are sorted, their indices order them.
+        order = np.lexsort((self.object_indices, self.scores,
+                            -segments))[::-1]
+
+        ranks = np.empty(len(self.scores), dtype=np.int64)
+        ranks[order] = np.arange(1, len(order) + 1) - \
+            self.topic_offsets[segments[order]]
+
+        return ranks
+
+    def __len__(self):
+        return len(self.topic_ids)
+
+    def __iter__(self):
+        return iter(self.topic_ids)
+
+    def __contains__(self, topic_id):
+        return topic_id in self.topic_indices
+
+    def __getitem__(self, topic_id):
+        """
+        Returns the object identifiers (bytes) and scores of a topic.
+        """
+        object_ids, start, end = self._get(topic_id)
+
+        return object_ids, self.scores[start:end]
+
+    def _get(self, topic_id):
+        idx = self.topic_indices[topic_id]
+        start, end = self.topic_offsets[idx], self.topic_offsets[idx + 1]
+
+        return self.object_ids[self.object_indices[start:end]], start, end
+
+    @property
+    def nbytes(self):
+        return (self.object_ids.nbytes + self.topic_offsets.nbytes +
+                self.object_indices.nbytes + self.scores.nbytes +
+                self.ranks.nbytes)
+
+    def write_run(self, model_name, out_f,
+                  max_objects_per_query=sys.maxsize):
+        data = collections.OrderedDict()
+
+        for topic_id in self.topic_ids:
+            object_ids, scores = self[topic_id]
+
+            data[topic_id] = (scores, object_ids)
+
+        write_run(model_name, data, out_f, max_objects_per_query)
+
+
+def _compact_relevances(relevances):
+    """
+    Stores integral relevance levels using the smallest integer type that
+    holds them.
+    """
+    relevances = np.asarray(relevances)
+
+    if not len(relevances) or relevances.dtype.kind in 'iu':
+        return relevances
+
+    relevances = relevances.astype(np.float64)
+
+    if np.all(relevances == np.round(relevances)):
+        for dtype in (np.int8, np.int16, np.int32):
+            dtype_info = np.iinfo(dtype)
+
+            if relevances.min() >= dtype_info.min and \
+                    relevances.max() <= dtype_info.max:
+                return relevances.astype(dtype)
+
+    return relevances
+
+
+class ColumnarTRECQrel(object):
+
+    """
+        Array-backed TREC relevance judgments.
+
+        Similar to ColumnarTRECRun, topic identifiers are interned and object
+        identifiers are kept in sorted order as a NumPy bytes array; the
+        judgments of topic topic_ids[i] are stored contiguously in the slice
+        topic_offsets[i]:topic_offsets[i + 1] of object_indices and
+        relevances (in the order of the qrel file). Integral relevance levels
+        are stored using the smallest integer type that holds them.
+
+        Judgments are looked up by a hash lookup of the topic, followed by a
+        binary search within the judgments of that topic. If an object is
+        judged more than once, the last judgment is used (as in
+        TRECEvaluator).
+
+        Usage example:
+            with open('qrel.txt', 'rb') as f_qrel:
+                qrel = trec_utils.ColumnarTRECQrel.parse(f_qrel)
+
+            qrel.get('301', 'FBIS3-10082')
+            qrel.get_relevances('301', ['FBIS3-10082', 'FBIS3-10169'])
+
+            # Same output as parse_qrel.
+            qrel_list = qrel.to_list()
+    """
+
+    def __init__(self, topic_ids, object_ids, topic_offsets,
+                 object_indices, relevances, lookup_order=None):
+        assert len(topic_offsets) == len(topic_ids) + 1
+        assert len(object_indices) == len(relevances) == topic_offsets[-1]
+
+        self.topic_ids = list(topic_ids)
+        self.object_ids = np.asarray(object_ids, dtype=np.bytes_)
+
+        self.topic_offsets = np.asarray(topic_offsets, dtype=np.int64)
+
+        self.object_indices = np.asarray(object_indices, dtype=np.int32)
+        self.relevances = _compact_relevances(relevances)
+
+        if np.any(self.object_ids[1:] <= self.object_ids[:-1]):
+            self.object_ids, remap = np.unique(
+                self.object_ids, return_inverse=True)
+            self.object_indices = remap.reshape(-1).astype(
+                np.int32)[self.object_indices]
+
+            lookup_order = None
+
+        self.topic_indices = {
+            topic_id: idx for idx, topic_id in enumerate(self.topic_ids)}
+
+        assert len(self.topic_indices) == len(self.topic_ids)
+
+        if lookup_order is not None:
+            self.lookup_order = np.asarray(lookup_order, dtype=np.int32)
+
+            assert len(self.lookup_order) == len(self.object_indices)
+
+            return
+
+        # Judgments ordered by topic, object and position; used for lookups.
+        self.lookup_order = np.lexsort((
+            np.arange(len(self.object_indices)),
+            self.object_indices,
+            np.repeat(np.arange(len(self.topic_ids)),
+                      np.diff(self.topic_offsets)))).astype(np.int32)
+
+    @classmethod
+    def parse(cls, f, lowercase_items=False, chunk_size=_TREC_CHUNK_SIZE):
+        """
+        Parses TREC relevance judgments from f (preferably opened in binary
+        mode), reading it in chunks that are split and converted in bulk.
+
+        As in parse_qrel, topics are sorted by identifier.
+        """
+        topic_index = {}
+
+        topic_indices, object_ids, relevances = [], [], []
+
+        for line_idx, data in _iter_line_chunks(f, chunk_size):
+            fields, stride = _split_chunk_fields(line_idx, data, 4)
+
+            topic_runs = [
+                (topic_id, len(list(group)))
+                for topic_id, group in itertools.groupby(fields[0::stride])]
+
+            topic_indices.append(np.repeat(
+                [topic_index.setdefault(topic_id, len(topic_index))
+                 for topic_id, _ in topic_runs],
+                [num_judgments for _, num_judgments in topic_runs]))
+
+            object_ids.append(_intern_chunk_ids(fields[2::stride]))
+            relevances.append(np.fromiter(
+                map(float, fields[3::stride]),
+                dtype=np.float64, count=len(fields) // stride))
+
+        if not topic_index:
+            return cls([], [], [0], [], [])
+
+        topic_ids = [topic_id.decode('utf8') for topic_id in topic_index]
+
+        # Renumber topics in sorted order.
+        topic_order = sorted(range(len(topic_ids)),
+                             key=lambda idx: topic_ids[idx])
+
+        topic_remap = np.empty(len(topic_ids), dtype=np.int32)
+        topic_remap[topic_order] = np.arange(len(topic_ids))
+
+        topic_ids = [topic_ids[idx] for idx in topic_order]
+        topic_indices = topic_remap[np.concatenate(topic_indices)]
+
+        object_ids, object_indices = _merge_chunk_ids(object_ids)
+
+        if lowercase_items:
+            object_ids = np.array(
+                [object_id.decode('utf8').lower().encode('utf8')
+                 for object_id in object_ids], dtype=np.bytes_)
+
+        relevances = np.concatenate(relevances)
+
+        order = np.argsort(topic_indices, kind='stable')
+
+        topic_offsets = np.zeros(len(topic_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(topic_indices, minlength=len(topic_ids)),
+                  out=topic_offsets[1:])
+
+        return cls(topic_ids, object_ids, topic_offsets,
+                   object_indices[order], relevances[order])
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads judgments written by save; arrays are memory-mapped if mmap is
+        set.
+        """
+        arrays = _load_arrays(path, mmap)
+
+        return cls(arrays['topic_ids'].tolist(),
+                   arrays['object_ids'],
+                   arrays['topic_offsets'],
+                   arrays['object_indices'],
+                   arrays['relevances'],
+                   arrays['lookup_order'])
+
+    def save(self, path):
+        """
+        Writes the judgments to directory path, as one .npy file per array.
+        """
+        _save_arrays(path,
+                     topic_ids=np.array(self.topic_ids, dtype=np.str_),
+                     object_ids=self.object_ids,
+                     topic_offsets=self.topic_offsets,
+                     object_indices=self.object_indices,
+                     relevances=self.relevances,
+                     lookup_order=self.lookup_order)
+
+    def to_list(self):
+        """
+        Converts the judgments into the format of parse_qrel.
+        """
+        return [(topic_id, list(zip(*self._get(topic_id))))
+                for topic_id in self.topic_ids]
+
+    def to_dict(self):
+        """
+        Converts the judgments into a dictionary mapping topic identifiers to
+        dictionaries of object relevances.
+        """
+        return {topic_id: dict(zip(*self._get(topic_id)))
+                for topic_id in self.topic_ids}
+
+    def _get(self, topic_id):
+        idx = self.topic_indices[topic_id]
+        start, end = self.topic_offsets[idx], self.topic_offsets[idx + 1]
+
+        return ([object_id.decode('utf8') for object_id in
+                 self.object_ids[self.object_indices[start:end]]],
+                self.relevances[start:end].astype(np.float64).tolist())
+
+    def __len__(self):
+        return len(self.topic_ids)
+
+    def __iter__(self):
+        return iter(self.topic_ids)
+
+    def __contains__(self, topic_id):
+        return topic_id in self.topic_indices
+
+    def get(self, topic_id, object_id, default=None):
+        """
+        Returns the relevance of an object for a topic, or default if the
+        object was not judged.
+        """
+        relevance = self.get_relevances(topic_id, [object_id])[0]
+
+        return default if np.isnan(relevance) else float(relevance)
+
+    def get_relevances(self, topic_id, object_ids):
+        """
+        Returns an array with the relevance of every object for a topic (NaN
+        for objects that were not judged).
+        """
+        relevances = np.full(len(object_ids), np.nan)
+
+        if topic_id not in self.topic_indices or not len(object_ids):
+            return relevances
+
+        idx = self.topic_indices[topic_id]
+        start, end = self.topic_offsets[idx], self.topic_offsets[idx + 1]
+
+        topic_judgments = self.lookup_order[start:end]
+        topic_object_indices = self.object_indices[topic_judgments]
+
+        object_ids = np.array(
+            [object_id.encode('utf8') if isinstance(object_id, str)
+             else object_id for object_id in object_ids], dtype=np.bytes_)
+
+        object_indices = np.searchsorted(self.object_ids, object_ids)
+        object_indices[object_indices >= len(self.object_ids)] = 0
+
+        is_known = self.object_ids[object_indices] == object_ids
+
+        # Position of the last judgment of every object within the topic.
+        positions = np.searchsorted(
+            topic_object_indices, object_indices, side='right') - 1
+
+        is_judged = is_known & (positions >= 0)
+        is_judged[is_judged] &= topic_object_indices[
+            positions[is_judged]] == object_indices[is_judged]
+
+        relevances[is_judged] = self.relevances[
+            topic_judgments[positions[is_judged]]]
+
+        return relevances
+
+
+def _find_identifier(identifiers, identifier):
+    """
+    Returns the index of identifier (str or bytes) in the sorted NumPy
+    bytes array identifiers, or -1 if it does not occur.
+    """
+    if isinstance(identifier, str):
+        identifier = identifier.encode('utf8')
+
+    idx = int(np.searchsorted(identifiers, identifier))
+
+    if idx < len(identifiers) and identifiers[idx] == identifier:
+        return idx
+
+    return -1
+
+
+class _IdentifierSet(collections.abc.Set):
+
+    """
+        Read-only set of str identifiers backed by a sorted NumPy bytes
+        array.
+    """
+
+    def __init__(self, identifiers):
+        self.identifiers = identifiers
+
+    def __contains__(self, identifier):
+        return _find_identifier(self.identifiers, identifier) >= 0
+
+    def __iter__(self):
+        return (identifier.decode('utf8')
+                for identifier in self.identifiers.tolist())
+
+    def __len__(self):
+        return len(self.identifiers)
+
+
+class _AssociationView(collections.abc.Mapping):
+
+    """
+        Read-only mapping from str identifiers (keys) to the sets of
+        identifiers (values) associated with them in a compressed sparse
+        matrix, given by its keys, values, indptr and indices. As with a
+        defaultdict(set), unknown keys map to an empty set.
+    """
+
+    def __init__(self, keys, values, indptr, indices):
+        assert len(indptr) == len(keys) + 1
+
+        self.keys_ = keys
+        self.values_ = values
+
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, key):
+        idx = _find_identifier(self.keys_, key)
+
+        if idx < 0:
+            return set()
+
+        return set(
+            value.decode('utf8') for value in self.values_[
+                self.indices[self.indptr[idx]:self.indptr[idx + 1]]].tolist())
+
+    def __contains__(self, key):
+        return _find_identifier(self.keys_, key) >= 0
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        return (key.decode('utf8') for key in self.keys_.tolist())
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+def _compact_indices(indices, num_identifiers):
+    """
+    Renumbers indices into [0, num_identifiers) such that only the
+    identifiers that occur are kept; returns the kept identifiers (in
+    order) and the new indices.
+    """
+    used = np.bincount(indices, minlength=num_identifiers) > 0
+
+    remap = np.cumsum(used, dtype=np.int64) - 1
+
+    return np.flatnonzero(used), remap[indices].astype(np.int32)
+
+
+class SparseEntityDocumentAssociations(object):
+
+    """
+        Compact alternative to EntityDocumentAssociations.
+
+        Entity and document identifiers are interned as sorted NumPy bytes
+        arrays (entity_ids and document_ids) and the associations are stored
+        as a boolean sparse matrix with a row per document, both in CSR
+        (document_entities) and in CSC (entity_documents) format. The
+        entities, entities_per_document and documents_per_entity attributes
+        are read-only views that answer the same queries as those of
+        EntityDocumentAssociations.
+
+        Usage example:
+            with open('assocs.txt', 'rb') as f_assocs:
+                associations = SparseEntityDocumentAssociations.parse(
+                    f_assocs, max_unique_entities=1000)
+
+            'FBIS3-10082' in associations.entities_per_document
+            associations.documents_per_entity['candidate-0001']
+    """
+
+    def __init__(self, entity_ids, document_ids, document_entities,
+                 num_associations=None):
+        self.entity_ids = np.asarray(entity_ids, dtype=np.bytes_)
+        self.document_ids = np.asarray(document_ids, dtype=np.bytes_)
+
+        assert not np.any(self.entity_ids[1:] <= self.entity_ids[:-1])
+        assert not np.any(self.document_ids[1:] <= self.document_ids[:-1])
+
+        self.document_entities = scipy.sparse.csr_matrix(
+            document_entities,
+            shape=(len(self.document_ids), len(self.entity_ids)),
+            dtype=bool)
+        self.document_entities.sum_duplicates()
+
+        self.entity_documents = self.document_entities.tocsc()
+        self.entity_documents.sort_indices()
+
+        # Number of (possibly duplicate) associations that were read.
+        self.num_associations = self.document_entities.nnz \
+            if num_associations is None else num_associations
+
+        self.max_entities_per_document = int(
+            np.diff(self.document_entities.indptr).max()) \
+            if len(self.document_ids) else 0
+
+        self.entities = _IdentifierSet(self.entity_ids)
+
+        self.entities_per_document = _AssociationView(
+            self.document_ids, self.entity_ids,
+            self.document_entities.indptr, self.document_entities.indices)
+        self.documents_per_entity = _AssociationView(
+            self.entity_ids, self.document_ids,
+            self.entity_documents.indptr, self.entity_documents.indices)
+
+    @classmethod
+    def parse(cls, f, document_ids=None, max_unique_entities=False,
+              chunk_size=_TREC_CHUNK_SIZE):
+        """
+        Parses (entity, document, score) lines from f (preferably opened in
+        binary mode), reading it in chunks that are split and interned in
+        bulk. Arguments are as for EntityDocumentAssociations.
+        """
+        entity_chunks, document_chunks = [], []
+
+        for line_idx, data in _iter_line_chunks(f, chunk_size):
+            fields, stride = _split_chunk_fields(line_idx, data, 3)
+
+            entity_chunks.append(_intern_chunk_ids(fields[0::stride]))
+            document_chunks.append(_intern_chunk_ids(fields[1::stride]))
+
+        entity_ids, entity_indices = _merge_chunk_ids(entity_chunks)
+        all_document_ids, document_indices = _merge_chunk_ids(
+            document_chunks)
+
+        if document_ids is not None:
+            is_allowed = np.isin(all_document_ids, np.array(
+                [document_id.encode('utf8')
+                 if isinstance(document_id, str) else document_id
+                 for document_id in document_ids] + [b''],
+                dtype=np.bytes_))
+
+            keep = is_allowed[document_indices]
+
+            entity_indices = entity_indices[keep]
+            document_indices = document_indices[keep]
+
+        if max_unique_entities:
+            # Keep the first max_unique_entities entities in file order.
+            _, first_positions = np.unique(
+                entity_indices, return_index=True)
+
+            is_allowed = np.zeros(len(entity_ids), dtype=bool)
+            is_allowed[entity_indices[
+                np.sort(first_positions)[:max_unique_entities]]] = True
+
+            keep = is_allowed[entity_indices]
+
+            entity_indices = entity_indices[keep]
+            document_indices = document_indices[keep]
+
+        num_associations = len(entity_indices)
+
+        # Drop identifiers that are no longer associated.
+        used_entities, entity_indices = _compact_indices(
+            entity_indices, len(entity_ids))
+        used_documents, document_indices = _compact_indices(
+            document_indices, len(all_document_ids))
+
+        num_entities = len(used_entities)
+
+        pairs = np.unique(
+            document_indices.astype(np.int64) * num_entities +
+            entity_indices)
+
+        indptr = np.zeros(len(used_documents) + 1, dtype=np.int64)
+
+        if num_entities:
+            np.cumsum(np.bincount(pairs // num_entities,
+                                  minlength=len(used_documents)),
+                      out=indptr[1:])
+
+        document_entities = scipy.sparse.csr_matrix(
+            (np.ones(len(pairs), dtype=bool),
+             (pairs % max(num_entities, 1)).astype(np.int32),
+             indptr),
+            shape=(len(used_documents), num_entities))
+
+        return cls(entity_ids[used_entities],
+                   all_document_ids[used_documents],
+                   document_entities,
+                   num_associations=num_associations)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads associations written by save; arrays are memory-mapped if mmap
+        is set.
+        """
+        arrays = _load_arrays(path, mmap)
+
+        return cls(arrays['entity_ids'],
+                   arrays['document_ids'],
+                   (np.ones(len(arrays['indices']), dtype=bool),
+                    arrays['indices'],
+                    arrays['indptr']),
+                   num_associations=int(arrays['num_associations']))
+
+    def save(self, path):
+        """
+        Writes the associations to directory path, as one .npy file per
+        array.
+        """
+        _save_arrays(path,
+                     entity_ids=self.entity_ids,
+                     document_ids=self.document_ids,
+                     indptr=self.document_entities.indptr,
+                     indices=self.document_entities.indices,
+                     num_associations=np.array(self.num_associations))
+
+
+# Increment when the layout of cached objects changes.
+_CACHE_VERSION = 1
+
+TREC_CACHE_DIR = os.environ.get(
+    'TREC_UTILS_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'trec_utils_cache'))
+
+
+def _parse_trec_eval_arrays(path):
+    with open(path, 'r') as f:
+        trec_eval = parse_trec_eval(f)
+
+    topics = sorted(trec_eval)
+    measures = sorted(set(itertools.chain.from_iterable(
+        trec_eval[topic] for topic in topics)))
+
+    values = np.array(
+        [[trec_eval[topic].get(measure, np.nan) for measure in measures]
+         for topic in topics], dtype=np.float64).reshape(
+             len(topics), len(measures))
+
+    return {'topics': np.array(topics, dtype=np.str_),
+            'measures': np.array(measures, dtype=np.str_),
+            'values': values}
+
+
+def _trec_eval_from_arrays(arrays):
+    trec_eval = collections.defaultdict(dict)
+
+    measures = arrays['measures'].tolist()
+
+    for topic, topic_values in zip(arrays['topics'].tolist(),
+                                   arrays['values']):
+        for measure, value in zip(measures, topic_values.tolist()):
+            if not np.isnan(value):
+                trec_eval[topic][measure] = value
+
+    return trec_eval
+
+
+def _load_cache_entry(entry_path, key, load_fn, mmap):
+    """
+    Loads the cache entry at entry_path if it exists and matches key;
+    returns None otherwise.
+    """
+    try:
+        with open(os.path.join(entry_path, 'key.txt'), 'r') as f_key:
+            if f_key.read() != key:
+                return None
+
+        return load_fn(entry_path, mmap)
+    except FileNotFoundError:
+        # The entry does not exist or was replaced while being loaded.
+        return None
+
+
+def _load_cached(path, kind, parse_fn, save_fn, load_fn,
+                 cache_dir=None, mmap=True):
+    """
+    Loads the object parsed from path from the cache; if the cache entry
+    does not exist or is stale (i.e., the path, size or modification time of
+    the file changed), path is parsed using parse_fn and stored using
+    save_fn.
+    """
+    if cache_dir is None:
+        cache_dir = TREC_CACHE_DIR
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    key = '{}\t{}\t{}\t{}\t{}'.format(
+        kind, path, stat.st_size, stat.st_mtime_ns, _CACHE_VERSION)
+
+    entry_path = os.path.join(cache_dir, '{}-{}'.format(
+        kind, hashlib.sha1(path.encode('utf8')).hexdigest()))
+    key_path = os.path.join(entry_path, 'key.txt')
+
+    obj = _load_cache_entry(entry_path, key, load_fn, mmap)
+
+    if obj is not None:
+        logging.debug('Loaded %s from cache %s.', path, entry_path)
+
+        return obj
+
+    if os.path.exists(key_path):
+        logging.info('Cache entry %s for %s is stale.', entry_path, path)
+
+    obj = parse_fn(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write the entry to a temporary directory first, such that concurrent
+    # readers never observe a partially written entry.
+    tmp_entry_path = tempfile.mkdtemp(dir=cache_dir)
+
+    save_fn(obj, tmp_entry_path)
+
+    with open(os.path.join(tmp_entry_path, 'key.txt'), 'w') as f_key:
+        f_key.write(key)
+
+    # Stale entries are first moved out of the way (atomically), rather than
+    # deleted in place; readers that already opened or memory-mapped their
+    # files keep using them.
+    tombstone_path = tempfile.mkdtemp(dir=cache_dir)
+
+    try:
+        try:
+            os.rename(entry_path, os.path.join(tombstone_path, 'entry'))
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.rename(tmp_entry_path, entry_path)
+
+            logging.debug('Cached %s in %s.', path, entry_path)
+        except OSError:
+            # Another process wrote the entry in the meantime.
+            logging.debug('Cache entry %s for %s was written concurrently.',
+                          entry_path, path)
+
+            shutil.rmtree(tmp_entry_path, ignore_errors=True)
+
+            concurrent_obj = _load_cache_entry(
+                entry_path, key, load_fn, mmap)
+
+            if concurrent_obj is not None:
+                obj = concurrent_obj
+    finally:
+        shutil.rmtree(tombstone_path, ignore_errors=True)
+
+    return obj
+
+
+def _parse_columnar_trec_run(path):
+    with open(path, 'rb') as f_run:
+        return ColumnarTRECRun.parse(f_run)
+
+
+def _parse_columnar_trec_qrel(path):
+    with open(path, 'rb') as f_qrel:
+        return ColumnarTRECQrel.parse(f_qrel)
+
+
+def load_cached_run(path, cache_dir=None, mmap=True):
+    """
+    Parses the TREC run at path into a ColumnarTRECRun, using an on-disk
+    cache keyed on the path, size and modification time of the file.
+
+    Cache entries are stored in cache_dir (default: TREC_CACHE_DIR, which
+    can be set using the TREC_UTILS_CACHE_DIR environment variable) as
+    .npy files that are memory-mapped when loaded (if mmap is set), such
+    that processes share them through the page cache.
+    """
+    return _load_cached(
+        path, 'run', _parse_columnar_trec_run,
+        ColumnarTRECRun.save, ColumnarTRECRun.load,
+        cache_dir=cache_dir, mmap=mmap)
+
+
+def load_cached_qrel(path, cache_dir=None, mmap=True):
+    """
+    Parses the relevance judgments at path into a ColumnarTRECQrel, using
+    the on-disk cache (see load_cached_run).
+    """
+    return _load_cached(
+        path, 'qrel', _parse_columnar_trec_qrel,
+        ColumnarTRECQrel.save, ColumnarTRECQrel.load,
+        cache_dir=cache_dir, mmap=mmap)
+
+
+def load_cached_trec_eval(path, cache_dir=None):
+    """
+    Parses the trec_eval output at path, as parse_trec_eval does, using the
+    on-disk cache (see load_cached_run).
+    """
+    return _trec_eval_from_arrays(_load_cached(
+        path, 'trec_eval', _parse_trec_eval_arrays,
+        lambda arrays, entry_path: _save_arrays(entry_path, **arrays),
+        _load_arrays,
+        cache_dir=cache_dir, mmap=False))
+
+
+FUSION_METHODS = ('combsum', 'combmnz', 'rrf')
+FUSION_NORMALIZATIONS = ('none', 'minmax', 'zscore', 'rank')
+
+
+def _as_columnar_run(run):
+    """
+    Converts a path to a run, a TRECRun or a dictionary in the format of
+    parse_trec_run into a ColumnarTRECRun.
+    """
+    if isinstance(run, ColumnarTRECRun):
+        return run
+    elif isinstance(run, str):
+        with open(run, 'rb') as f_run:
+            return ColumnarTRECRun.parse(f_run)
+    else:
+        return ColumnarTRECRun.from_dict(run)
+
+
+def normalize_run_scores(run, normalization):
+    """
+    Normalizes the scores of a ColumnarTRECRun per topic; returns an array
+    aligned with run.scores.
+
+    Supported normalizations are:
+        - none: the scores are kept as-is.
+        - minmax: scores are mapped linearly onto [0, 1]; if all scores of
+            a topic are equal, they are mapped to 1.
+        - zscore: scores are standardized to zero mean and unit variance;
+            if all scores of a topic are equal, they are mapped to 0.
+        - rank: the object at rank r out of n gets 1 - (r - 1) / n.
+    """
+    assert normalization in FUSION_NORMALIZATIONS
+
+    if normalization == 'none' or not len(run.scores):
+        return run.scores.astype(np.float64)
+
+    segments = run.topic_segments()
+
+    starts = run.topic_offsets[:-1]
+    counts = np.diff(run.topic_offsets)
+
+    if normalization == 'minmax':
+        minima = np.minimum.reduceat(run.scores, starts)
+        ranges = np.maximum.reduceat(run.scores, starts) - minima
+
+        return np.divide(run.scores - minima[segments], ranges[segments],
+                         out=np.ones(len(run.scores)),
+                         where=ranges[segments] > 0.0)
+    elif normalization == 'zscore':
+        deviations = run.scores - \
+            (np.add.reduceat(run.scores, starts) / counts)[segments]
+        deviations_std = np.sqrt(
+            np.add.reduceat(deviations ** 2, starts) / counts)[segments]
+
+        return np.divide(deviations, deviations_std,
+                         out=np.zeros(len(run.scores)),
+                         where=deviations_std > 0.0)
+    elif normalization == 'rank':
+        return 1.0 - (run.rank_entries() - 1.0) / counts[segments]
+
+
+def fuse_runs(runs, method='combsum', normalization='minmax',
+              weights=None, rrf_k=60):
+    """
+    Fuses runs (ColumnarTRECRun, TRECRun, paths or dictionaries in the
+    format of parse_trec_run) into a single ColumnarTRECRun.
+
+    Supported methods are:
+        - combsum: the sum of the normalized scores of an object.
+        - combmnz: combsum multiplied by the number of runs that
+            retrieved the object.
+        - rrf: reciprocal rank fusion, i.e., the sum of 1 / (rrf_k + r)
+            where r is the rank of the object (normalization is ignored).
+
+    If weights are given, the contribution of every run is multiplied by
+    its weight. The fused run can be written using its write_run method.
+
+    Usage example:
+        fused_run = trec_utils.fuse_runs(
+            run_paths, method='combmnz', normalization='zscore')
+
+        with open('fused.run', 'w') as f_out:
+            fused_run.write_run('combmnz', f_out,
+                                max_objects_per_query=1000)
+    """
+    assert method in FUSION_METHODS
+    assert normalization in FUSION_NORMALIZATIONS
+
+    runs = [_as_columnar_run(run) for run in runs]
+
+    if weights is None:
+        weights = np.ones(len(runs))
+
+    assert len(weights) == len(runs)
+
+    # Align runs on a shared set of sorted object identifiers, such that
+    # identifier ties can be broken using indices.
+    object_ids, object_indices = _merge_sorted_ids(
+        [run.object_ids for run in runs])
+
+    run_object_indices, run_contributions = [], []
+
+    for run, run_object_map, weight in zip(runs, object_indices, weights):
+        run_object_indices.append(run_object_map[run.object_indices])
+
+        if method == 'rrf':
+            contributions = 1.0 / (rrf_k + run.rank_entries())
+        else:
+            contributions = normalize_run_scores(run, normalization)
+
+        run_contributions.append(weight * contributions)
+
+    topic_ids = list(collections.OrderedDict.fromkeys(
+        itertools.chain.from_iterable(run.topic_ids for run in runs)))
+
+    fused_object_indices, fused_scores = [], []
+
+    # Dense accumulators indexed by object, which are reset after every
+    # topic; this avoids sorting the candidates of every topic.
+    accumulated_scores = np.zeros(len(object_ids), dtype=np.float64)
+    accumulated_counts = np.zeros(len(object_ids), dtype=np.int64)
+    last_positions = np.zeros(len(object_ids), dtype=np.int64)
+
+    for topic_id in topic_ids:
+        topic_object_indices, topic_contributions = [], []
+
+        for run_idx, run in enumerate(runs):
+            if topic_id not in run.topic_indices:
+                continue
+
+            idx = run.topic_indices[topic_id]
+            start, end = run.topic_offsets[idx], run.topic_offsets[idx + 1]
+
+            topic_object_indices.append(
+                run_object_indices[run_idx][start:end])
+            topic_contributions.append(
+                run_contributions[run_idx][start:end])
+
+        topic_object_indices = np.concatenate(topic_object_indices)
+        positions = np.arange(len(topic_object_indices))
+
+        last_positions[topic_object_indices] = positions
+        unique_object_indices = topic_object_indices[
+            last_positions[topic_object_indices] == positions]
+
+        np.add.at(accumulated_scores, topic_object_indices,
+                  np.concatenate(topic_contributions))
+        scores = accumulated_scores[unique_object_indices]
+        accumulated_scores[unique_object_indices] = 0.0
+
+        if method == 'combmnz':
+            np.add.at(accumulated_counts, topic_object_indices, 1)
+            scores *= accumulated_counts[unique_object_indices]
+            accumulated_counts[unique_object_indices] = 0
+
+        # Order by decreasing score and decreasing identifier.
+        order = np.lexsort((unique_object_indices, scores))[::-1]
+
+        fused_object_indices.append(unique_object_indices[order])
+        fused_scores.append(scores[order])
+
+    topic_offsets = np.zeros(len(topic_ids) + 1, dtype=np.int64)
+    np.cumsum([len(scores) for scores in fused_scores],
+              out=topic_offsets[1:])
+
+    return ColumnarTRECRun(
+        topic_ids, object_ids, topic_offsets,
+        np.concatenate(fused_object_indices + [np.zeros(0, np.int32)]),
+        np.concatenate(fused_scores + [np.zeros(0)]))
+
+
+_TREC_RUN_FORMAT = \
+    '{subject} Q0 {object} {rank} {relevance:.40f} {model_name}\n'
+_TREC_QREL_FORMAT = '{subject} 0 {object} {relevance}\n'
+
+
+def write_run(model_name, data, out_f,
+              max_objects_per_query=sys.maxsize,
+              skip_sorting=False):
+    return write_ranking(
+        model_name, data, out_f, max_objects_per_query, skip_sorting,
+        _TREC_RUN_FORMAT)
+
+
+def write_qrel(model_name, data, out_f,
+               max_objects_per_query=sys.maxsize,
+               skip_sorting=False):
+    return write_ranking(
+        None, data, out_f, max_objects_per_query, skip_sorting,
+        _TREC_QREL_FORMAT)
+
+
+class OnlineTRECRun(object):
+
+    """
+        Run that is written to a temporary file one topic at a time.
+
+        If in-memory relevance judgments are passed as qrel (see
+        evaluate_run), or a TRECEvaluator, every ranking is evaluated as it
+        is added and the measures computed so far can be retrieved at any
+        time using evaluation(), without going through the file system.
+
+        Usage example:
+            run = trec_utils.OnlineTRECRun('model', qrel=qrel)
+
+            for topic_id, ranking in rankings:
+                run.add_ranking(topic_id, ranking)
+
+                logging.info('MAP so far: %.4f',
+                             run.evaluation()['all']['map'])
+    """
+
+    def __init__(self, name, rank_cutoff=sys.maxsize, write_fn=write_run,
+                 qrel=None, measures=measures.keys()):
+        self.name = name
+        self.rank_cutoff = rank_cutoff
+
+        self.write_fn = write_fn
+
+        if qrel is None:
+            self.evaluator = None
+        else:
+            assert write_fn == write_run
+
+            if isinstance(qrel, TRECEvaluator):
+                self.evaluator = qrel
+            else:
+                self.evaluator = TRECEvaluator(qrel, measures=measures)
+
+        # Per-topic measures and their running sums over evaluated topics.
+        self.topic_evaluations = collections.OrderedDict()
+        self.measure_sums = collections.OrderedDict()
+
+        self.tmp_file = tempfile.NamedTemporaryFile(
+            mode='w', delete=False)
+
+        logging.info('Writing temporary run to %s.',
+                     self.tmp_file.name)
+
+    def add_ranking(self, subject_id, object_assesments):
+        assert self.tmp_file
+
+        if self.evaluator is None or not len(object_assesments) or (
+                _is_assessment_arrays(object_assesments) and
+                not len(object_assesments[0])):
+            self.write_fn(self.name,
+                          data={subject_id: object_assesments},
+                          out_f=self.tmp_file,
+                          max_objects_per_query=self.rank_cutoff)
+
+            return
+
+        # Rank the objects once, for both writing and evaluation.
+        relevances, object_ids = _prepare_ranking(
+            object_assesments, self.rank_cutoff, skip_sorting=False)
+
+        self.write_fn(self.name,
+                      data={subject_id: list(zip(relevances, object_ids))},
+                      out_f=self.tmp_file,
+                      max_objects_per_query=self.rank_cutoff,
+                      skip_sorting=True)
+
+        self._evaluate_ranking(subject_id, object_ids)
+
+    def _evaluate_ranking(self, subject_id, object_ids):
+        if isinstance(subject_id, bytes):
+            subject_id = subject_id.decode('utf8')
+
+        # Evaluation of the file would merge rankings of the same topic.
+        assert subject_id not in self.topic_evaluations, \
+            'Topic {} was already evaluated.'.format(subject_id)
+
+        # The objects were written in the order in which trec_eval ranks
+        # them (i.e., by decreasing relevance and identifier); only the
+        # first occurrence of an object counts.
+        ranking = list(dict.fromkeys(object_ids))
+
+        trec_eval = self.evaluator.evaluate_rankings(
+            [(subject_id, ranking)])
+
+        if subject_id not in trec_eval:
+            # Topic without relevance judgments.
+            return
+
+        self.topic_evaluations[subject_id] = trec_eval[subject_id]
+
+        for measure, value in trec_eval[subject_id].items():
+            self.measure_sums[measure] = \
+                self.measure_sums.get(measure, 0.0) + value
+
+    def evaluation(self):
+        """
+        Returns the measures of the rankings evaluated so far in the
+        format of parse_trec_eval.
+        """
+        assert self.evaluator is not None
+
+        trec_eval = collections.defaultdict(dict)
+
+        if not self.topic_evaluations:
+            return trec_eval
+
+        for topic_id, topic_evaluation in self.topic_evaluations.items():
+            trec_eval[topic_id] = dict(topic_evaluation)
+
+        num_topics = len(self.topic_evaluations)
+
+        for measure, value in self.measure_sums.items():
+            if measure.startswith('num_'):
+                trec_eval['all'][measure] = value
+            else:
+                trec_eval['all'][measure] = value / num_topics
+
+        trec_eval['all']['num_q'] = float(num_topics)
+
+        return trec_eval
+
+    def close_and_return_temporary_path(self):
+        assert self.tmp_file
+
+        tmp_file_path = self.tmp_file.name
+
+        self.tmp_file.close()
+
+        return tmp_file_path
+
+    def close_and_write(self, out_path, overwrite=True):
+        if not overwrite:
+            assert not os.path.exists(out_path)
+        elif os.path.exists(out_path):
+            logging.warning('Overwriting run %s.', out_path)
+
+        tmp_file_path = self.close_and_return_temporary_path()
+        shutil.copy(tmp_file_path, out_path)
+
+        os.remove(tmp_file_path)
+
+    def close_and_evaluate(self, qrel=None, engine='trec_eval'):
+        assert self.tmp_file
+
+        if qrel is None:
+            # The rankings were evaluated as they were added.
+            trec_eval = self.evaluation()
+
+            os.remove(self.close_and_return_temporary_path())
+
+            return trec_eval
+
+        assert isinstance(qrel, OnlineTRECRun) and qrel.write_fn == write_qrel
+        assert qrel.tmp_file
+
+        qrel_tmp_file_path = qrel.tmp_file.name
+        run_tmp_file_path = self.tmp_file.name
+
+        qrel.tmp_file.close()
+        self.tmp_file.close()
+
+        trec_eval = evaluate(
+            run_tmp_file_path, qrel_tmp_file_path, engine=engine)
+
+        os.remove(qrel_tmp_file_path)
+        os.remove(run_tmp_file_path)
+
+        return trec_eval
+
+
+def evaluate(run_path, qrel_path, engine='trec_eval'):
+    """
+    Evaluates the run at run_path using the relevance judgments at qrel_path.
+
+    By default, the trec_eval binary is called and all measures of
+    trec_eval -m all_trec are returned. Use engine='numpy' to compute the
+    measures in trec_utils.measures in-process instead (see TRECEvaluator);
+    the result then only contains those measures.
+    """
+    assert os.path.exists(run_path)
+    assert os.path.exists(qrel_path)
+
+    assert engine in ('numpy', 'trec_eval')
+
+    if engine == 'numpy':
+        with open(run_path, 'r') as f_run:
+            run = parse_trec_run(f_run, return_score=True)
+
+        with open(qrel_path, 'rb') as f_qrel:
+            qrel = ColumnarTRECQrel.parse(f_qrel)
+
+        return evaluate_run(run, qrel)
+
+    command = ['trec_eval -q -m all_trec {} {}'.format(qrel_path, run_path)]
+    out = subprocess.check_output(command, shell=True)
+    return parse_trec_eval(out.decode('ascii').split('\n'))
+
+
+def _parse_measure(measure):
+    """
+    Splits a trec_eval measure name into its family and cut-off
+    (e.g. 'ndcg_cut_10' into ('ndcg_cut', 10)).
+    """
+    if measure in ('map', 'ndcg', 'recip_rank', 'bpref', 'Rprec',
+                   'num_ret', 'num_rel', 'num_rel_ret'):
+        return measure, None
+
+    family, _, cutoff = measure.rpartition('_')
+
+    if family not in ('success', 'P', 'map_cut', 'ndcg_cut', 'recall') or \
+            not cutoff.isdigit() or int(cutoff) < 1:
+        raise ValueError('Unsupported measure "{}".'.format(measure))
+
+    return family, int(cutoff)
+
+
+def _rank_trec_objects(object_scores):
+    """
+    Ranks objects by decreasing score, breaking ties by decreasing
+    identifier, as trec_eval does.
+    """
+    return [object_id for object_id, _ in sorted(
+        object_scores.items(),
+        key=lambda item: (item[1], item[0]), reverse=True)]
+
+
+class TRECEvaluator(object):
+
+    """
+        In-process evaluation engine that computes trec_eval measures using
+        NumPy; see evaluate_run.
+
+        Supported are the measures in trec_utils.measures (and the same
+        families with other cut-offs), as well as num_ret, num_rel and
+        num_rel_ret. Values are identical to those of
+        trec_eval -q -m all_trec, up to the four decimals it prints.
+
+        Usage example:
+            evaluator = trec_utils.TRECEvaluator(qrel)
+
+            for run in runs:
+                trec_eval = evaluator.evaluate(run)
+    """
+
+    def __init__(self, qrel, measures=measures.keys(), relevance_level=1):
+        self.qrel = _qrel_to_dict(qrel)
+        self.measures = list(measures)
+        self.relevance_level = relevance_level
+
+        self.parsed_measures = [
+            _parse_measure(measure) for measure in self.measures]
+
+        self.max_cutoff = max(
+            [cutoff for _, cutoff in self.parsed_measures
+             if cutoff is not None] + [1])
+
+        self.num_rel = {}
+        self.num_nonrel = {}
+        self.ideal_gains = {}
+
+        for topic_id, relevances in self.qrel.items():
+            relevances = np.fromiter(relevances.values(), dtype=np.float64,
+                                     count=len(relevances))
+
+            # Like trec_eval, negative relevance levels are treated as if
+            # the objects were not judged.
+            self.num_rel[topic_id] = np.count_nonzero(
+                relevances >= relevance_level)
+            self.num_nonrel[topic_id] = np.count_nonzero(
+                relevances >= 0.0) - self.num_rel[topic_id]
+
+            self.ideal_gains[topic_id] = -np.sort(
+                -relevances[relevances > 0.0])
+
+    def evaluate(self, run):
+        """
+        Evaluates a run given as a dictionary mapping topic identifiers to
+        dictionaries of object scores (e.g., the output of
+        parse_trec_run(..., return_score=True)), a TRECRun or a
+        ColumnarTRECRun.
+
+        Returns a dictionary in the format of parse_trec_eval.
+        """
+        if isinstance(run, TRECRun):
+            run = run.data
+        elif isinstance(run, ColumnarTRECRun):
+            return self.evaluate_rankings(_iter_columnar_rankings(
+                run, [topic_id for topic_id in sorted(run)
+                      if self.qrel.get(topic_id)]))
+
+        topic_ids = sorted(topic_id for topic_id in run
+                           if self.qrel.get(topic_id) and run[topic_id])
+
+        return self.evaluate_rankings(
+            (topic_id, _rank_trec_objects(run[topic_id]))
+            for topic_id in topic_ids)
+
+    def evaluate_rankings(self, rankings):
+        """
+        Evaluates (topic_id, ranked object identifiers) pairs.
+
+        Returns a dictionary in the format of parse_trec_eval.
+        """
+        rankings = [(topic_id, ranking) for topic_id, ranking in rankings
+                    if self.qrel.get(topic_id) and ranking]
+
+        trec_eval = collections.defaultdict(dict)
+
+        if not rankings:
+            return trec_eval
+
+        values = self._compute_measures(rankings)
+
+        for idx, (topic_id, _) in enumerate(rankings):
+            for measure, topic_values in values.items():
+                trec_eval[topic_id][measure] = float(topic_values[idx])
+
+        for measure, topic_values in values.items():
+            if measure.startswith('num_'):
+                trec_eval['all'][measure] = float(topic_values.sum())
+            else:
+                trec_eval['all'][measure] = float(topic_values.mean())
+
+        trec_eval['all']['num_q'] = float(len(rankings))
+
+        return trec_eval
+
+    def _compute_measures(self, rankings):
+        num_topics = len(rankings)
+
+        depth = max(max(len(ranking) for _, ranking in rankings),
+                    self.max_cutoff)
+
+        # Relevance levels of the ranked objects; unjudged objects and
+        # padding beyond the end of a ranking have level 0.
+        relevances = np.zeros((num_topics, depth), dtype=np.float64)
+        judged = np.zeros((num_topics, depth), dtype=bool)
+
+        num_ret = np.empty(num_topics, dtype=np.int64)
+        num_rel = np.empty(num_topics, dtype=np.int64)
+        num_nonrel = np.empty(num_topics, dtype=np.int64)
+
+        max_ideal_depth = max(
+            len(self.ideal_gains[topic_id]) for topic_id, _ in rankings)
+        ideal_gains = np.zeros((num_topics, max(max_ideal_depth, depth)),
+                               dtype=np.float64)
+
+        for idx, (topic_id, ranking) in enumerate(rankings):
+            topic_qrel = self.qrel[topic_id]
+
+            for rank, object_id in enumerate(ranking):
+                relevance = topic_qrel.get(object_id)
+
+                if relevance is not None and relevance >= 0.0:
+                    relevances[idx, rank] = relevance
+                    judged[idx, rank] = True
+
+            num_ret[idx] = len(ranking)
+            num_rel[idx] = self.num_rel[topic_id]
+            num_nonrel[idx] = self.num_nonrel[topic_id]
+
+            topic_ideal_gains = self.ideal_gains[topic_id]
+            ideal_gains[idx, :len(topic_ideal_gains)] = topic_ideal_gains
+
+        ranks = np.arange(1, depth + 1, dtype=np.float64)
+
+        is_relevant = relevances >= self.relevance_level
+        cum_relevant = np.cumsum(is_relevant, axis=1)
+
+        num_rel_ret = cum_relevant[:, -1]
+
+        safe_num_rel = np.maximum(num_rel, 1)
+
+        precisions = np.where(is_relevant, cum_relevant / ranks, 0.0)
+        cum_precisions = np.cumsum(precisions, axis=1)
+
+        discounts = 1.0 / np.log2(np.arange(2, ideal_gains.shape[1] + 2))
+
+        cum_dcg = np.cumsum(relevances * discounts[:depth], axis=1)
+        cum_ideal_dcg = np.cumsum(ideal_gains * discounts, axis=1)
+
+        def _ndcg(cutoff):
+            ideal_dcg = cum_ideal_dcg[:, cutoff - 1]
+
+            return np.divide(
+                cum_dcg[:, min(cutoff, depth) - 1], ideal_dcg,
+                out=np.zeros(num_topics), where=ideal_dcg > 0.0)
+
+        values = collections.OrderedDict()
+
+        for measure, (family, cutoff) in zip(
+                self.measures, self.parsed_measures):
+            if family == 'num_ret':
+                values[measure] = num_ret
+            elif family == 'num_rel':
+                values[measure] = num_rel
+            elif family == 'num_rel_ret':
+                values[measure] = num_rel_ret
+            elif family == 'success':
+                values[measure] = (
+                    cum_relevant[:, cutoff - 1] > 0).astype(np.float64)
+            elif family == 'P':
+                values[measure] = cum_relevant[:, cutoff - 1] / cutoff
+            elif family == 'recall':
+                values[measure] = np.where(
+                    num_rel > 0,
+                    cum_relevant[:, cutoff - 1] / safe_num_rel, 0.0)
+            elif family == 'map':
+                values[measure] = np.where(
+                    num_rel > 0, cum_precisions[:, -1] / safe_num_rel, 0.0)
+            elif family == 'map_cut':
+                values[measure] = np.where(
+                    num_rel > 0,
+                    cum_precisions[:, cutoff - 1] / safe_num_rel, 0.0)
+            elif family == 'ndcg':
+                values[measure] = _ndcg(ideal_gains.shape[1])
+            elif family == 'ndcg_cut':
+                values[measure] = _ndcg(cutoff)
+            elif family == 'recip_rank':
+                first_relevant = np.argmax(is_relevant, axis=1)
+
+                values[measure] = np.where(
+                    num_rel_ret > 0, 1.0 / (first_relevant + 1), 0.0)
+            elif family == 'Rprec':
+                values[measure] = np.where(
+                    num_rel > 0,
+                    cum_relevant[np.arange(num_topics),
+                                 np.minimum(safe_num_rel, depth) - 1] /
+                    safe_num_rel,
+                    0.0)
+            elif family == 'bpref':
+                is_nonrelevant = judged & ~is_relevant
+                nonrelevant_before = np.minimum(
+                    np.cumsum(is_nonrelevant, axis=1),
+                    num_rel[:, np.newaxis])
+
+                denominator = np.minimum(num_rel, num_nonrel)[:, np.newaxis]
+
+                contributions = np.where(
+                    nonrelevant_before > 0,
+                    1.0 - np.divide(
+                        nonrelevant_before, denominator,
+                        out=np.zeros(nonrelevant_before.shape),
+                        where=denominator > 0),
+                    1.0)
+
+                values[measure] = np.where(
+                    num_rel > 0,
+                    np.where(is_relevant, contributions, 0.0).sum(axis=1) /
+                    safe_num_rel,
+                    0.0)
+
+        return values
+
+
+def _iter_columnar_rankings(run, topic_ids):
+    """
+    Yields (topic_id, ranked object identifiers) pairs for the given topics
+    of a ColumnarTRECRun, ranked as trec_eval does.
+    """
+    ranks = run.rank_entries()
+
+    for topic_id in topic_ids:
+        object_ids, start, end = run._get(topic_id)
+
+        yield topic_id, [
+            object_id.decode('utf8')
+            for object_id in object_ids[np.argsort(ranks[start:end])]]
+
+
+def _qrel_to_dict(qrel):
+    """
+    Converts the output of parse_qrel to a dictionary mapping topic
+    identifiers to dictionaries of object relevances.
+    """
+    if isinstance(qrel, dict):
+        return qrel
+    elif isinstance(qrel, ColumnarTRECQrel):
+        return qrel.to_dict()
+
+    return {topic_id: dict(relevant_items)
+            for topic_id, relevant_items in qrel}
+
+
+def evaluate_run(run, qrel, measures=measures.keys()):
+    """
+    Evaluates an in-memory run (see TRECEvaluator.evaluate) against
+    in-memory relevance judgments (a dictionary mapping topic identifiers to
+    dictionaries of object relevances, the output of parse_qrel or a
+    ColumnarTRECQrel).
+    """
+    return TRECEvaluator(qrel, measures=measures).evaluate(run)
+
+
+def _evaluate_runs_worker_initializer(evaluator):
+    _evaluate_runs_worker_.evaluator = evaluator
+
+
+def _evaluate_runs_worker_(payload):
+    idx, run = payload
+
+    if isinstance(run, str):
+        with open(run, 'rb') as f_run:
+            run = ColumnarTRECRun.parse(f_run)
+
+    return idx, _evaluate_runs_worker_.evaluator.evaluate(run)
+
+_evaluate_runs_worker = multiprocessing_utils.WorkerFunction(
+    _evaluate_runs_worker_)
+
+
+def evaluate_runs(runs, qrel, measures=measures.keys(), num_workers=1):
+    """
+    Evaluates many runs against the same relevance judgments.
+
+    Runs are given as paths, OnlineTRECRun instances (which are evaluated
+    up to the last ranking added) or in-memory runs (see
+    TRECEvaluator.evaluate). The judgments (a path or in-memory judgments,
+    see evaluate_run) are loaded once and shared with a pool of num_workers
+    processes.
+
+    Yields (index, trec_eval) pairs as soon as each run has been
+    evaluated, where index refers to the position of the run in runs and
+    trec_eval is in the format of parse_trec_eval.
+
+    Usage example:
+        for idx, trec_eval in trec_utils.evaluate_runs(
+                run_paths, qrel_path, num_workers=8):
+            logging.info('%s: MAP=%.4f', run_paths[idx],
+                         trec_eval['all']['map'])
+    """
+    assert num_workers > 0
+
+    if isinstance(qrel, str):
+        with open(qrel, 'rb') as f_qrel:
+            qrel = ColumnarTRECQrel.parse(f_qrel)
+
+    evaluator = TRECEvaluator(qrel, measures=measures)
+
+    payloads = []
+
+    for idx, run in enumerate(runs):
+        if isinstance(run, OnlineTRECRun):
+            assert run.write_fn == write_run
+
+            run.tmp_file.flush()
+            run = run.tmp_file.name
+
+        payloads.append((idx, run))
+
+    if num_workers == 1:
+        _evaluate_runs_worker_initializer(evaluator)
+
+        for payload in payloads:
+            yield _evaluate_runs_worker(payload)
+
+        return
+
+    pool = multiprocessing.Pool(
+        min(num_workers, max(len(payloads), 1)),
+        initializer=_evaluate_runs_worker_initializer,
+        initargs=[evaluator])
+
+    try:
+        for idx, trec_eval in pool.imap_unordered(
+                _evaluate_runs_worker, payloads):
+            yield idx, trec_eval
+
+        pool.close()
+    finally:
+        # Stops the workers if the consumer stopped early.
+        pool.terminate()
+        pool.join()
+
+
+_WRITE_RANKING_BLOCK_SIZE = 4096
+
+
+def _is_assessment_arrays(object_assesments):
+    return isinstance(object_assesments, tuple) and \
+        len(object_assesments) == 2 and \
+        isinstance(object_assesments[0], np.ndarray)
+
+
+def _rank_assessment_arrays(relevances, object_ids,
+                            max_objects_per_query, skip_sorting):
+    """
+    Orders parallel arrays of relevances and object identifiers like
+    sorted(zip(relevances, object_ids), reverse=True) would, but only sorts
+    the candidates for the first max_objects_per_query positions.
+    """
+    assert len(relevances) == len(object_ids)
+
+    num_objects = min(len(relevances), max_objects_per_query)
+
+    if skip_sorting:
+        indices = np.arange(num_objects)
+    else:
+        if num_objects < len(relevances):
+            # All objects with a relevance at least equal to the
+            # num_objects-th largest one are candidates, including ties.
+            threshold = np.partition(
+                relevances, len(relevances) - num_objects)[
+                    len(relevances) - num_objects]
+
+            candidates = np.flatnonzero(relevances >= threshold)
+        else:
+            candidates = np.arange(len(relevances))
+
+        indices = candidates[np.lexsort(
+            (object_ids[candidates], relevances[candidates]))[::-1]]
+
+    indices = indices[:num_objects]
+
+    return list(relevances[indices]), object_ids[indices].tolist()
+
+
+def _format_ranking(format, model_name, subject_id,
+                    relevances, object_ids, start_rank):
+    """
+    Formats a ranking as a single string; equivalent to formatting every
+    line using format.format(...).
+    """
+    ranks = range(start_rank + 1, start_rank + len(object_ids) + 1)
+
+    # For the run and qrel formats, all lines are formatted at once by
+    # repeating a printf-style template.
+    if format == _TREC_RUN_FORMAT:
+        line = '{} Q0 %s %d %.40f {}\n'.format(
+            '{}'.format(subject_id).replace('%', '%%'),
+            '{}'.format(model_name).replace('%', '%%'))
+
+        return (line * len(object_ids)) % tuple(itertools.chain.from_iterable(
+            zip(object_ids, ranks, relevances)))
+    elif format == _TREC_QREL_FORMAT:
+        line = '{} 0 %s %s\n'.format(
+            '{}'.format(subject_id).replace('%', '%%'))
+
+        return (line * len(object_ids)) % tuple(itertools.chain.from_iterable(
+            zip(object_ids, map('{}'.format, relevances))))
+    else:
+        return ''.join(
+            format.format(
+                subject=subject_id,
+                object=object_id,
+                rank=rank,
+                relevance=relevance,
+                model_name=model_name)
+            for rank, relevance, object_id in zip(
+                ranks, relevances, object_ids))
+
+
+def _prepare_ranking(object_assesments, max_objects_per_query,
+                     skip_sorting):
+    """
+    Sorts and truncates a non-empty ranking as write_ranking does.
+
+    Returns a list of relevances and a list of object identifiers (str).
+    """
+    if _is_assessment_arrays(object_assesments):
+        relevances, object_ids = _rank_assessment_arrays(
+            *object_assesments,
+            max_objects_per_query=max_objects_per_query,
+            skip_sorting=skip_sorting)
+    else:
+        # Probe types, to make sure everything goes alright.
+        # assert isinstance(object_assesments[0][0], float) or \
+        #     isinstance(object_assesments[0][0], np.float32)
+        assert isinstance(object_assesments[0][1], str) or \
+            isinstance(object_assesments[0][1], bytes)
+
+        if not skip_sorting:
+            if max_objects_per_query < len(object_assesments):
+                # Equivalent to sorting and truncating.
+                object_assesments = heapq.nlargest(
+                    max_objects_per_query, object_assesments)
+            else:
+                object_assesments = sorted(
+                    object_assesments, reverse=True)
+
+        if max_objects_per_query < sys.maxsize:
+            object_assesments = object_assesments[:max_objects_per_query]
+
+        relevances = [relevance for relevance, _ in object_assesments]
+        object_ids = [object_id for _, object_id in object_assesments]
+
+    object_ids = [
+        object_id.decode('utf8') if isinstance(object_id, bytes)
+        else object_id
+        for object_id in object_ids]
+
+    return relevances, object_ids
+
+
+def write_ranking(model_name, data, out_f,
+                  max_objects_per_query,
+                  skip_sorting,
+                  format):
+    """
+    Write a run to an output file.
+
+    Parameters:
+        - model_name: identifier of run.
+        - data: dictionary mapping topic_id to object_assesments;
+            object_assesments is an iterable (list or tuple) of
+            (relevance, object_id) pairs, or a (relevances, object_ids)
+            tuple of NumPy arrays.
+
+            The object_assesments iterable is sorted by decreasing order.
+        - out_f: output file stream.
+        - max_objects_per_query: cut-off for number of objects per query.
+    """
+    for subject_id, object_assesments in data.items():
+        if not len(object_assesments) or (
+                _is_assessment_arrays(object_assesments) and
+                not len(object_assesments[0])):
+            logging.warning('Received empty ranking for %s; ignoring.',
+                            subject_id)
+
+            continue
+
+        relevances, object_ids = _prepare_ranking(
+            object_assesments, max_objects_per_query, skip_sorting)
+
+        if isinstance(subject_id, bytes):
+            subject_id = subject_id.decode('utf8')
+
+        for start in range(0, len(object_ids), _WRITE_RANKING_BLOCK_SIZE):
+            end = start + _WRITE_RANKING_BLOCK_SIZE
+
+            out_f.write(_format_ranking(
+                format, model_name, subject_id,
+                relevances[start:end], object_ids[start:end], start))